@@ -55,7 +55,8 @@ class BFDTopo(Topo):
         for routern in range(1, 5):
             tgen.add_router('r{}'.format(routern))
 
-        switch = tgen.add_switch('s1')
+        # r1-eth0 is disabled by test_bfd_fast_convergence()
+        switch = tgen.add_switch('s1', collapse=False)
         switch.add_link(tgen.gears['r1'])
         switch.add_link(tgen.gears['r2'])
 
@@ -24,9 +24,16 @@
 
 """
 test_bgp_ecmp_topo1.py: Test BGP topology with ECMP (Equal Cost MultiPath).
+
+The number of peers (20 by default) and of routes per peer route group (10
+by default, at most 256) are the `bgp_ecmp_peers` and `bgp_ecmp_routes`
+scale parameters (see Topogen.get_scale()), e.g.:
+`TOPOTESTS_BGP_ECMP_PEERS=500 pytest bgp-ecmp-topo1`.
+
+Benchmark the 20, 100 and 500 peers sizes in one session with:
+`python lib/toporunner.py --scale bgp_ecmp_peers=20,100,500 bgp-ecmp-topo1`.
 """
 
-import json
 import functools
 import os
 import sys
@@ -45,7 +52,9 @@ from lib.topolog import logger
 # Required to instantiate the topology builder class.
 from mininet.topo import Topo
 
+# Scale parameters (set when building the topology)
 total_ebgp_peers = 20
+total_routes = 10
 
 #####################################################
 #
@@ -58,27 +67,52 @@ class BGPECMPTopo1(Topo):
     "BGP ECMP Topology 1"
 
     def build(self, **_opts):
+        global total_ebgp_peers, total_routes
         tgen = get_topogen(self)
+        total_ebgp_peers = tgen.get_scale('bgp_ecmp_peers', 20, nodes=True)
+        total_routes = tgen.get_scale('bgp_ecmp_routes', 10)
+        # The route groups are /24 prefixes within a /16
+        if total_routes > 256:
+            raise ValueError('too many routes per group: {}'.format(
+                total_routes))
 
         # Create the BGP router
         router = tgen.add_router('r1')
 
-        # Setup Switches - 1 switch per 5 peering routers
-        for swNum in range(1, (total_ebgp_peers + 4) / 5 + 1):
-            switch = tgen.add_switch('s{}'.format(swNum))
-            switch.add_link(router)
-
-        # Add 'total_ebgp_peers' number of eBGP ExaBGP neighbors
-        for peerNum in range(1, total_ebgp_peers+1):
-            swNum = ((peerNum - 1) / 5 + 1)
-
-            peer_ip = '10.0.{}.{}'.format(swNum, peerNum + 100)
-            peer_route = 'via 10.0.{}.1'.format(swNum)
-            peer = tgen.add_exabgp_peer('peer{}'.format(peerNum),
-                                        ip=peer_ip, defaultRoute=peer_route)
-
-            switch = tgen.gears['s{}'.format(swNum)]
-            switch.add_link(peer)
+        # Add 'total_ebgp_peers' number of eBGP ExaBGP neighbors, 1 switch per
+        # 5 peering routers. The first half of the peers share the same AS.
+        tgen.add_bgp_fanout(router, total_ebgp_peers, peer_as=peer_asn)
+
+
+def peer_asn(num):
+    "Returns the AS number of the peer number `num`."
+    if num <= total_ebgp_peers / 2:
+        return 99
+    return num + 100
+
+
+def peer_routes(peer):
+    "Returns the routes announced by `peer`."
+    num = peer.fanout['num']
+    aspath = [peer.fanout['asn'], 200]
+    return [
+        # Equal routes per PE - different neighbor AS
+        {'prefix': '10.201.0.0/24', 'count': total_routes, 'med': 100},
+        # Equal routes per PE - different neighbor AS, but same source AS
+        {'prefix': '10.202.0.0/24', 'count': total_routes, 'med': 100,
+         'as_path': aspath},
+        # Equal routes with different med per PE and different neighbor AS
+        {'prefix': '10.203.0.0/24', 'count': total_routes, 'med': num},
+        # Equal routes with different med per PE and different neighbor AS,
+        # but same source AS
+        {'prefix': '10.204.0.0/24', 'count': total_routes, 'med': num,
+         'as_path': aspath},
+        # 2 different routes per peer
+        {'prefix': '10.{}.{}.0/24'.format(205 + num / 256, num % 256),
+         'count': 1},
+        {'prefix': '172.{}.{}.0/24'.format(16 + num / 256, num % 256),
+         'count': 1, 'as_path': aspath},
+    ]
 
 
 #####################################################
@@ -91,27 +125,26 @@ def setup_module(module):
     tgen = Topogen(BGPECMPTopo1, module.__name__)
     tgen.start_topology()
 
+    # Generate the router and peers configurations
+    confdir = tgen.write_bgp_fanout(100, '10.0.255.1', peer_routes)
+
     # Starting Routers
     router_list = tgen.routers()
     for rname, router in router_list.iteritems():
         router.load_config(
             TopoRouter.RD_ZEBRA,
-            os.path.join(CWD, '{}/zebra.conf'.format(rname))
+            os.path.join(confdir, '{}/zebra.conf'.format(rname))
         )
         router.load_config(
             TopoRouter.RD_BGP,
-            os.path.join(CWD, '{}/bgpd.conf'.format(rname))
+            os.path.join(confdir, '{}/bgpd.conf'.format(rname))
         )
         router.start()
 
     # Starting Hosts and init ExaBGP on each of them
-    topotest.sleep(10, 'starting BGP on all {} peers'.format(total_ebgp_peers))
-    peer_list = tgen.exabgp_peers()
-    for pname, peer in peer_list.iteritems():
-        peer_dir = os.path.join(CWD, pname)
-        env_file = os.path.join(CWD, 'exabgp.env')
-        peer.start(peer_dir, env_file)
-        logger.info(pname)
+    logger.info('starting BGP on all {} peers'.format(total_ebgp_peers))
+    if not tgen.start_bgp_fanout(os.path.join(CWD, 'exabgp.env')):
+        tgen.set_error('ExaBGP peers sessions not established')
 
 
 def teardown_module(module):
@@ -129,12 +162,24 @@ def test_bgp_convergence():
 
     # Expected result
     router = tgen.gears['r1']
-    if router.has_version('<', '3.0'):
-        reffile = os.path.join(CWD, 'r1/summary20.txt')
-    else:
-        reffile = os.path.join(CWD, 'r1/summary.txt')
-
-    expected = json.loads(open(reffile).read())
+    expected = {
+        'routerId': '10.0.255.1',
+        'as': 100,
+        'vrfId': 0,
+        'vrfName': 'Default',
+        'peerCount': total_ebgp_peers,
+        'peers': {},
+        'totalPeers': total_ebgp_peers,
+    }
+    for peer in tgen.exabgp_peers().values():
+        expected['peers'][peer.address()] = {
+            'outq': 0,
+            'inq': 0,
+            'prefixReceivedCount': 4 * total_routes + 2,
+            'state': 'Established',
+        }
+    if not router.has_version('<', '3.0'):
+        expected = {'ipv4Unicast': expected}
 
     def _output_summary_cmp(router, cmd, data):
         """
@@ -171,10 +216,10 @@ def test_bgp_ecmp():
     }
 
     for net in range(1, 5):
-        for subnet in range(0, 10):
+        for subnet in range(0, total_routes):
             netkey = '10.20{}.{}.0/24'.format(net, subnet)
             expect['routes'][netkey] = []
-            for _ in range(0, 10):
+            for _ in range(0, min(10, total_ebgp_peers)):
                 peer = {'multipath': True, 'valid': True}
                 expect['routes'][netkey].append(peer)
 
@@ -2,9 +2,14 @@
 Topotest conftest.py file.
 """
 
+import json
+import time
+
 from lib.topogen import get_topogen, diagnose_env
 from lib.topotest import json_cmp_result
 from lib.topolog import logger
+from lib.topotrace import timeline
+from lib.topohistory import TimingHistory
 import pytest
 
 def pytest_addoption(parser):
@@ -14,6 +19,16 @@ def pytest_addoption(parser):
     """
     parser.addoption('--topology-only', action='store_true',
                      help='Only set up this topology, don\'t run tests')
+    parser.addoption('--timing-report', metavar='FILE', default=None,
+                     help='Write the per module phase timing report (JSON) '
+                     'to FILE and show its summary')
+    parser.addoption('--timing-history', metavar='DB', default=None,
+                     help='Store the run timings in the SQLite database DB')
+    parser.addoption('--timing-regressions', action='store_true',
+                     help='Fail the run when the timings are significantly '
+                     'slower than the ones stored in --timing-history')
+    parser.addoption('--timing-baseline', metavar='VERSION', default=None,
+                     help='Only compare against runs of FRR version VERSION')
 
 def pytest_runtest_call():
     """
@@ -47,6 +62,17 @@ def pytest_configure(config):
     if not diagnose_env():
         pytest.exit('enviroment has errors, please read the logs')
 
+    report_path = config.getoption('--timing-report')
+    history_path = config.getoption('--timing-history')
+    if config.getoption('--timing-regressions') and history_path is None:
+        pytest.exit('--timing-regressions requires --timing-history')
+    if report_path is not None or history_path is not None:
+        config.pluginmanager.register(
+            TimingReport(report_path, history_path,
+                         config.getoption('--timing-regressions'),
+                         config.getoption('--timing-baseline')),
+            'topotest_timing')
+
 def pytest_runtest_makereport(item, call):
     "Log all assert messages to default logger with error level"
     # Nothing happened
@@ -66,3 +92,147 @@ def pytest_runtest_makereport(item, call):
     parent._previousfailed = item
     logger.error('assert failed at "{}/{}": {}'.format(
         modname, item.name, call.excinfo.value))
+
+class TimingReport(object):
+    """
+    Test timing plugin: records, for each test module, the time spent
+    building the topology, starting the routers, running each test function
+    and tearing down. The results are written to a JSON file and summarized
+    in the terminal sorted by cost.
+
+    Topology build and router start are obtained from the Topogen timeline
+    spans, so tests that don't use Topogen only report setup, tests and
+    teardown.
+
+    When `history_path` is set the timings are also stored in the timing
+    history database and, if `regressions` is set, compared with the
+    previous runs: significant slowdowns fail the test run.
+    """
+
+    def __init__(self, path, history_path=None, regressions=False,
+                 baseline_version=None):
+        self.path = path
+        self.history_path = history_path
+        self.check_regressions = regressions
+        self.baseline_version = baseline_version
+        self.regressions = []
+        self.modules = {}
+        self.order = []
+        self.start_time = time.time()
+        # Record the Topogen lifecycle even without timeline output.
+        timeline.always_record = True
+
+    def _module(self, modname):
+        "Returns the module timing entry, creates it if needed."
+        if modname not in self.modules:
+            self.order.append(modname)
+            self.modules[modname] = {
+                'module': modname,
+                'version': None,
+                'setup': 0.0,
+                'topology_build': 0.0,
+                'router_start': 0.0,
+                'tests': {},
+                'teardown': 0.0,
+                'convergence': [],
+                'total': 0.0,
+            }
+        return self.modules[modname]
+
+    def pytest_runtest_logreport(self, report):
+        "Accumulate the test phases duration."
+        modname = report.nodeid.split('::')[0]
+        entry = self._module(modname)
+        if report.when == 'call':
+            testname = report.nodeid.split('::')[-1]
+            entry['tests'][testname] = report.duration
+        else:
+            entry[report.when] += report.duration
+        entry['total'] += report.duration
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_teardown(self, item, nextitem):
+        "Collect the Topogen timeline when the module finishes."
+        yield
+
+        if nextitem is not None and nextitem.module is item.module:
+            return
+
+        entry = self._module(item.nodeid.split('::')[0])
+        if timeline.modname != item.module.__name__:
+            return
+
+        for name, lane, _, duration, args in timeline.spans():
+            if lane == timeline.TOPOLOGY_LANE:
+                if name in ['_init_topo', 'start_topology']:
+                    entry['topology_build'] += duration
+            elif name == 'start':
+                entry['router_start'] += duration
+
+        for name, _, _, duration, args in timeline.spans('run_and_expect'):
+            entry['convergence'].append({
+                'name': name,
+                'duration': duration,
+                'success': args.get('success'),
+            })
+
+        tgen = get_topogen()
+        if tgen is None or tgen.net is None:
+            return
+        for rname in sorted(tgen.routers().keys()):
+            version = getattr(tgen.net[rname], 'version', None)
+            if version is not None:
+                entry['version'] = version
+                break
+
+    def pytest_terminal_summary(self, terminalreporter):
+        "Show the module timings sorted by cost."
+        modules = sorted(self.modules.values(), key=lambda e: e['total'],
+                         reverse=True)
+        terminalreporter.section('topotest timing report')
+        terminalreporter.write_line(
+            '{:>9} {:>9} {:>9} {:>9} {:>9}  {}'.format(
+                'total', 'build', 'start', 'tests', 'teardown', 'module'))
+        for entry in modules:
+            terminalreporter.write_line(
+                '{:9.2f} {:9.2f} {:9.2f} {:9.2f} {:9.2f}  {}'.format(
+                    entry['total'], entry['topology_build'],
+                    entry['router_start'], sum(entry['tests'].values()),
+                    entry['teardown'], entry['module']))
+        if self.path is not None:
+            terminalreporter.write_line(
+                'report written to {}'.format(self.path))
+
+        if not self.check_regressions:
+            return
+        if not self.regressions:
+            terminalreporter.write_line('no timing regressions found')
+            return
+        for regression in self.regressions:
+            terminalreporter.write_line(
+                'timing regression: {}'.format(regression), red=True)
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_sessionfinish(self, session):
+        "Write the JSON report and update the timing history."
+        modules = [self.modules[modname] for modname in self.order]
+        if self.path is not None:
+            report = {
+                'start': self.start_time,
+                'duration': time.time() - self.start_time,
+                'modules': modules,
+            }
+            with open(self.path, 'w') as fhandle:
+                json.dump(report, fhandle, indent=2, sort_keys=True)
+
+        if self.history_path is None or not modules:
+            return
+
+        history = TimingHistory(self.history_path)
+        run_id = history.add_run(modules, start=self.start_time)
+        if self.check_regressions:
+            self.regressions = history.find_regressions(
+                run_id, self.baseline_version)
+            if self.regressions and session.exitstatus == 0:
+                session.exitstatus = 1
+        history.close()
@@ -107,7 +107,8 @@ class TemplateTopo(Topo):
         switch.add_link(tgen.gears['ce3'])
         switch.add_link(tgen.gears['r3'])
 
-        switch = tgen.add_switch('s4')
+        # r1-eth1 is disabled by test_ldp_pseudowires_after_link_down()
+        switch = tgen.add_switch('s4', collapse=False)
         switch.add_link(tgen.gears['r1'])
         switch.add_link(tgen.gears['r2'])
 
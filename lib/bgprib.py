@@ -34,74 +34,75 @@
 # ribRequireUnicastRoutes('r1','ipv4','','Customer routes in default',want_unicast_routes)
 #
 
-from lutil import luCommand,luResult
+from lutil import luCommand,luResult,luLastOutput
 import json
 import re
 
+# RIB parsed once and indexed by (RD, prefix) -> set of nexthops, the RD
+# is None for unicast tables
+class RibIndex:
+    def __init__(self):
+        self.routes = {}
+
+    def add_table(self, rd, pfxtbl):
+        for pfx, paths in pfxtbl.iteritems():
+            nexthops = self.routes.setdefault((rd, pfx), set())
+            for path in paths:
+                for nh in path.get('nexthops', []):
+                    nexthops.add(nh.get('ip'))
+
+    @classmethod
+    def from_vpn(cls, rib):
+        # 'show bgp ipv4 vpn json' output
+        index = cls()
+        rds = rib.get('routes', {}).get('routeDistinguishers', {})
+        for rd, pfxtbl in rds.iteritems():
+            index.add_table(rd, pfxtbl)
+        return index
+
+    @classmethod
+    def from_unicast(cls, rib):
+        # 'show bgp [vrf X] <afi> unicast json' output
+        index = cls()
+        index.add_table(None, rib.get('routes', {}))
+        return index
+
+    def nexthops(self, pfx, rd=None):
+        return self.routes.get((rd, pfx), set())
+
+    def missing(self, wantroutes):
+        # all wanted routes ({'rd':..., 'p':..., 'n':...}) not in the RIB
+        return [want for want in wantroutes
+                if want['n'] not in self.nexthops(want['p'], want.get('rd'))]
+
+    @staticmethod
+    def route_str(want):
+        if want.get('rd') is not None:
+            return 'rd=%s pfx=%s nh=%s' % (want['rd'], want['p'], want['n'])
+        return 'pfx=%s nh=%s' % (want['p'], want['n'])
+
 # gpz: get rib in json form and compare against desired routes
 class BgpRib:
-    def routes_include_wanted(self,pfxtbl,want,debug):
-	# helper function to RequireVpnRoutes
-	for pfx in pfxtbl.iterkeys():
-	    if debug:
-		print 'trying pfx ' + pfx
-	    if pfx != want['p']:
-		if debug:
-		    print 'want pfx=' + want['p'] + ', not ' + pfx
-		continue
-	    if debug:
-		print 'have pfx=' + pfx
-	    for r in pfxtbl[pfx]:
-		if debug:
-		    print 'trying route'
-		nexthops = r['nexthops']
-		for nh in nexthops:
-		    if debug:
-			print 'trying nh ' + nh['ip']
-		    if nh['ip'] == want['n']:
-			if debug:
-			    print 'found ' + want['n']
-			return 1
-		    else:
-			if debug:
-			    print 'want nh=' + want['n'] + ', not ' + nh['ip']
-	    if debug:
-		print 'missing route: pfx=' + want['p'] + ', nh=' + want['n']
-	    return 0
-
-    def RequireVpnRoutes(self, target, title, wantroutes, debug=0):
+    # when to get the non json RIB for humans: 'always' (before the json
+    # check), 'fail' (only when the check fails, attached to the failure
+    # record) or 'never'
+    human_dump = 'fail'
+
+    def RequireVpnRoutes(self, target, title, wantroutes):
 	import json
         logstr = "RequireVpnRoutes " + str(wantroutes)
         #non json form for humans
-	luCommand(target,'vtysh -c "show bgp ipv4 vpn"','.','None','Get VPN RIB (non-json)')
+        human = ('show bgp ipv4 vpn', 'Get VPN RIB (non-json)')
+        self.dump_for_humans(target, human, 'always')
 	ret = luCommand(target,'vtysh -c "show bgp ipv4 vpn json"','.*','None','Get VPN RIB (json)')
         if re.search(r'^\s*$', ret):
             # degenerate case: empty json means no routes
-            if len(wantroutes) > 0:
-                luResult(target, False, title, logstr)
-                return
-            luResult(target, True, title, logstr)
-	rib = json.loads(ret)
-	rds = rib['routes']['routeDistinguishers']
-	for want in wantroutes:
-	    found = 0
-	    if debug:
-		print "want rd " + want['rd']
-	    for rd in rds.iterkeys():
-		if rd != want['rd']:
-		    continue
-		if debug:
-		    print "found rd " + rd
-		table = rds[rd]
-		if self.routes_include_wanted(table,want,debug):
-		    found = 1
-		    break
-	    if not found:
-		luResult(target, False, title, logstr)
-		return
-	luResult(target, True, title, logstr)
-
-    def RequireUnicastRoutes(self,target,afi,vrf,title,wantroutes,debug=0):
+            missing = wantroutes
+        else:
+            missing = RibIndex.from_vpn(json.loads(ret)).missing(wantroutes)
+	self.report_missing(target, title, logstr, missing, human)
+
+    def RequireUnicastRoutes(self,target,afi,vrf,title,wantroutes):
         logstr = "RequireVpnRoutes " + str(wantroutes)
 	vrfstr = ''
 	if vrf != '':
@@ -112,29 +113,50 @@ class BgpRib:
 
 	cmdstr = 'show bgp %s %s unicast' % (vrfstr, afi)
         #non json form for humans
-	cmd = 'vtysh -c "%s"' % cmdstr
-	luCommand(target,cmd,'.','None','Get %s %s RIB (non-json)' % (vrfstr, afi))
+        human = (cmdstr, 'Get %s %s RIB (non-json)' % (vrfstr, afi))
+        self.dump_for_humans(target, human, 'always')
         cmd = 'vtysh -c "%s json"' % cmdstr
 	ret = luCommand(target,cmd,'.*','None','Get %s %s RIB (json)' % (vrfstr, afi))
         if re.search(r'^\s*$', ret):
             # degenerate case: empty json means no routes
-            if len(wantroutes) > 0:
-                luResult(target, False, title, logstr)
-                return
-            luResult(target, True, title, logstr)
-	rib = json.loads(ret)
-	table = rib['routes']
-	for want in wantroutes:
-	    if not self.routes_include_wanted(table,want,debug):
-		luResult(target, False, title, logstr)
-		return
-	luResult(target, True, title, logstr)
+            missing = wantroutes
+        else:
+            missing = RibIndex.from_unicast(json.loads(ret)).missing(wantroutes)
+	self.report_missing(target, title, logstr, missing, human)
+
+    def dump_for_humans(self, target, human, mode):
+        # run the non json command (cmdstr, description) in the given mode
+        if self.human_dump != mode:
+            return None
+        # the whole output, not just the match
+        if luCommand(target, 'vtysh -c "%s"' % human[0], '.*', 'none',
+                     human[1]) is False:
+            return None
+        return luLastOutput()
+
+    def report_missing(self, target, title, logstr, missing, human=None):
+        # pass when nothing is missing, otherwise list all missing routes
+        if len(missing) > 0:
+            logstr += "\nmissing %d route(s): %s" % (
+                len(missing), ', '.join([RibIndex.route_str(want)
+                                         for want in missing]))
+            if human is not None:
+                dump = self.dump_for_humans(target, human, 'fail')
+                if dump is not None:
+                    logstr += "\n%s:\n%s" % (human[0], dump)
+        luResult(target, len(missing) == 0, title, logstr)
 
 
 BgpRib=BgpRib()
 
-def bgpribRequireVpnRoutes(target, title, wantroutes, debug=0):
-    BgpRib.RequireVpnRoutes(target, title, wantroutes, debug)
+def bgpribSetHumanDump(mode):
+    # see BgpRib.human_dump
+    if mode not in ['always', 'fail', 'never']:
+        raise ValueError('invalid human dump mode: %s' % mode)
+    BgpRib.human_dump = mode
+
+def bgpribRequireVpnRoutes(target, title, wantroutes):
+    BgpRib.RequireVpnRoutes(target, title, wantroutes)
 
-def bgpribRequireUnicastRoutes(target, afi, vrf, title, wantroutes, debug=0):
-    BgpRib.RequireUnicastRoutes(target, afi, vrf, title, wantroutes, debug)
+def bgpribRequireUnicastRoutes(target, afi, vrf, title, wantroutes):
+    BgpRib.RequireUnicastRoutes(target, afi, vrf, title, wantroutes)
@@ -22,7 +22,11 @@ import sys
 import time
 import datetime
 import json
+import threading
+from contextlib import contextmanager
 from topolog import logger
+from topotrace import tracer
+from topotest import CommandTimeoutError, node_cmd, cache_tick
 from mininet.net import Mininet
 
 
@@ -31,6 +35,29 @@ from mininet.net import Mininet
 # These functions are inteneted to provide support for CI testing within MiniNet
 # environments.
 
+# Compiled regular expressions, by (pattern, flags)
+_regexp_cache = {}
+
+def luRegexp(regexp, flags=0):
+    key = (regexp, flags)
+    compiled = _regexp_cache.get(key)
+    if compiled == None:
+        compiled = re.compile(regexp, flags)
+        _regexp_cache[key] = compiled
+    return compiled
+
+# Compiled scripts (code objects for .py files, step plans for test files),
+# by path: (mtime, compiled)
+_script_cache = {}
+
+def luCompiled(path, compiler):
+    mtime = os.path.getmtime(path)
+    cached = _script_cache.get(path)
+    if cached == None or cached[0] != mtime:
+        cached = (mtime, compiler(path))
+        _script_cache[path] = cached
+    return cached[1]
+
 class lUtil:
     #to be made configurable in the future
     base_script_dir = '.'
@@ -48,6 +75,14 @@ class lUtil:
     l_line = 0
     l_dotall_experiment = False
     l_last_nl = None
+    l_last_out = None
+    l_last_regexp = None
+    l_wait_group = None
+    # wait polling: the pause between polls starts at l_wait_min secs and
+    # grows by l_wait_backoff up to l_wait_max secs
+    l_wait_min = 0.1
+    l_wait_max = 2.0
+    l_wait_backoff = 1.5
 
     fout = ''
     fsum = ''
@@ -56,14 +91,14 @@ class lUtil:
     def log(self, str):
         if self.l_level > 0:
             if self.fout == '':
-                self.fout = open(self.fout_name, 'w', 0)
+                self.fout = open(self.fout_name, 'w')
             self.fout.write(str+'\n')
         if self.l_level > 5:
             print(str)
 
     def summary(self, str):
         if self.fsum == '':
-            self.fsum = open(self.fsum_name, 'w', 0)
+            self.fsum = open(self.fsum_name, 'w')
             self.fsum.write('\
 ******************************************************************************\n')
             self.fsum.write('\
@@ -72,6 +107,13 @@ Test Target Summary                                                  Pass Fail\n
 ******************************************************************************\n')
         self.fsum.write(str+'\n')
 
+    def flush(self):
+        # logs are buffered, written at each result and when closing
+        if self.fout != '':
+            self.fout.flush()
+        if self.fsum != '':
+            self.fsum.flush()
+
     def result(self, target, success, str, logstr=None):
         if success:
             p = 1
@@ -89,6 +131,7 @@ Test Target Summary                                                  Pass Fail\n
         res = "%-4d %-6s %-56s %-4d %d" % (self.l_total, target, str, p, f)
         self.log ('R:'+res)
         self.summary(res)
+        self.flush()
         if f == 1 and self.CallOnFail != False:
             self.CallOnFail()
 
@@ -158,23 +201,33 @@ Total %-4d                                                           %-4d %d\n\
 
         return a
 
+    def compileTestFile(self, tstFile):
+        # parse a test file once into a plan of (line, arguments) steps
+        plan = []
+        f = open(tstFile)
+        for line in f:
+            if len(line) > 1:
+                a = self.strToArray(line)
+                if len(a) >= 6:
+                    # compile the step regexp ahead of time
+                    luRegexp(a[3])
+                plan.append((line, a))
+        f.close()
+        return plan
+
     def execTestFile(self, tstFile):
         if os.path.isfile(tstFile):
-            f = open(tstFile)
-            for line in f:
-                if len(line) > 1:
-                    a = self.strToArray(line)
-                    if len(a) >= 6:
-                        luCommand(a[1], a[2], a[3], a[4], a[5])
-                    else:
-                        self.l_line += 1
-                        self.log('%s:%s %s' % (self.l_filename, self.l_line , line))
-                        if len(a) >= 2:
-                            if a[0] == 'sleep':
-                                time.sleep(int(a[1]))
-                            elif a[0] == 'include':
-                                self.execTestFile(a[1])
-            f.close()
+            for line, a in luCompiled(tstFile, self.compileTestFile):
+                if len(a) >= 6:
+                    luCommand(a[1], a[2], a[3], a[4], a[5])
+                else:
+                    self.l_line += 1
+                    self.log('%s:%s %s' % (self.l_filename, self.l_line , line))
+                    if len(a) >= 2:
+                        if a[0] == 'sleep':
+                            time.sleep(int(a[1]))
+                        elif a[0] == 'include':
+                            self.execTestFile(a[1])
         else:
             self.log('unable to read: ' + tstFile)
             sys.exit(1)
@@ -190,7 +243,14 @@ Total %-4d                                                           %-4d %d\n\
             return False
         #self.log("Running %s %s" % (target, command))
         js = None
-        out = self.net[target].cmd(command).rstrip()
+        try:
+            out = node_cmd(self.net[target], command).rstrip()
+        except CommandTimeoutError as error:
+            # Hung command: failed attempt (wait keeps polling)
+            self.log('COMMAND TIMEOUT:%s:' % error)
+            if op == 'pass' or op == 'fail':
+                self.result(target, False, result, 'command timed out')
+            return False
         if len(out) == 0:
             report = "<no output>"
         else:
@@ -203,20 +263,14 @@ Total %-4d                                                           %-4d %d\n\
                     self.log('WARNING: JSON load failed -- confirm command output is in JSON format.')
         self.log('COMMAND OUTPUT:%s:' % report)
 
-	# Experiment: can we achieve the same match behavior via DOTALL
-	# without converting newlines to spaces?
-	out_nl = out
-	search_nl = re.search(regexp, out_nl, re.DOTALL);
-	self.l_last_nl = search_nl
-	# Set up for comparison
-	if search_nl != None:
-	    group_nl = search_nl.group()
-	    group_nl_converted = " ".join(group_nl.splitlines())
-        else:
-	    group_nl_converted = None
+        # The DOTALL search on the original output (see luLast()) is only
+        # done when requested
+        self.l_last_out = out
+        self.l_last_regexp = regexp
+        self.l_last_nl = None
 
         out = " ".join(out.splitlines())
-        search = re.search(regexp, out)
+        search = luRegexp(regexp).search(out)
         self.l_last = search
         if search == None:
             if op == 'fail':
@@ -231,41 +285,160 @@ Total %-4d                                                           %-4d %d\n\
                 success = True
             else:
                 success = False
-	    # Experiment: compare matched strings obtained each way
-	    if self.l_dotall_experiment and (group_nl_converted != ret):
-		self.log('DOTALL experiment: strings differ dotall=[%s] orig=[%s]' % (group_nl_converted, ret))
+	    # Experiment: can we achieve the same match behavior via DOTALL
+	    # without converting newlines to spaces?
+	    if self.l_dotall_experiment:
+		search_nl = self.lastDotall()
+		group_nl_converted = None
+		if search_nl != None:
+		    group_nl_converted = " ".join(search_nl.group().splitlines())
+		if group_nl_converted != ret:
+		    self.log('DOTALL experiment: strings differ dotall=[%s] orig=[%s]' % (group_nl_converted, ret))
         if op == 'pass' or op == 'fail':
             self.result(target, success, result)
         if js != None:
             return js
         return ret
 
-    def wait(self, target, command, regexp, op, result, wait, returnJson):
-        self.log('%s:%s WAIT:%s:%s:%s:%s:%s:%s:' % \
-                 (self.l_filename, self.l_line, target, command, regexp, op, result,wait))
-        llevel = LUtil.l_level
+    def lastDotall(self):
+        # DOTALL search of the last command output (without converting
+        # newlines to spaces)
+        if self.l_last_nl == None and self.l_last_out != None:
+            self.l_last_nl = luRegexp(self.l_last_regexp, re.DOTALL).search(
+                self.l_last_out)
+        return self.l_last_nl
+
+    def match(self, target, command, regexp):
+        # run command and search regexp without logging or saving state
+        # (safe to use from concurrent waits on different targets)
+        try:
+            out = node_cmd(self.net[target], command).rstrip()
+        except CommandTimeoutError:
+            return False
+        search = luRegexp(regexp).search(" ".join(out.splitlines()))
+        if search == None:
+            return False
+        return search.group()
+
+    def waitPoll(self, target, command, regexp, op, result, wait, returnJson,
+                 quiet=False, stable=1):
+        # poll until found (with the same match for stable polls in a row)
+        # or wait secs, returns (found, loops, time); only the first poll
+        # is logged, unless quiet
         found = False
+        same = 0
         n = 0
+        pause = self.l_wait_min
         startt = time.time()
-        delta = time.time() - startt
-        while delta < wait and found is False:
-            found = self.command(target, command, regexp, op, result, returnJson)
+        deadline = startt + wait
+        while True:
+            cache_tick()
+            if quiet or n > 0:
+                last = self.match(target, command, regexp)
+            else:
+                last = self.command(target, command, regexp, op, result, returnJson)
             n+=1
-            LUtil.l_level = 0
-            delta = time.time() - startt
-            if delta < wait and found is False:
-                time.sleep (0.5)
-        LUtil.l_level = llevel
+            if last is False:
+                same = 0
+            elif same > 0 and last == found:
+                same += 1
+            else:
+                same = 1
+            found = last
+            now = time.time()
+            if same >= stable or now >= deadline:
+                break
+            # backoff, the last poll is at the deadline
+            time.sleep(min(pause, deadline - now))
+            pause = min(pause * self.l_wait_backoff, self.l_wait_max)
+        if same < stable:
+            found = False
+        return found, n, now - startt
+
+    def waitLog(self, target, command, regexp, op, result, wait):
+        self.log('%s:%s WAIT:%s:%s:%s:%s:%s:%s:' % \
+                 (self.l_filename, self.l_line, target, command, regexp, op, result,wait))
+
+    def waitDone(self, target, command, regexp, result, returnJson, poll,
+                 stable=1):
+        found, n, delta = poll
         self.log('Done after %d loops, time=%s, Found=%s' % (n, delta, found))
+        if found is False and stable > 1:
+            # may match now, but was not stable
+            found = self.command(target, command, regexp, 'none', result, returnJson)
+            self.result(target, False, '%s +%4.2f secs (not stable for %d polls)' % \
+                        (result, delta, stable))
+            return False
         found = self.command(target, command, regexp, 'pass', '%s +%4.2f secs' % (result, delta), returnJson)
         return found
 
+    def wait(self, target, command, regexp, op, result, wait, returnJson,
+             stable=1):
+        self.waitLog(target, command, regexp, op, result, wait)
+        poll = self.waitPoll(target, command, regexp, op, result, wait,
+                             returnJson, stable=stable)
+        return self.waitDone(target, command, regexp, result, returnJson,
+                             poll, stable)
+
+    def runWaitGroup(self, steps):
+        # poll the waits concurrently: one thread per target, the waits of
+        # a target keep their order
+        targets = {}
+        for idx in range(len(steps)):
+            if steps[idx][3] == 'wait':
+                targets.setdefault(steps[idx][0], []).append(idx)
+        polls = {}
+        errors = {}
+
+        def poller(idxs):
+            for idx in idxs:
+                target, command, regexp, op, result, wait, returnJson, stable = steps[idx]
+                startt = time.time()
+                try:
+                    polls[idx] = self.waitPoll(target, command, regexp, op,
+                                               result, wait, returnJson, True,
+                                               stable)
+                except Exception as error:
+                    # failed poll (e.g. unknown target), reported in order
+                    polls[idx] = (False, 0, time.time() - startt)
+                    errors[idx] = error
+
+        threads = [threading.Thread(target=poller, args=(idxs,))
+                   for idxs in targets.values()]
+        startt = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.log('Wait group: %d steps on %d targets, time=%s' % \
+                 (len(steps), len(targets), time.time() - startt))
+
+        # log and check all steps in their original order
+        for idx in range(len(steps)):
+            target, command, regexp, op, result, wait, returnJson, stable = steps[idx]
+            with tracer.trace('lucommand', target, command) as span:
+                if op == 'wait' and idx in errors:
+                    self.waitLog(target, command, regexp, op, result, wait)
+                    self.l_line += 1
+                    self.result(target, False, '%s +%4.2f secs' % (result, polls[idx][2]),
+                                'WAIT ERROR:%s: %s' % (type(errors[idx]).__name__, errors[idx]))
+                    span.output = False
+                elif op == 'wait':
+                    self.waitLog(target, command, regexp, op, result, wait)
+                    span.output = self.waitDone(target, command, regexp,
+                                                result, returnJson, polls[idx],
+                                                stable)
+                else:
+                    span.output = self.command(target, command, regexp, op,
+                                               result, returnJson)
+
 #initialized by luStart
 LUtil=None
 
 #entry calls
 def luStart(baseScriptDir='.', baseLogDir='.', net='',
-            fout='output.log', fsum='summary.txt', level=9):
+            fout='output.log', fsum='summary.txt', level=9,
+            dotallExperiment=False):
     global LUtil
     #init class
     LUtil=lUtil()
@@ -277,18 +450,41 @@ def luStart(baseScriptDir='.', baseLogDir='.', net='',
     if fsum != None:
         LUtil.fsum_name = baseLogDir + '/' + fsum
     LUtil.l_level = level
-    LUtil.l_dotall_experiment = False
-    LUtil.l_dotall_experiment = True
-
-def luCommand(target, command, regexp='.', op='none', result='', time=10, returnJson=False):
-    if op != 'wait':
-        return LUtil.command(target, command, regexp, op, result, returnJson)
-    else:
-        return LUtil.wait(target, command, regexp, op, result, time, returnJson)
+    LUtil.l_dotall_experiment = dotallExperiment
+
+def luCommand(target, command, regexp='.', op='none', result='', time=10, returnJson=False,
+              stable=1):
+    # a 'wait' for a match stable for (at least) stable polls in a row
+    if LUtil.l_wait_group != None:
+        # run at the end of the group (see luWaitGroup())
+        LUtil.l_wait_group.append((target, command, regexp, op, result, time, returnJson, stable))
+        return None
+    with tracer.trace('lucommand', target, command) as span:
+        if op != 'wait':
+            span.output = LUtil.command(target, command, regexp, op, result, returnJson)
+        else:
+            span.output = LUtil.wait(target, command, regexp, op, result, time, returnJson, stable)
+    return span.output
+
+@contextmanager
+def luWaitGroup():
+    # Waits of the block on different targets run concurrently, e.g.:
+    #   with luWaitGroup():
+    #       luCommand('ce1','vtysh -c "show bgp summary"',' 00:0','wait','Up')
+    #       luCommand('ce2','vtysh -c "show bgp summary"',' 00:0','wait','Up')
+    # All steps of the block are run (and logged in their order) when it
+    # ends, so luCommand() returns None and luLast() is unavailable inside.
+    LUtil.l_wait_group = []
+    try:
+        yield
+    finally:
+        steps = LUtil.l_wait_group
+        LUtil.l_wait_group = None
+    LUtil.runWaitGroup(steps)
 
 def luLast(usenl=False):
     if usenl:
-	if LUtil.l_last_nl != None:
+	if LUtil.lastDotall() != None:
 	    LUtil.log('luLast:%s:' %  LUtil.l_last_nl.group())
 	return LUtil.l_last_nl
     else:
@@ -296,6 +492,10 @@ def luLast(usenl=False):
 	    LUtil.log('luLast:%s:' %  LUtil.l_last.group())
 	return LUtil.l_last
 
+def luLastOutput():
+    # last command output (with its newlines)
+    return LUtil.l_last_out
+
 def luInclude(filename, CallOnFail=None):
     tstFile = LUtil.base_script_dir + '/' + filename
     LUtil.setFilename(filename)
@@ -304,13 +504,23 @@ def luInclude(filename, CallOnFail=None):
         LUtil.setCallOnFail(CallOnFail)
     if filename.endswith('.py'):
         LUtil.log("luInclude: execfile "+tstFile)
-        execfile(tstFile)
+        # compiled once, run like execfile(tstFile)
+        _runScript(luCompiled(tstFile, _compileScript), locals())
     else:
         LUtil.log("luInclude: execTestFile "+tstFile)
         LUtil.execTestFile(tstFile)
     if CallOnFail != None:
         LUtil.setCallOnFail(oldCallOnFail)
 
+def _compileScript(path):
+    f = open(path)
+    source = f.read()
+    f.close()
+    return compile(source, path, 'exec')
+
+def _runScript(code, scope):
+    exec code in globals(), scope
+
 def luFinish():
     global LUtil
     ret = LUtil.closeFiles()
@@ -328,6 +538,7 @@ def luResult(target, success, str, logstr=None):
     return LUtil.result(target, success, str, logstr)
 
 def luShowFail():
+    LUtil.flush()
     printed = 0
     sf = open(LUtil.fsum_name, 'r')
     for line in sf:
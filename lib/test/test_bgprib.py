@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+#
+# test_bgprib.py
+# Tests for the BGP RIB index.
+#
+# Copyright (c) 2018 by
+# Network Device Education Foundation, Inc. ("NetDEF")
+#
+# Permission to use, copy, modify, and/or distribute this software
+# for any purpose with or without fee is hereby granted, provided
+# that the above copyright notice and this permission notice appear
+# in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND NETDEF DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL NETDEF BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY
+# DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE
+# OF THIS SOFTWARE.
+#
+
+"""
+Tests for the BGP RIB index (lib/bgprib.py).
+"""
+
+import os
+import sys
+import json
+
+# Save the Current Working Directory to find lib files.
+CWD = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(CWD, '../../'))
+
+# pylint: disable=C0413
+from lib.bgprib import RibIndex, BgpRib
+from lib import lutil
+
+def _paths(*nexthops):
+    "Returns the JSON paths of a prefix with the `nexthops` addresses."
+    return [{'valid': True, 'nexthops': [{'ip': nh, 'afi': 'ipv4'}]}
+            for nh in nexthops]
+
+def test_vpn_routes():
+    "Test the VPN RIB index and missing routes"
+
+    rib = {'routes': {'routeDistinguishers': {
+        '10:1': {'5.1.0.0/24': _paths('1.1.1.1', '2.2.2.2')},
+        '10:3': {'5.1.0.0/24': _paths('3.3.3.3'),
+                 '5.1.1.0/24': _paths('3.3.3.3')},
+    }}}
+    index = RibIndex.from_vpn(rib)
+    assert index.nexthops('5.1.0.0/24', '10:1') == set(['1.1.1.1', '2.2.2.2'])
+
+    want = [
+        {'rd': '10:1', 'p': '5.1.0.0/24', 'n': '2.2.2.2'},
+        {'rd': '10:3', 'p': '5.1.1.0/24', 'n': '3.3.3.3'},
+    ]
+    assert index.missing(want) == []
+
+    # All misses are reported: wrong RD, nexthop and prefix
+    want = [
+        {'rd': '10:2', 'p': '5.1.0.0/24', 'n': '1.1.1.1'},
+        {'rd': '10:3', 'p': '5.1.0.0/24', 'n': '1.1.1.1'},
+        {'rd': '10:1', 'p': '5.1.0.0/24', 'n': '1.1.1.1'},
+        {'rd': '10:1', 'p': '5.1.2.0/24', 'n': '1.1.1.1'},
+    ]
+    assert index.missing(want) == [want[0], want[1], want[3]]
+
+def test_unicast_routes():
+    "Test the unicast RIB index"
+
+    rib = {'routes': {'99.0.0.1/32': _paths('192.168.1.2')}}
+    index = RibIndex.from_unicast(rib)
+    assert index.missing([{'p': '99.0.0.1/32', 'n': '192.168.1.2'}]) == []
+    want = {'p': '99.0.0.2/32', 'n': '192.168.1.2'}
+    assert index.missing([want]) == [want]
+    assert RibIndex.route_str(want) == 'pfx=99.0.0.2/32 nh=192.168.1.2'
+
+def test_human_dump(tmpdir, monkeypatch):
+    "Test the human readable RIB attached to a failed check"
+
+    outputs = {
+        'vtysh -c "show bgp  ipv4 unicast json"': json.dumps(
+            {'routes': {'99.0.0.1/32': _paths('192.168.1.2')}}),
+        'vtysh -c "show bgp  ipv4 unicast"':
+            'Network          Next Hop\n*> 99.0.0.1/32     192.168.1.2',
+    }
+    monkeypatch.setattr(lutil, 'node_cmd',
+                        lambda node, command, timeout=None: outputs[command])
+    lutil.luStart(baseLogDir=str(tmpdir), net={'r1': None}, level=1)
+    monkeypatch.setattr(BgpRib, 'human_dump', 'fail')
+
+    BgpRib.RequireUnicastRoutes('r1', 'ipv4', '', 'present',
+                                [{'p': '99.0.0.1/32', 'n': '192.168.1.2'}])
+    BgpRib.RequireUnicastRoutes('r1', 'ipv4', '', 'missing',
+                                [{'p': '99.0.0.2/32', 'n': '192.168.1.2'}])
+    lutil.luFinish()
+
+    log = tmpdir.join('output.log').read()
+    # Only the failed check gets the whole dump
+    assert log.count('show bgp  ipv4 unicast:\n') == 1
+    assert ('show bgp  ipv4 unicast:\nNetwork          Next Hop\n'
+            '*> 99.0.0.1/32     192.168.1.2\n') in log
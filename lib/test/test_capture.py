@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+#
+# test_capture.py
+# Tests for the command output captures.
+#
+# Copyright (c) 2018 by
+# Network Device Education Foundation, Inc. ("NetDEF")
+#
+# Permission to use, copy, modify, and/or distribute this software
+# for any purpose with or without fee is hereby granted, provided
+# that the above copyright notice and this permission notice appear
+# in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND NETDEF DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL NETDEF BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY
+# DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE
+# OF THIS SOFTWARE.
+#
+
+
+"""
+Tests for the CapturedOutput class (command outputs captured in files).
+"""
+
+import os
+import sys
+import json
+import pytest
+
+# Save the Current Working Directory to find lib files.
+CWD = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(CWD, '../../'))
+
+# pylint: disable=C0413
+from lib.topotest import CapturedOutput, _JSONReader
+
+BGP_TABLE = {
+    'vrfId': 0,
+    'routerId': '10.0.255.1',
+    'routes': dict([
+        ('10.{}.{}.0/24'.format(i / 256, i % 256),
+         [{'valid': True, 'nexthops': [{'ip': '10.0.1.{}'.format(i % 250)}]}])
+        for i in range(3000)
+    ]),
+    'totalRoutes': 3000,
+}
+
+def capture(tmpdir, text):
+    "Returns a capture with `text` as output."
+    path = tmpdir.join('capture.txt')
+    path.write(text)
+    return CapturedOutput(str(path))
+
+def test_text(tmpdir):
+    "Test the text searches"
+
+    output = capture(tmpdir, 'r1 line1\nr1 line2 up\n')
+    assert output.size == 21
+    assert output.contains('line2')
+    assert not output.contains('line3')
+    assert output.search(r'line\d up') == 'line2 up'
+    assert output.findall(r'line\d') == ['line1', 'line2']
+    assert list(output.lines()) == ['r1 line1', 'r1 line2 up']
+
+    output = capture(tmpdir, '')
+    assert output.search('.') is None
+    assert list(output.lines()) == []
+
+    output.discard()
+    assert not os.path.exists(output.path)
+
+def test_json(tmpdir):
+    "Test the incremental JSON decoding"
+
+    # Pretty printed like vtysh does
+    output = capture(tmpdir, json.dumps(BGP_TABLE, indent=2))
+    assert output.json() == BGP_TABLE
+    assert output.json('totalRoutes') == 3000
+    assert output.json('routes', '10.0.7.0/24') == \
+        BGP_TABLE['routes']['10.0.7.0/24']
+    assert dict(output.json_items('routes')) == BGP_TABLE['routes']
+
+    with pytest.raises(KeyError):
+        output.json('routes', '10.99.0.0/24')
+    with pytest.raises(KeyError):
+        output.json('vrfId', 'foo')
+    assert list(output.json_items('nothere')) == []
+
+    output = capture(tmpdir, ' [1, 2, {"a": {}}] ')
+    assert output.json() == [1, 2, {'a': {}}]
+
+    for text in ['', '{"a": 1', '{"a" 1}', '{"a": 1,}']:
+        with pytest.raises(ValueError):
+            capture(tmpdir, text).json()
+
+def test_json_chunks(tmpdir):
+    "Test the values split between read chunks"
+
+    text = json.dumps(BGP_TABLE)
+    for chunk in [1, 7, 64]:
+        with open(capture(tmpdir, text).path) as fhandle:
+            reader = _JSONReader(fhandle, chunk)
+            sizes = []
+            fill = reader._fill
+
+            def traced_fill(size):
+                "Record the buffer sizes."
+                result = fill(size)
+                sizes.append(len(reader.buf))
+                return result
+
+            reader._fill = traced_fill
+            assert reader.decode() == BGP_TABLE
+            # Only about one member text is buffered at a time
+            assert max(sizes) < 2 * max(chunk, 100)
+
+    # Numbers ending the buffer
+    with open(capture(tmpdir, '{"a": 12345, "b": 678}').path) as fhandle:
+        assert _JSONReader(fhandle, 9).decode() == {'a': 12345, 'b': 678}
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+#
+# test_history.py
+# Tests for library class: TimingHistory.
+#
+# Copyright (c) 2018 by
+# Network Device Education Foundation, Inc. ("NetDEF")
+#
+# Permission to use, copy, modify, and/or distribute this software
+# for any purpose with or without fee is hereby granted, provided
+# that the above copyright notice and this permission notice appear
+# in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND NETDEF DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL NETDEF BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY
+# DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE
+# OF THIS SOFTWARE.
+#
+
+"""
+Tests for the TimingHistory class.
+"""
+
+import os
+import sys
+import pytest
+
+# Save the Current Working Directory to find lib files.
+CWD = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(CWD, '../../'))
+
+# pylint: disable=C0413
+from lib.topohistory import TimingHistory, module_metrics
+
+def make_module(total, check=10.0, version='6.0'):
+    "Returns a timing report module entry."
+    return {
+        'module': 'test_foo.py',
+        'version': version,
+        'setup': total / 2,
+        'topology_build': 1.0,
+        'router_start': 2.0,
+        'tests': {'test_convergence': total / 2},
+        'teardown': 0.5,
+        'convergence': [
+            {'name': 'router_json_cmp', 'duration': check, 'success': True},
+            {'name': 'router_json_cmp', 'duration': 60.0, 'success': False},
+        ],
+        'total': total,
+    }
+
+def test_module_metrics():
+    "Test timing report conversion to metrics"
+
+    metrics = dict(module_metrics(make_module(20.0)))
+    assert metrics['total'] == 20.0
+    assert metrics['test:test_convergence'] == 10.0
+    assert metrics['check:router_json_cmp#1'] == 10.0
+    # Failed checks are not convergence times
+    assert 'check:router_json_cmp#2' not in metrics
+
+def test_no_baseline():
+    "Test that runs without enough history don't report regressions"
+
+    history = TimingHistory(':memory:')
+    history.add_run([make_module(20.0)], revision='abc')
+    run_id = history.add_run([make_module(200.0)], revision='abc')
+    assert history.find_regressions(run_id) == []
+
+def test_regressions():
+    "Test slowdown detection"
+
+    history = TimingHistory(':memory:')
+    for total in [20.0, 21.0, 19.5, 20.5, 20.2, 19.8]:
+        history.add_run([make_module(total)], revision='abc')
+
+    # Noise is not a regression
+    run_id = history.add_run([make_module(21.2)], revision='abc')
+    assert history.find_regressions(run_id) == []
+
+    # Convergence slowdown
+    run_id = history.add_run([make_module(20.0, check=30.0)], revision='abc')
+    metrics = [r.metric for r in history.find_regressions(run_id)]
+    assert metrics == ['check:router_json_cmp#1']
+
+    # Module slowdown
+    run_id = history.add_run([make_module(40.0)], revision='abc')
+    metrics = [r.metric for r in history.find_regressions(run_id)]
+    assert 'total' in metrics
+    assert 'test:test_convergence' in metrics
+
+    # Compare only against another FRR version without history
+    run_id = history.add_run([make_module(40.0, version='7.0')],
+                             revision='abc')
+    assert history.find_regressions(run_id, frr_version='7.0') == []
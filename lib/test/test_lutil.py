@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+#
+# test_lutil.py
+# Tests for the LabN test utilities.
+#
+# Copyright (c) 2018 by
+# Network Device Education Foundation, Inc. ("NetDEF")
+#
+# Permission to use, copy, modify, and/or distribute this software
+# for any purpose with or without fee is hereby granted, provided
+# that the above copyright notice and this permission notice appear
+# in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND NETDEF DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL NETDEF BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY
+# DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE
+# OF THIS SOFTWARE.
+#
+
+
+"""
+Tests for the lutil waits: wait groups, polling and stable matches.
+"""
+
+import os
+import sys
+import time
+import pytest
+
+# Save the Current Working Directory to find lib files.
+CWD = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(CWD, '../../'))
+
+# pylint: disable=C0413
+from lib import lutil
+from lib.lutil import luCommand, luWaitGroup
+
+class FakeNode(object):
+    "Node whose command outputs come from `outputs(node)`."
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, name, outputs):
+        self.name = name
+        self.outputs = outputs
+        self.polls = 0
+
+    def cmd(self, _command):
+        "Returns the next output."
+        self.polls += 1
+        return self.outputs(self)
+
+@pytest.fixture
+def net(tmpdir, monkeypatch):
+    "Starts lutil with the fake nodes to be added to the returned dict."
+    nodes = {}
+    monkeypatch.setattr(lutil, 'node_cmd',
+                        lambda node, command, timeout=None: node.cmd(command))
+    monkeypatch.setattr(lutil.lUtil, 'l_wait_min', 0.01)
+    monkeypatch.setattr(lutil.lUtil, 'l_wait_max', 0.05)
+    lutil.luStart(baseLogDir=str(tmpdir), net=nodes, level=1)
+    yield nodes
+    if lutil.LUtil is not None:
+        lutil.luFinish()
+
+def up_after(delay):
+    "Returns an outputs function that is 'Up' after `delay` seconds."
+    start = time.time()
+    return lambda node: 'Up' if time.time() - start >= delay else 'Down'
+
+def sequence(*outputs):
+    "Returns an outputs function that returns `outputs` (the last repeats)."
+    return lambda node: outputs[min(node.polls, len(outputs)) - 1]
+
+def summary(tmpdir):
+    "Returns the summary result lines (without the header and total)."
+    lutil.luFinish()
+    lines = tmpdir.join('summary.txt').read().splitlines()
+    return [line for line in lines if line[:1].isdigit()]
+
+def test_wait_group(net, tmpdir):
+    "Test the wait group concurrency and results order"
+
+    for name in ['ce1', 'ce2', 'ce3']:
+        net[name] = FakeNode(name, up_after(0.5))
+
+    start = time.time()
+    with luWaitGroup():
+        for name in ['ce3', 'ce1', 'ce2']:
+            assert luCommand(name, 'show', 'Up', 'wait',
+                             '{} up'.format(name), 5) is None
+        luCommand('ce1', 'show', 'Up', 'pass', 'ce1 still up')
+    # The waits run at the same time
+    assert time.time() - start < 1.2
+
+    lines = summary(tmpdir)
+    assert [line.split()[1:3] for line in lines] == [
+        ['ce3', 'ce3'], ['ce1', 'ce1'], ['ce2', 'ce2'], ['ce1', 'ce1']]
+    assert all([line.endswith('1    0') for line in lines])
+
+def test_wait_group_error(net, tmpdir):
+    "Test a wait group poll failure (unknown target)"
+
+    net['ce1'] = FakeNode('ce1', up_after(0))
+    with luWaitGroup():
+        luCommand('ce9', 'show', 'Up', 'wait', 'ce9 up', 1)
+        luCommand('ce1', 'show', 'Up', 'wait', 'ce1 up', 1)
+
+    log = tmpdir.join('output.log').read()
+    assert 'WAIT ERROR:KeyError:' in log
+    lines = summary(tmpdir)
+    assert lines[0].split()[1] == 'ce9' and lines[0].endswith('0    1')
+    assert lines[1].split()[1] == 'ce1' and lines[1].endswith('1    0')
+
+def test_wait_backoff(net):
+    "Test the polls backoff and deadline"
+
+    net['r1'] = FakeNode('r1', sequence('Down'))
+    start = time.time()
+    found, loops, delta = lutil.LUtil.waitPoll(
+        'r1', 'show', 'Up', 'wait', 'up', 0.5, False)
+    assert found is False
+    assert 0.5 <= delta < 0.7 and time.time() - start < 0.7
+    # 0.01, 0.015, 0.0225, ... then 0.05 secs pauses, last poll at deadline
+    assert 10 < loops < 20
+
+def test_wait_stable(net):
+    "Test the stable match criterion reset"
+
+    # The match changes after 2 polls: stable again after 3 more
+    net['r1'] = FakeNode('r1', sequence('routes 1', 'routes 1', 'routes 2'))
+    found, loops, _ = lutil.LUtil.waitPoll(
+        'r1', 'show', r'routes \d', 'wait', 'stable', 5, False, stable=3)
+    assert found == 'routes 2'
+    assert loops == 5
+
+    # A miss resets it too
+    net['r2'] = FakeNode('r2', sequence('up', 'up', 'down', 'up'))
+    found, loops, _ = lutil.LUtil.waitPoll(
+        'r2', 'show', 'up', 'wait', 'stable', 5, False, stable=3)
+    assert (found, loops) == ('up', 6)
+
+def test_wait_not_stable(net, tmpdir):
+    "Test the failure record of a match that is never stable"
+
+    net['r1'] = FakeNode('r1', lambda node: 'routes {}'.format(node.polls % 2))
+    assert luCommand('r1', 'show', r'routes \d', 'wait', 'flapping', 0.3,
+                     stable=2) is False
+    net['r2'] = FakeNode('r2', sequence('routes 1'))
+    assert luCommand('r2', 'show', r'routes \d', 'wait', 'steady', 1,
+                     stable=2) == 'routes 1'
+
+    lines = summary(tmpdir)
+    assert 'flapping' in lines[0] and '(not stable for 2 polls)' in lines[0]
+    assert lines[0].endswith('0    1')
+    assert 'steady' in lines[1] and lines[1].endswith('1    0')
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+#
+# test_topobgp.py
+# Tests for the built-in BGP speaker codec.
+#
+# Copyright (c) 2018 by
+# Network Device Education Foundation, Inc. ("NetDEF")
+#
+# Permission to use, copy, modify, and/or distribute this software
+# for any purpose with or without fee is hereby granted, provided
+# that the above copyright notice and this permission notice appear
+# in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND NETDEF DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL NETDEF BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY
+# DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE
+# OF THIS SOFTWARE.
+#
+
+"""
+Tests for the built-in BGP speaker messages encoding and decoding.
+"""
+
+import os
+import socket
+import struct
+import sys
+import pytest
+
+# Save the Current Working Directory to find lib files.
+CWD = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(CWD, '../../'))
+
+# pylint: disable=C0413
+from lib.topobgp import (MSG_OPEN, MSG_UPDATE, MSG_KEEPALIVE,
+                         MAX_MESSAGE_SIZE, BGPError, BGPSession,
+                         encode_message, decode_messages, encode_open,
+                         decode_open, encode_attributes, encode_update,
+                         decode_update, update_messages)
+from lib.topoexa import prefix_range
+
+def test_open():
+    "Test OPEN messages with 2 and 4-octet AS numbers"
+
+    info = decode_open(encode_open(100, '10.0.1.1', 180))
+    assert info['asn'] == 100
+    assert info['as4'] is True
+    assert info['hold_time'] == 180
+    assert info['router_id'] == '10.0.1.1'
+
+    info = decode_open(encode_open(4200000000, '10.0.1.1', 90))
+    assert info['asn'] == 4200000000
+
+def test_messages():
+    "Test messages framing"
+
+    data = encode_message(MSG_OPEN, 'a' * 10) + encode_message(MSG_UPDATE)
+    messages, rest = decode_messages(data + data[:5])
+    assert messages == [(MSG_OPEN, 'a' * 10), (MSG_UPDATE, '')]
+    assert rest == data[:5]
+
+    with pytest.raises(BGPError):
+        decode_messages('\x00' * 19)
+
+def test_update():
+    "Test UPDATE messages"
+
+    attributes = encode_attributes('10.0.1.101', [99, 200], 'igp', med=100)
+    body = encode_update(['10.9.0.0/20'], attributes,
+                         ['10.201.0.0/24', '10.0.0.0/8', '10.1.2.3/32'])
+    withdrawn, decoded, nlri = decode_update(body)
+    assert withdrawn == ['10.9.0.0/20']
+    assert nlri == ['10.201.0.0/24', '10.0.0.0/8', '10.1.2.3/32']
+    assert decoded == {
+        'origin': 'igp',
+        'as_path': [99, 200],
+        'next_hop': '10.0.1.101',
+        'med': 100,
+    }
+
+    # 2-octet AS numbers
+    attributes = encode_attributes('10.0.1.101', [99], as4=False)
+    _, decoded, _ = decode_update(encode_update(None, attributes,
+                                                ['10.201.0.0/24']), as4=False)
+    assert decoded['as_path'] == [99]
+
+def test_update_packing():
+    "Test prefixes packing in UPDATE messages"
+
+    attributes = encode_attributes('10.0.1.101', [99])
+    messages = update_messages(prefix_range('10.0.0.0/24', 5000), attributes)
+    assert len(messages) == 5
+
+    prefixes = []
+    for message in messages:
+        assert len(message) <= MAX_MESSAGE_SIZE
+        (msgtype, body), = decode_messages(message)[0]
+        assert msgtype == MSG_UPDATE
+        prefixes.extend(decode_update(body)[2])
+    assert prefixes == list(prefix_range('10.0.0.0/24', 5000))
+
+def test_session_as4():
+    "Test routes announced before OPEN use the negotiated AS numbers size"
+
+    session = BGPSession('peer1', None, '10.0.1.101', 99, '10.0.1.1', 100)
+    session.announce(['10.201.0.0/24'])
+
+    # OPEN without the 4-octet AS numbers capability
+    session.handle(MSG_OPEN, struct.pack('!BHH4sB', 4, 100, 180,
+                                         socket.inet_aton('10.0.1.1'), 0), 0)
+    assert session.as4 is False
+    session.outbuf = ''
+    session.handle(MSG_KEEPALIVE, '', 0)
+    assert session.established()
+
+    (msgtype, body), = decode_messages(session.outbuf)[0]
+    assert msgtype == MSG_UPDATE
+    _, decoded, nlri = decode_update(body, as4=False)
+    assert decoded['as_path'] == [99]
+    assert nlri == ['10.201.0.0/24']
+
+def test_session_malformed():
+    "Test a malformed message only closes its session"
+
+    session = BGPSession('peer1', None, '10.0.1.101', 99, '10.0.1.1', 100)
+    session.sock, peer = socket.socketpair()
+    session.state = 'Established'
+    try:
+        peer.send(encode_message(MSG_UPDATE, '\x00'))
+        session.readable(0)
+    finally:
+        peer.close()
+    assert session.state == 'Idle'
+    assert session.sock is None
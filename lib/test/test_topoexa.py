@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+#
+# test_topoexa.py
+# Tests for the ExaBGP API processes.
+#
+# Copyright (c) 2018 by
+# Network Device Education Foundation, Inc. ("NetDEF")
+#
+# Permission to use, copy, modify, and/or distribute this software
+# for any purpose with or without fee is hereby granted, provided
+# that the above copyright notice and this permission notice appear
+# in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND NETDEF DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL NETDEF BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY
+# DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE
+# OF THIS SOFTWARE.
+#
+
+"""
+Tests for the ExaBGP API processes (route injection and update receiver).
+"""
+
+import os
+import sys
+import json
+import threading
+import StringIO
+import pytest
+
+# Save the Current Working Directory to find lib files.
+CWD = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(CWD, '../../'))
+
+# pylint: disable=C0413
+from lib.topoexa import Injector, Receiver, RouteSpec, UpdateIndex
+from lib.topoexa import parse_update, prefix_range
+
+def test_prefix_range():
+    "Test consecutive prefixes generation"
+
+    assert list(prefix_range('10.201.0.0/24', 3)) == [
+        '10.201.0.0/24', '10.201.1.0/24', '10.201.2.0/24']
+    assert list(prefix_range('10.0.255.0/24', 2)) == [
+        '10.0.255.0/24', '10.1.0.0/24']
+    assert list(prefix_range('2001:db8::/64', 2)) == [
+        '2001:db8::/64', '2001:db8:0:1::/64']
+
+    with pytest.raises(ValueError):
+        list(prefix_range('255.255.255.0/24', 2))
+
+def test_route_lines():
+    "Test the ExaBGP API lines"
+
+    spec = RouteSpec('10.201.0.0/24', 3, 'next-hop 10.0.1.101')
+    assert list(spec.lines()) == [
+        ('announce route 10.201.0.0/24 next-hop 10.0.1.101', 1),
+        ('announce route 10.201.1.0/24 next-hop 10.0.1.101', 1),
+        ('announce route 10.201.2.0/24 next-hop 10.0.1.101', 1),
+    ]
+
+    spec = RouteSpec('10.201.0.0/24', 3, 'next-hop 10.0.1.101', 'withdraw')
+    assert list(spec.lines(pack=2)) == [
+        ('withdraw attributes next-hop 10.0.1.101 nlri '
+         '10.201.0.0/24 10.201.1.0/24', 2),
+        ('withdraw attributes next-hop 10.0.1.101 nlri 10.201.2.0/24', 1),
+    ]
+
+def test_injector(tmpdir):
+    "Test the injection output and progress report"
+
+    progress = str(tmpdir.join('inject.progress'))
+    specs = [RouteSpec('10.201.0.0/24', 5), RouteSpec('10.202.0.0/24', 5)]
+    output = StringIO.StringIO()
+    injector = Injector(specs, batch=4, progress=progress)
+    injector.run(output)
+
+    assert len(output.getvalue().splitlines()) == 10
+    with open(progress) as fhandle:
+        report = json.load(fhandle)
+    assert report['sent'] == report['total'] == 10
+    assert report['done'] is True
+
+def test_parse_update():
+    "Test the ExaBGP text and JSON encoder updates parsing"
+
+    assert parse_update('neighbor 10.0.1.1 announced route 10.201.0.0/24 '
+                        'next-hop 10.0.1.1 origin igp') == [
+                            ('A', '10.201.0.0/24')]
+    assert parse_update('neighbor 10.0.1.1 withdrawn route '
+                        '10.201.0.0/24') == [('W', '10.201.0.0/24')]
+    assert parse_update('neighbor 10.0.1.1 up') == []
+
+    update = {'neighbor': {'message': {'update': {
+        'announce': {'ipv4 unicast': {'10.0.1.1': {'10.201.0.0/24': {}}}},
+        'withdraw': {'ipv4 unicast': {'10.202.0.0/24': {}}},
+    }}}}
+    assert parse_update(json.dumps(update)) == [
+        ('W', '10.202.0.0/24'), ('A', '10.201.0.0/24')]
+
+def test_receiver(tmpdir):
+    "Test the update log and its index"
+
+    path = str(tmpdir.join('received.log'))
+    rfd, wfd = os.pipe()
+    receiver = Receiver(path, interval=0.1)
+    thread = threading.Thread(target=receiver.run,
+                              args=(os.fdopen(rfd),))
+    thread.start()
+
+    index = UpdateIndex(path)
+    os.write(wfd, 'neighbor 10.0.1.1 announced route 10.201.0.0/24\n'
+                  'neighbor 10.0.1.1 announced route 10.201.1.0/24\n')
+    os.write(wfd, 'neighbor 10.0.1.1 withdrawn route 10.201.0.0/24\n')
+    # Last update without line ending
+    os.write(wfd, 'neighbor 10.0.1.1 announced route 10.201.3.0/24')
+    os.close(wfd)
+    thread.join()
+
+    assert index.update() == 4
+    assert index.get('10.201.0.0/24')[0] == 'W'
+    assert index.announced() == ['10.201.1.0/24', '10.201.3.0/24']
+    assert index.get('10.201.2.0/24') is None
+    assert index.update() == 0
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+#
+# test_toporunner.py
+# Tests for the parallel topology test runner.
+#
+# Copyright (c) 2018 by
+# Network Device Education Foundation, Inc. ("NetDEF")
+#
+# Permission to use, copy, modify, and/or distribute this software
+# for any purpose with or without fee is hereby granted, provided
+# that the above copyright notice and this permission notice appear
+# in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND NETDEF DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL NETDEF BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY
+# DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE
+# OF THIS SOFTWARE.
+#
+
+
+"""
+Tests for the parallel runner modules sizing and scheduling.
+"""
+
+import os
+import sys
+
+# Save the Current Working Directory to find lib files.
+CWD = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(CWD, '../../'))
+
+# pylint: disable=C0413
+from lib import toporunner
+from lib.toporunner import Runner, count_nodes
+from lib.toporunner import estimate_duration, schedule
+
+TEST_CODE = '''
+def build():
+    tgen.add_router('r1')
+    tgen.add_router('r2')
+    peers = tgen.get_scale('test_peers', 10, nodes=True)
+    routes = tgen.get_scale('test_routes', 100)
+    sleep(5)
+    # sleep(100)
+    topotest.sleep(2.5)
+'''
+
+def make_module(tmpdir, name, nodes=0, code='', exclusive=False):
+    "Creates the test directory `name`, returns its TestModule."
+    path = tmpdir.mkdir(name)
+    for num in range(nodes):
+        path.mkdir('r{}'.format(num + 1))
+    if exclusive:
+        code += '\nos.system("mn -c")\n'
+    path.join('test_{}.py'.format(name)).write(code)
+    return toporunner.TestModule(name, str(path))
+
+def test_count_nodes(tmpdir, monkeypatch):
+    "Test the nodes count from directories, code and scale parameters"
+
+    monkeypatch.delenv('TOPOTESTS_TEST_PEERS', raising=False)
+    module = make_module(tmpdir, 'm1', 3, TEST_CODE)
+    # r1-r3 directories (r1 and r2 also in the code) and 10 peers
+    assert count_nodes(module.path) == 13
+    assert count_nodes(module.path, {'test_peers': 100}) == 103
+    assert count_nodes(module.path, {'test_routes': 1000}) == 13
+
+    monkeypatch.setenv('TOPOTESTS_TEST_PEERS', '50')
+    assert count_nodes(module.path) == 53
+
+def test_estimate_duration(tmpdir):
+    "Test the static duration estimate"
+
+    module = make_module(tmpdir, 'm1', 2, TEST_CODE)
+    assert estimate_duration(module.path, 4) == (
+        toporunner.MODULE_BASE_COST + 4 * toporunner.NODE_COST + 7.5)
+
+def test_schedule(tmpdir):
+    "Test the modules start order"
+
+    small = make_module(tmpdir, 'small', 1)
+    big = make_module(tmpdir, 'big', 5)
+    alone = make_module(tmpdir, 'alone', 1, exclusive=True)
+    recorded = make_module(tmpdir, 'recorded', 1)
+    scaled = toporunner.TestModule('big[x=1]', big.path, {'x': 1})
+
+    modules = schedule([small, big, alone, recorded, scaled],
+                       {'recorded': 1000.0, 'big': 0.1})
+    assert modules == [alone, recorded, scaled, small, big]
+    assert recorded.cost_source == 'history'
+    # The recorded durations don't apply to other scales
+    assert scaled.cost_source == 'estimate'
+
+def test_pick(tmpdir):
+    "Test the node budget: no module starts ahead of the blocked first one"
+
+    first = make_module(tmpdir, 'first', 6)
+    second = make_module(tmpdir, 'second', 4)
+    third = make_module(tmpdir, 'third', 1)
+    runner = Runner([first, second, third], 4, str(tmpdir), max_nodes=8)
+
+    assert runner.pick() is first
+    runner.pending.remove(first)
+    runner.running.append(first)
+    # second doesn't fit and third must wait for it
+    assert runner.pick() is None
+
+    runner.running.remove(first)
+    assert runner.pick() is second
+
+    # A module bigger than the budget runs alone
+    huge = make_module(tmpdir, 'huge', 10)
+    runner = Runner([huge, third], 4, str(tmpdir), max_nodes=8)
+    assert runner.pick() is huge
+    runner.pending.remove(huge)
+    runner.running.append(huge)
+    assert runner.pick() is None
+
+    # Exclusive modules wait for the others and run alone
+    alone = make_module(tmpdir, 'alone', 1, exclusive=True)
+    runner = Runner([alone, third], 4, str(tmpdir))
+    runner.running.append(second)
+    assert runner.pick() is None
+    runner.running.remove(second)
+    assert runner.pick() is alone
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+#
+# test_topotrace.py
+# Tests for the command tracing utilities.
+#
+# Copyright (c) 2018 by
+# Network Device Education Foundation, Inc. ("NetDEF")
+#
+# Permission to use, copy, modify, and/or distribute this software
+# for any purpose with or without fee is hereby granted, provided
+# that the above copyright notice and this permission notice appear
+# in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND NETDEF DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL NETDEF BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY
+# DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE
+# OF THIS SOFTWARE.
+#
+
+
+"""
+Tests for the command tracer spans.
+"""
+
+import os
+import sys
+import time
+import threading
+
+# Save the Current Working Directory to find lib files.
+CWD = os.path.dirname(os.path.realpath(__file__))
+sys.path.append(os.path.join(CWD, '../../'))
+
+# pylint: disable=C0413
+from lib.topotrace import CommandTracer
+
+def test_concurrent_spans(tmpdir):
+    "Test the spans of concurrent commands, traced or not"
+
+    tracer = CommandTracer()
+    errors = []
+
+    def command(node):
+        "Traces a command and checks its span output."
+        for _ in range(20):
+            with tracer.trace('run', node, 'show') as span:
+                # Nested spans aren't traced
+                with tracer.trace('cmd', node, 'show') as nested:
+                    nested.output = node
+                span.output = node
+                time.sleep(0.001)
+            if span.output != node or nested.output != node:
+                errors.append(node)
+
+    for enabled in [False, True]:
+        if enabled:
+            tracer.start('test', str(tmpdir.join('trace.json')))
+        threads = [threading.Thread(target=command, args=('r{}'.format(i),))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert errors == []
+    assert len(tracer.events) == 80
+    assert set([event['kind'] for event in tracer.events]) == set(['run'])
+    tracer.stop()
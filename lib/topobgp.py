@@ -0,0 +1,665 @@
+#
+# topobgp.py
+# Library of helper functions for NetDEF Topology Tests
+#
+# Copyright (c) 2018 by
+# Network Device Education Foundation, Inc. ("NetDEF")
+#
+# Permission to use, copy, modify, and/or distribute this software
+# for any purpose with or without fee is hereby granted, provided
+# that the above copyright notice and this permission notice appear
+# in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND NETDEF DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL NETDEF BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY
+# DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE
+# OF THIS SOFTWARE.
+#
+
+"""
+Built-in BGP speaker.
+
+Lightweight ExaBGP replacement for the peers that only announce routes and
+record the received updates (see `Topogen.add_bgp_speaker()`). All the
+sessions are served by a single thread of the test process with a
+`select()` loop: every session socket is created inside its peer network
+namespace (`setns()`), so the peers are plain hosts without any daemon.
+
+The speaker opens the sessions (it does not listen), supports IPv4 unicast
+only and the 4-octet AS numbers capability. Usage example:
+```py
+speaker = BGPSpeaker()
+speaker.start()
+session = BGPSession('peer1', peer_pid, '10.0.1.101', 99,
+                     '10.0.1.1', 100)
+speaker.add(session)
+session.announce(prefix_range('10.201.0.0/24', 1000), '10.0.1.101')
+```
+"""
+
+import ctypes
+import errno
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+from lib.topoexa import ANNOUNCED, WITHDRAWN
+from lib.topolog import logger
+
+BGP_PORT = 179
+BGP_VERSION = 4
+
+# Message types
+MSG_OPEN = 1
+MSG_UPDATE = 2
+MSG_NOTIFICATION = 3
+MSG_KEEPALIVE = 4
+
+MARKER = '\xff' * 16
+HEADER_SIZE = 19
+MAX_MESSAGE_SIZE = 4096
+
+# Path attributes flags and types
+FLAG_OPTIONAL = 0x80
+FLAG_TRANSITIVE = 0x40
+FLAG_EXTENDED = 0x10
+ATTR_ORIGIN = 1
+ATTR_AS_PATH = 2
+ATTR_NEXT_HOP = 3
+ATTR_MED = 4
+ATTR_LOCAL_PREF = 5
+
+AS_SEQUENCE = 2
+AS_TRANS = 23456
+ORIGINS = ['igp', 'egp', 'incomplete']
+
+# OPEN optional parameter and capabilities
+PARAM_CAPABILITY = 2
+CAP_MULTIPROTOCOL = 1
+CAP_AS4 = 65
+
+# Linux setns() network namespace type
+CLONE_NEWNET = 0x40000000
+
+class BGPError(Exception):
+    "Malformed or unexpected BGP message."
+    pass
+
+#
+# Codec
+#
+
+def encode_message(msgtype, body=''):
+    "Returns the BGP message of type `msgtype` with `body`."
+    return MARKER + struct.pack('!HB', HEADER_SIZE + len(body), msgtype) + body
+
+def decode_messages(data):
+    """
+    Returns the list of complete (type, body) messages in `data` and the
+    remaining bytes.
+    """
+    messages = []
+    while len(data) >= HEADER_SIZE:
+        if data[:16] != MARKER:
+            raise BGPError('invalid message marker')
+        length, msgtype = struct.unpack('!HB', data[16:HEADER_SIZE])
+        if length < HEADER_SIZE or length > MAX_MESSAGE_SIZE:
+            raise BGPError('invalid message length {}'.format(length))
+        if len(data) < length:
+            break
+        messages.append((msgtype, data[HEADER_SIZE:length]))
+        data = data[length:]
+    return messages, data
+
+def encode_open(asn, router_id, hold_time):
+    "Returns the OPEN message body (IPv4 unicast and 4-octet AS numbers)."
+    capabilities = [
+        struct.pack('!BBHBB', CAP_MULTIPROTOCOL, 4, 1, 0, 1),
+        struct.pack('!BBI', CAP_AS4, 4, asn),
+    ]
+    params = ''.join([struct.pack('!BB', PARAM_CAPABILITY, len(cap)) + cap
+                      for cap in capabilities])
+    return struct.pack('!BHH4sB', BGP_VERSION, asn if asn < 65536 else AS_TRANS,
+                       hold_time, socket.inet_aton(router_id),
+                       len(params)) + params
+
+def decode_open(body):
+    """
+    Returns the OPEN message body dictionary: `version`, `asn` (the
+    4-octet AS number when advertised), `hold_time`, `router_id` and `as4`.
+    """
+    if len(body) < 10:
+        raise BGPError('OPEN message too short')
+    version, asn, hold_time, router_id, plen = struct.unpack(
+        '!BHH4sB', body[:10])
+    result = {
+        'version': version,
+        'asn': asn,
+        'hold_time': hold_time,
+        'router_id': socket.inet_ntoa(router_id),
+        'as4': False,
+    }
+
+    params = body[10:10 + plen]
+    while len(params) >= 2:
+        ptype, length = struct.unpack('!BB', params[:2])
+        value, params = params[2:2 + length], params[2 + length:]
+        if ptype != PARAM_CAPABILITY:
+            continue
+        while len(value) >= 2:
+            code, clen = struct.unpack('!BB', value[:2])
+            if code == CAP_AS4 and clen == 4:
+                result['asn'] = struct.unpack('!I', value[2:6])[0]
+                result['as4'] = True
+            value = value[2 + clen:]
+    return result
+
+def encode_prefix(prefix):
+    "Returns the NLRI encoding of the IPv4 `prefix` (e.g. '10.0.0.0/24')."
+    address, length = prefix.split('/')
+    length = int(length)
+    return chr(length) + socket.inet_aton(address)[:(length + 7) // 8]
+
+def decode_prefixes(data):
+    "Returns the list of IPv4 prefixes of the NLRI encoded `data`."
+    prefixes = []
+    while data:
+        length = ord(data[0])
+        size = (length + 7) // 8
+        if length > 32 or len(data) < 1 + size:
+            raise BGPError('invalid prefix encoding')
+        address = socket.inet_ntoa(data[1:1 + size].ljust(4, '\x00'))
+        prefixes.append('{}/{}'.format(address, length))
+        data = data[1 + size:]
+    return prefixes
+
+def _encode_attribute(flags, code, value):
+    "Returns a path attribute encoding."
+    if len(value) > 255:
+        return struct.pack('!BBH', flags | FLAG_EXTENDED, code,
+                           len(value)) + value
+    return struct.pack('!BBB', flags, code, len(value)) + value
+
+def encode_attributes(next_hop, as_path=None, origin='igp', med=None,
+                      local_pref=None, as4=True):
+    """
+    Returns the path attributes encoding. `as_path` is a list of AS numbers,
+    `as4` selects the 4-octet AS numbers encoding.
+    """
+    as_path = as_path or []
+    asfmt = '!I' if as4 else '!H'
+    segment = ''
+    if as_path:
+        segment = struct.pack('!BB', AS_SEQUENCE, len(as_path)) + ''.join(
+            [struct.pack(asfmt, asn) for asn in as_path])
+
+    attributes = [
+        _encode_attribute(FLAG_TRANSITIVE, ATTR_ORIGIN,
+                          chr(ORIGINS.index(origin))),
+        _encode_attribute(FLAG_TRANSITIVE, ATTR_AS_PATH, segment),
+        _encode_attribute(FLAG_TRANSITIVE, ATTR_NEXT_HOP,
+                          socket.inet_aton(next_hop)),
+    ]
+    if med is not None:
+        attributes.append(_encode_attribute(FLAG_OPTIONAL, ATTR_MED,
+                                            struct.pack('!I', med)))
+    if local_pref is not None:
+        attributes.append(_encode_attribute(FLAG_TRANSITIVE, ATTR_LOCAL_PREF,
+                                            struct.pack('!I', local_pref)))
+    return ''.join(attributes)
+
+def decode_attributes(data, as4=True):
+    """
+    Returns the dictionary of the known path attributes: `origin`,
+    `as_path` (list of AS numbers), `next_hop`, `med` and `local_pref`.
+    """
+    result = {}
+    while data:
+        if len(data) < 3:
+            raise BGPError('invalid path attribute')
+        flags, code = struct.unpack('!BB', data[:2])
+        if flags & FLAG_EXTENDED:
+            length = struct.unpack('!H', data[2:4])[0]
+            value, data = data[4:4 + length], data[4 + length:]
+        else:
+            length = ord(data[2])
+            value, data = data[3:3 + length], data[3 + length:]
+
+        if code == ATTR_ORIGIN:
+            result['origin'] = ORIGINS[ord(value)]
+        elif code == ATTR_AS_PATH:
+            size = 4 if as4 else 2
+            path = []
+            while len(value) >= 2:
+                count = ord(value[1])
+                path.extend(struct.unpack(
+                    '!{}{}'.format(count, 'I' if as4 else 'H'),
+                    value[2:2 + count * size]))
+                value = value[2 + count * size:]
+            result['as_path'] = path
+        elif code == ATTR_NEXT_HOP:
+            result['next_hop'] = socket.inet_ntoa(value)
+        elif code == ATTR_MED:
+            result['med'] = struct.unpack('!I', value)[0]
+        elif code == ATTR_LOCAL_PREF:
+            result['local_pref'] = struct.unpack('!I', value)[0]
+    return result
+
+def encode_update(withdrawn=None, attributes='', nlri=None):
+    "Returns the UPDATE message body."
+    withdrawn = ''.join([encode_prefix(prefix) for prefix in withdrawn or []])
+    nlri = ''.join([encode_prefix(prefix) for prefix in nlri or []])
+    if not nlri:
+        attributes = ''
+    return (struct.pack('!H', len(withdrawn)) + withdrawn +
+            struct.pack('!H', len(attributes)) + attributes + nlri)
+
+def decode_update(body, as4=True):
+    """
+    Returns the UPDATE message body withdrawn prefixes, path attributes
+    dictionary (see `decode_attributes()`) and announced prefixes.
+    """
+    wlen = struct.unpack('!H', body[:2])[0]
+    withdrawn = decode_prefixes(body[2:2 + wlen])
+    body = body[2 + wlen:]
+    alen = struct.unpack('!H', body[:2])[0]
+    attributes = decode_attributes(body[2:2 + alen], as4)
+    nlri = decode_prefixes(body[2 + alen:])
+    return withdrawn, attributes, nlri
+
+def update_messages(prefixes, attributes=None):
+    """
+    Returns the UPDATE messages announcing `prefixes` with the encoded
+    `attributes`, or withdrawing them when `attributes` is `None`. Prefixes
+    are packed in as few messages as possible.
+    """
+    room = MAX_MESSAGE_SIZE - HEADER_SIZE - 4 - len(attributes or '')
+    messages = []
+    chunk = []
+    size = 0
+    for prefix in prefixes:
+        encoded = encode_prefix(prefix)
+        if size + len(encoded) > room:
+            messages.append(_update_message(chunk, attributes))
+            chunk = []
+            size = 0
+        chunk.append(prefix)
+        size += len(encoded)
+    if chunk:
+        messages.append(_update_message(chunk, attributes))
+    return messages
+
+def _update_message(prefixes, attributes):
+    "Returns an UPDATE message for `update_messages()`."
+    if attributes is None:
+        return encode_message(MSG_UPDATE, encode_update(withdrawn=prefixes))
+    return encode_message(MSG_UPDATE, encode_update(
+        attributes=attributes, nlri=prefixes))
+
+#
+# Sessions
+#
+
+_libc = None
+
+def _setns(fdesc):
+    "Moves the calling thread to the network namespace `fdesc`."
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL('libc.so.6', use_errno=True)
+    if _libc.setns(fdesc, CLONE_NEWNET) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+
+def netns_socket(pid):
+    """
+    Returns a TCP socket of the network namespace of the process `pid` (the
+    current one when `pid` is `None`).
+    """
+    if pid is None:
+        return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    with open('/proc/thread-self/ns/net') as own:
+        with open('/proc/{}/ns/net'.format(pid)) as target:
+            _setns(target.fileno())
+        try:
+            return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        finally:
+            _setns(own.fileno())
+
+class BGPSession(object):
+    """
+    BGP session from `local_address` (in the network namespace of the
+    process `pid`) to `peer_address`. The announced routes are sent again
+    when the session is established again.
+    """
+
+    def __init__(self, name, pid, local_address, local_as, peer_address,
+                 peer_as, router_id=None, hold_time=180, connect_retry=2):
+        self.name = name
+        self.pid = pid
+        self.local_address = local_address
+        self.local_as = local_as
+        self.peer_address = peer_address
+        self.peer_as = peer_as
+        self.router_id = router_id or local_address
+        self.hold_time = hold_time
+        self.connect_retry = connect_retry
+
+        self.state = 'Idle'
+        self.sock = None
+        self.inbuf = ''
+        self.outbuf = ''
+        self.as4 = True
+        self.negotiated_hold = hold_time
+        self.next_connect = 0
+        self.last_received = 0
+        self.last_sent = 0
+        # Announced (and withdrawn) routes in order: (prefixes, attributes
+        # parameters or None), encoded when sent as AS_PATH depends on as4
+        self.adj_out = []
+        self.lock = threading.Lock()
+        # Received routes: prefix -> (last action, timestamp)
+        self.routes = {}
+        self.attributes = {}
+        self.updates = 0
+
+    def __str__(self):
+        return '{} {} -> {} ({})'.format(self.name, self.local_address,
+                                         self.peer_address, self.state)
+
+    def established(self):
+        "Returns whether the session is established."
+        return self.state == 'Established'
+
+    def announce(self, prefixes, next_hop=None, as_path=None, origin='igp',
+                 med=None, local_pref=None):
+        """
+        Announces `prefixes` with the path attributes (`as_path` is a list
+        of AS numbers, the local AS is prepended). Can be called from any
+        thread, before or after the session is established.
+        """
+        path = [self.local_as] + list(as_path or [])
+        self._queue(list(prefixes), (next_hop or self.local_address, path,
+                                     origin, med, local_pref))
+
+    def withdraw(self, prefixes):
+        "Withdraws `prefixes`. Can be called from any thread."
+        self._queue(list(prefixes), None)
+
+    def _queue(self, prefixes, params):
+        "Records and sends (when established) an announce or a withdraw."
+        with self.lock:
+            self.adj_out.append((prefixes, params))
+            if self.established():
+                self.outbuf += self._encode(prefixes, params)
+
+    def _encode(self, prefixes, params):
+        """
+        Returns the UPDATE messages for `prefixes` with the attributes
+        `params`, encoded with the negotiated AS number size.
+        """
+        attributes = None
+        if params is not None:
+            attributes = encode_attributes(*params, as4=self.as4)
+        return ''.join(update_messages(prefixes, attributes))
+
+    def get(self, prefix):
+        "Returns the (action, timestamp) of the last `prefix` update or `None`."
+        return self.routes.get(prefix)
+
+    def announced(self):
+        "Returns the prefixes currently announced by the peer."
+        return [prefix for prefix, (action, _) in self.routes.items()
+                if action == ANNOUNCED]
+
+    #
+    # Speaker thread functions
+    #
+
+    def connect(self, now):
+        "Starts the connection to the peer."
+        self.next_connect = now + self.connect_retry
+        try:
+            self.sock = netns_socket(self.pid)
+            self.sock.setblocking(0)
+            self.sock.bind((self.local_address, 0))
+            error = self.sock.connect_ex((self.peer_address, BGP_PORT))
+        except (OSError, socket.error) as exc:
+            logger.debug('{}: connect failed: {}'.format(self.name, exc))
+            self.close()
+            return
+        if error not in [0, errno.EINPROGRESS]:
+            self.close()
+            return
+        self.state = 'Connect'
+
+    def close(self, reason=None):
+        "Closes the connection, the next one is opened after connect_retry."
+        if reason is not None and self.state != 'Idle':
+            logger.info('{}: session closed: {}'.format(self.name, reason))
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.state = 'Idle'
+        self.inbuf = ''
+        with self.lock:
+            self.outbuf = ''
+
+    def send(self, msgtype, body=''):
+        "Queues a message."
+        with self.lock:
+            self.outbuf += encode_message(msgtype, body)
+
+    def tick(self, now):
+        "Handles the session timers."
+        if self.state == 'Idle':
+            if now >= self.next_connect:
+                self.connect(now)
+            return
+        if self.state == 'Connect':
+            if now >= self.next_connect:
+                self.close('connection timeout')
+            return
+
+        hold = self.negotiated_hold
+        if self.state == 'OpenSent':
+            # The peer OPEN must arrive before the hold time
+            hold = hold and max(hold, 240)
+        if hold and now - self.last_received > hold:
+            self.send(MSG_NOTIFICATION, struct.pack('!BB', 4, 0))
+            self.flush()
+            self.close('hold timer expired')
+        elif (hold and self.state != 'OpenSent' and
+              now - self.last_sent > hold / 3.0):
+            self.send(MSG_KEEPALIVE)
+
+    def wants_write(self):
+        "Returns whether the socket must be checked for writing."
+        return self.state == 'Connect' or bool(self.outbuf)
+
+    def writable(self, now):
+        "Handles the socket being writable."
+        if self.state == 'Connect':
+            error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error != 0:
+                self.close()
+                return
+            self.state = 'OpenSent'
+            self.last_received = now
+            self.negotiated_hold = self.hold_time
+            self.send(MSG_OPEN, encode_open(self.local_as, self.router_id,
+                                            self.hold_time))
+        self.flush()
+
+    def flush(self):
+        "Sends as much of the queued messages as possible."
+        with self.lock:
+            if not self.outbuf or self.sock is None:
+                return
+            try:
+                sent = self.sock.send(self.outbuf)
+            except socket.error as exc:
+                if exc.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    return
+                self.outbuf = ''
+                sent = None
+            else:
+                self.outbuf = self.outbuf[sent:]
+                self.last_sent = time.time()
+        if sent is None:
+            self.close('send failed')
+
+    def readable(self, now):
+        "Handles the socket being readable."
+        try:
+            data = self.sock.recv(65536)
+        except socket.error as exc:
+            self.close('receive failed: {}'.format(exc))
+            return
+        if not data:
+            self.close('connection closed by peer')
+            return
+
+        self.last_received = now
+        try:
+            messages, self.inbuf = decode_messages(self.inbuf + data)
+            for msgtype, body in messages:
+                self.handle(msgtype, body, now)
+                if self.sock is None:
+                    return
+        except (BGPError, struct.error, IndexError, ValueError) as exc:
+            self.close('malformed message: {}'.format(exc))
+
+    def handle(self, msgtype, body, now):
+        "Handles a received message."
+        if msgtype == MSG_OPEN:
+            info = decode_open(body)
+            if info['asn'] != self.peer_as:
+                self.send(MSG_NOTIFICATION, struct.pack('!BB', 2, 2))
+                self.flush()
+                self.close('bad peer AS {}'.format(info['asn']))
+                return
+            self.as4 = info['as4']
+            self.negotiated_hold = min(self.hold_time, info['hold_time'])
+            self.state = 'OpenConfirm'
+            self.send(MSG_KEEPALIVE)
+        elif msgtype == MSG_KEEPALIVE:
+            if self.state == 'OpenConfirm':
+                self.state = 'Established'
+                logger.info('{}: session established'.format(self.name))
+                with self.lock:
+                    self.outbuf += ''.join(self._encode(prefixes, params)
+                                           for prefixes, params in self.adj_out)
+        elif msgtype == MSG_UPDATE:
+            withdrawn, attributes, nlri = decode_update(body, self.as4)
+            self.updates += 1
+            for prefix in withdrawn:
+                self.routes[prefix] = (WITHDRAWN, now)
+                self.attributes.pop(prefix, None)
+            for prefix in nlri:
+                self.routes[prefix] = (ANNOUNCED, now)
+                self.attributes[prefix] = attributes
+        elif msgtype == MSG_NOTIFICATION:
+            code, subcode = struct.unpack('!BB', body[:2])
+            self.close('notification {}/{}'.format(code, subcode))
+
+class BGPSpeaker(object):
+    "Serves BGP sessions from a single thread."
+
+    def __init__(self):
+        self.sessions = []
+        self.lock = threading.Lock()
+        self.added = []
+        self.removed = []
+        self.thread = None
+        self.running = False
+        self.wakeup = None
+
+    def start(self):
+        "Starts the speaker thread."
+        self.running = True
+        self.wakeup = os.pipe()
+        self.thread = threading.Thread(target=self._run, name='bgp-speaker')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        "Closes all sessions and stops the speaker thread."
+        self.running = False
+        self._wake()
+        self.thread.join()
+        for fdesc in self.wakeup:
+            os.close(fdesc)
+
+    def add(self, session):
+        "Starts serving `session`."
+        with self.lock:
+            self.added.append(session)
+        self._wake()
+
+    def remove(self, session):
+        "Closes `session`."
+        with self.lock:
+            self.removed.append(session)
+        self._wake()
+
+    def _wake(self):
+        "Interrupts the speaker thread select()."
+        os.write(self.wakeup[1], '.')
+
+    def _run(self):
+        "Speaker thread main loop."
+        while self.running:
+            with self.lock:
+                self.sessions.extend(self.added)
+                for session in self.removed:
+                    if session in self.sessions:
+                        self.sessions.remove(session)
+                    session.close()
+                self.added, self.removed = [], []
+
+            now = time.time()
+            for session in self.sessions:
+                self._call(session, session.tick, now)
+
+            sockets = dict([(session.sock, session)
+                            for session in self.sessions
+                            if session.sock is not None])
+            wlist = [sock for sock, session in sockets.iteritems()
+                     if session.wants_write()]
+            readable, writable, _ = select.select(
+                [self.wakeup[0]] + sockets.keys(), wlist, [], 0.5)
+
+            now = time.time()
+            for sock in writable:
+                if sock in sockets and sockets[sock].sock is sock:
+                    self._call(sockets[sock], sockets[sock].writable, now)
+            for sock in readable:
+                if sock == self.wakeup[0]:
+                    os.read(self.wakeup[0], 4096)
+                elif sockets[sock].sock is sock:
+                    self._call(sockets[sock], sockets[sock].readable, now)
+
+        for session in self.sessions:
+            session.close()
+        self.sessions = []
+
+    @staticmethod
+    def _call(session, function, now):
+        """
+        Calls a `session` speaker thread function, an unexpected error only
+        closes that session instead of stopping the thread.
+        """
+        try:
+            function(now)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.exception('{}: unexpected error'.format(session.name))
+            session.close('unexpected error: {}'.format(exc))
@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+
+#
+# topoexa.py
+# Library of helper functions for NetDEF Topology Tests
+#
+# Copyright (c) 2018 by
+# Network Device Education Foundation, Inc. ("NetDEF")
+#
+# Permission to use, copy, modify, and/or distribute this software
+# for any purpose with or without fee is hereby granted, provided
+# that the above copyright notice and this permission notice appear
+# in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND NETDEF DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL NETDEF BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY
+# DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE
+# OF THIS SOFTWARE.
+#
+
+"""
+ExaBGP API processes.
+
+This file is copied to the ExaBGP peers `/etc/exabgp` (see
+`TopoExaBGP.stage()`) and run by ExaBGP as an API process, so it must only
+depend on the standard library.
+
+Route injection: announces/withdraws the routes described by an injection
+file (see `TopoExaBGP.write_injection()`), in batches, optionally rate
+limited, reporting its progress in a file. ExaBGP configuration example:
+```
+process announce-routes {
+    run "/etc/exabgp/topoexa.py inject /etc/exabgp/inject.json";
+}
+```
+
+Injection file example (JSON):
+```
+{
+  "rate": 10000,
+  "batch": 1000,
+  "pack": 100,
+  "specs": [
+    {"prefix": "10.201.0.0/24", "count": 1000000,
+     "attributes": "med 100 next-hop 10.0.1.101 origin igp"}
+  ]
+}
+```
+
+Update receiver: records the prefixes announced/withdrawn by the ExaBGP
+neighbors in a compact append-only log ("<timestamp> <A|W> <prefix>"
+lines) written in buffered blocks, see `UpdateIndex` to query it (and
+`TopoExaBGP.has_received()`). ExaBGP configuration example:
+```
+process receive-routes {
+    run "/etc/exabgp/topoexa.py receive /etc/exabgp/received.log";
+    receive-routes;
+    encoder text;
+}
+```
+"""
+
+import binascii
+import json
+import os
+import re
+import select
+import socket
+import sys
+import time
+
+# ExaBGP text encoder updates (e.g. 'neighbor 10.0.1.1 announced route
+# 10.201.0.0/24 next-hop 10.0.1.1').
+UPDATE_REGEXP = re.compile(r'\b(announced|withdrawn)\s+(?:route\s+)?(\S+/\d+)')
+
+# Update log actions.
+ANNOUNCED = 'A'
+WITHDRAWN = 'W'
+
+def parse_prefix(prefix):
+    "Returns the address family, the network (integer) and the prefix length."
+    address, length = prefix.split('/')
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    value = int(binascii.hexlify(socket.inet_pton(family, address)), 16)
+    return family, value, int(length)
+
+def format_prefix(family, value, length):
+    "Returns the prefix string of the `parse_prefix()` values."
+    size = 4 if family == socket.AF_INET else 16
+    packed = binascii.unhexlify('{:0{}x}'.format(value, size * 2))
+    return '{}/{}'.format(socket.inet_ntop(family, packed), length)
+
+def prefix_range(prefix, count):
+    """
+    Generates `count` consecutive prefixes of the same length starting with
+    `prefix` (e.g. '10.0.0.0/24', '10.0.1.0/24', ...).
+    """
+    family, value, length = parse_prefix(prefix)
+    bits = 32 if family == socket.AF_INET else 128
+    step = 1 << (bits - length)
+    if value + step * count > 1 << bits:
+        raise ValueError('{} prefixes from {} overflow'.format(count, prefix))
+
+    idx = 0
+    while idx < count:
+        yield format_prefix(family, value + idx * step, length)
+        idx += 1
+
+class RouteSpec(object):
+    """
+    Route stream specification: `count` prefixes starting with `prefix`
+    (see `prefix_range()`), with the ExaBGP route `attributes` (e.g.
+    'med 100 next-hop 10.0.1.101 origin igp'). `action` is either 'announce'
+    or 'withdraw'.
+    """
+
+    def __init__(self, prefix, count=1, attributes='', action='announce'):
+        if action not in ['announce', 'withdraw']:
+            raise ValueError('unknown route action: {}'.format(action))
+        self.prefix = prefix
+        self.count = count
+        self.attributes = attributes
+        self.action = action
+
+    def to_dict(self):
+        "Returns the specification dictionary (JSON encodable)."
+        return {
+            'prefix': self.prefix,
+            'count': self.count,
+            'attributes': self.attributes,
+            'action': self.action,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        "Returns a RouteSpec from a specification dictionary."
+        return cls(data['prefix'], data.get('count', 1),
+                   data.get('attributes', ''), data.get('action', 'announce'))
+
+    def lines(self, pack=1):
+        """
+        Generates the ExaBGP API lines and the number of prefixes in each one.
+        With `pack` greater than 1 up to `pack` prefixes share a line (and
+        an UPDATE message).
+        """
+        if pack <= 1:
+            for prefix in prefix_range(self.prefix, self.count):
+                line = '{} route {} {}'.format(self.action, prefix,
+                                               self.attributes)
+                yield line.rstrip(), 1
+            return
+
+        chunk = []
+        for prefix in prefix_range(self.prefix, self.count):
+            chunk.append(prefix)
+            if len(chunk) == pack:
+                yield self._packed_line(chunk), len(chunk)
+                chunk = []
+        if chunk:
+            yield self._packed_line(chunk), len(chunk)
+
+    def _packed_line(self, prefixes):
+        "Returns the API line for several prefixes."
+        return '{} attributes {} nlri {}'.format(
+            self.action, self.attributes, ' '.join(prefixes))
+
+class Injector(object):
+    """
+    Writes the route specifications `specs` lines to ExaBGP:
+    * `rate`: maximum prefixes per second (unlimited by default)
+    * `batch`: prefixes written (and flushed) at once
+    * `pack`: prefixes per API line (see `RouteSpec.lines()`)
+    * `progress`: path of the file that reports the progress
+    * `delay`: seconds to wait before starting
+    """
+
+    def __init__(self, specs, rate=None, batch=1000, pack=1, progress=None,
+                 delay=0):
+        self.specs = specs
+        self.rate = rate
+        self.batch = batch
+        self.pack = pack
+        self.progress = progress
+        self.delay = delay
+        self.total = sum([spec.count for spec in specs])
+        self.sent = 0
+        self.start = None
+
+    @classmethod
+    def load(cls, path):
+        "Returns the Injector of the injection file `path`."
+        with open(path) as fhandle:
+            data = json.load(fhandle)
+        specs = [RouteSpec.from_dict(spec) for spec in data['specs']]
+        progress = data.get('progress',
+                            os.path.splitext(path)[0] + '.progress')
+        return cls(specs, data.get('rate'), data.get('batch', 1000),
+                   data.get('pack', 1), progress, data.get('delay', 0))
+
+    def report(self, done=False):
+        "Write the progress file (replaced atomically)."
+        if self.progress is None:
+            return
+        elapsed = time.time() - self.start
+        data = {
+            'sent': self.sent,
+            'total': self.total,
+            'elapsed': round(elapsed, 3),
+            'done': done,
+        }
+        tmppath = self.progress + '.tmp'
+        with open(tmppath, 'w') as fhandle:
+            json.dump(data, fhandle)
+        os.rename(tmppath, self.progress)
+
+    def _flush(self, output, lines, count):
+        "Write a batch and wait as required by the rate limit."
+        output.write('\n'.join(lines) + '\n')
+        output.flush()
+        self.sent += count
+        if self.rate:
+            ahead = float(self.sent) / self.rate - (time.time() - self.start)
+            if ahead > 0:
+                time.sleep(ahead)
+        self.report()
+
+    def run(self, output=sys.stdout):
+        "Write all routes to `output`."
+        if self.delay:
+            time.sleep(self.delay)
+
+        self.start = time.time()
+        self.report()
+        lines = []
+        count = 0
+        for spec in self.specs:
+            for line, prefixes in spec.lines(self.pack):
+                lines.append(line)
+                count += prefixes
+                if count >= self.batch:
+                    self._flush(output, lines, count)
+                    lines = []
+                    count = 0
+        if lines:
+            self._flush(output, lines, count)
+        self.report(done=True)
+
+def _json_prefixes(nlris):
+    "Generates the prefixes of an ExaBGP JSON encoder address family NLRIs."
+    if isinstance(nlris, list):
+        # ExaBGP 4: [{"nlri": "<prefix>"}, ...]
+        for nlri in nlris:
+            yield nlri['nlri'] if isinstance(nlri, dict) else nlri
+        return
+
+    for key, value in nlris.iteritems():
+        if '/' in key:
+            yield key
+        else:
+            # Announcements are grouped by next hop
+            for prefix in _json_prefixes(value):
+                yield prefix
+
+def parse_update(line):
+    """
+    Returns the list of (action, prefix) of an ExaBGP API process input line
+    (text or JSON encoder).
+    """
+    if not line.startswith('{'):
+        return [(ANNOUNCED if action == 'announced' else WITHDRAWN, prefix)
+                for action, prefix in UPDATE_REGEXP.findall(line)]
+
+    try:
+        update = json.loads(line)['neighbor']['message']['update']
+    except (ValueError, KeyError, TypeError):
+        return []
+
+    result = []
+    for key, action in [('withdraw', WITHDRAWN), ('announce', ANNOUNCED)]:
+        for nlris in update.get(key, {}).values():
+            result.extend([(action, prefix)
+                           for prefix in _json_prefixes(nlris)])
+    return result
+
+class UpdateIndex(object):
+    """
+    Index of an update log: prefix -> (last action, timestamp). The log is
+    read incrementally, call `update()` to read the new entries.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.routes = {}
+
+    def update(self):
+        "Read the new complete log lines. Returns the number of new entries."
+        try:
+            with open(self.path) as fhandle:
+                fhandle.seek(self.offset)
+                data = fhandle.read()
+        except IOError:
+            return 0
+
+        # Only complete lines, the receiver may be writing the last one
+        end = data.rfind('\n') + 1
+        self.offset += end
+        lines = data[:end].splitlines()
+        for line in lines:
+            timestamp, action, prefix = line.split(' ', 2)
+            self.routes[prefix] = (action, float(timestamp))
+        return len(lines)
+
+    def get(self, prefix):
+        "Returns the (action, timestamp) of the last `prefix` update or `None`."
+        return self.routes.get(prefix)
+
+    def announced(self):
+        "Returns the prefixes currently announced."
+        return [prefix for prefix, (action, _) in self.routes.iteritems()
+                if action == ANNOUNCED]
+
+class Receiver(object):
+    """
+    Reads the ExaBGP updates and appends them to the update log `path`.
+    Writes are done in blocks of `batch` entries or after `interval`
+    seconds.
+    """
+
+    def __init__(self, path, batch=1000, interval=0.5):
+        self.path = path
+        self.batch = batch
+        self.interval = interval
+        self.entries = []
+        self.flushed = time.time()
+
+    def flush(self, output):
+        "Write the buffered entries."
+        if self.entries:
+            output.write(''.join(self.entries))
+            output.flush()
+            self.entries = []
+        self.flushed = time.time()
+
+    def parse(self, lines):
+        "Buffer the updates of `lines`."
+        now = '{:.3f}'.format(time.time())
+        for line in lines:
+            for action, prefix in parse_update(line):
+                self.entries.append('{} {} {}\n'.format(now, action, prefix))
+
+    def run(self, source=sys.stdin):
+        "Receive updates until `source` is closed."
+        fdesc = source.fileno()
+        pending = ''
+        with open(self.path, 'a') as output:
+            while True:
+                timeout = max(0, self.flushed + self.interval - time.time())
+                readable, _, _ = select.select([fdesc], [], [], timeout)
+                if not readable:
+                    self.flush(output)
+                    continue
+
+                data = os.read(fdesc, 65536)
+                if not data:
+                    break
+
+                lines = (pending + data).split('\n')
+                pending = lines.pop()
+                self.parse(lines)
+
+                if (len(self.entries) >= self.batch or
+                        time.time() - self.flushed >= self.interval):
+                    self.flush(output)
+            # Last line without line ending
+            self.parse([pending])
+            self.flush(output)
+
+def save_injection(path, specs, progress=None, **options):
+    """
+    Writes the injection file `path` of the RouteSpec list `specs`,
+    `options` are the Injector parameters (`rate`, `batch`, `pack` and
+    `delay`).
+    """
+    data = dict(options)
+    data['specs'] = [spec.to_dict() if isinstance(spec, RouteSpec) else spec
+                     for spec in specs]
+    if progress is not None:
+        data['progress'] = progress
+    with open(path, 'w') as fhandle:
+        json.dump(data, fhandle, indent=2)
+
+def inject(path):
+    "Inject the routes of the injection file `path`, then keep running."
+    Injector.load(path).run()
+    # ExaBGP stops the peer when its API processes exit.
+    while True:
+        time.sleep(1)
+
+def main(argv):
+    "API process entry point."
+    if len(argv) == 3 and argv[1] == 'inject':
+        inject(argv[2])
+    elif len(argv) == 3 and argv[1] == 'receive':
+        Receiver(argv[2]).run()
+    else:
+        sys.stderr.write(
+            'usage: {0} inject <file>\n       {0} receive <file>\n'.format(
+                argv[0]))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
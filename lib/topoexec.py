@@ -0,0 +1,278 @@
+#
+# topoexec.py
+# Library of helper functions for NetDEF Topology Tests
+#
+# Copyright (c) 2018 by
+# Network Device Education Foundation, Inc. ("NetDEF")
+#
+# Permission to use, copy, modify, and/or distribute this software
+# for any purpose with or without fee is hereby granted, provided
+# that the above copyright notice and this permission notice appear
+# in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND NETDEF DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL NETDEF BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY
+# DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE
+# OF THIS SOFTWARE.
+#
+
+"""
+Shell-less node command executor.
+
+Mininet runs the node commands in a long-lived bash driven through a pty:
+the commands of a node are serialized and their output is read through the
+pty. The executor runs every command as a direct child process inside the
+node namespaces (`nsenter`), reading its output from a pipe, with optional
+timeouts and allowing concurrent commands on the same node.
+
+The shell state that later commands rely on (`cd`, `umask`, `ulimit` and
+`export`) is replayed before every command.
+
+Enable it for the Topogen nodes by setting `executor = nsenter` in
+`pytest.ini`. Usage example:
+```py
+executor = NodeExecutor(router.pid, 'r1')
+output = executor.cmd('ip route show')
+results = executor.run_many(['vtysh -c "show ip route"',
+                             'vtysh -c "show ip bgp"'], timeout=30)
+```
+"""
+
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+
+# Shell commands whose effect must persist for the next node commands.
+STICKY_REGEXP = re.compile(r'^\s*(cd|umask|ulimit|export)\b([^;&|]*)$')
+
+def sticky_key(command):
+    """
+    Returns the key that identifies the shell state changed by `command`
+    (later commands with the same key replace it) or `None`.
+    """
+    mres = STICKY_REGEXP.match(command)
+    if mres is None:
+        return None
+
+    builtin, args = mres.group(1), mres.group(2).split()
+    if builtin == 'ulimit':
+        # One entry per limit (e.g. 'ulimit -c')
+        return ' '.join([builtin] + [arg for arg in args
+                                     if arg.startswith('-')])
+    if builtin == 'export':
+        return 'export ' + ' '.join([arg.split('=')[0] for arg in args])
+    return builtin
+
+def command_string(args):
+    "Converts Mininet style command arguments into a command string."
+    if len(args) == 1 and isinstance(args[0], list):
+        args = args[0]
+    if len(args) == 1 and isinstance(args[0], basestring):
+        return args[0]
+    return ' '.join([str(arg) for arg in args])
+
+class CommandResult(object):
+    "Executed command result."
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, command, output, returncode, duration,
+                 timed_out=False, pid=None):
+        self.command = command
+        self.output = output
+        self.returncode = returncode
+        self.duration = duration
+        self.timed_out = timed_out
+        # Background commands (ending with '&') process id
+        self.pid = pid
+
+    def __str__(self):
+        return self.output
+
+class NodeExecutor(object):
+    """
+    Runs commands in the namespaces of the process `pid` (or in the current
+    namespaces when `pid` is `None`). The commands are run by bash, their
+    standard error is merged into the output like in the Mininet shell.
+    """
+
+    def __init__(self, pid, name=None, timeout=None):
+        self.pid = pid
+        self.name = name
+        # Default timeout (seconds) when not specified per command
+        self.timeout = timeout
+        self.sticky = []
+        self.lock = threading.Lock()
+
+    def prefix(self):
+        "Returns the command prefix that enters the node namespaces."
+        if self.pid is None:
+            return []
+        return ['nsenter', '-t', str(self.pid), '-n', '-m', '--']
+
+    def _script(self, command):
+        "Returns the bash script running `command` after the shell state."
+        key = sticky_key(command)
+        with self.lock:
+            if key is not None:
+                self.sticky = [(skey, scmd) for skey, scmd in self.sticky
+                               if skey != key]
+                self.sticky.append((key, command))
+            lines = [scmd for _, scmd in self.sticky]
+
+        # Background commands must not hold our output pipe
+        if command.rstrip().endswith('&'):
+            lines.append('{{ {} ; }} < /dev/null > /dev/null 2>&1 &'.format(
+                command.rstrip()[:-1]))
+            lines.append('echo $!')
+        else:
+            lines.append(command)
+        return '\n'.join(lines)
+
+    def popen(self, command, **kwargs):
+        """
+        Returns a Popen() object running `command` with bash in the node
+        namespaces. The process is a process group leader.
+        """
+        params = {
+            'stdin': open(os.devnull),
+            'stdout': subprocess.PIPE,
+            'stderr': subprocess.STDOUT,
+            'preexec_fn': os.setsid,
+        }
+        params.update(kwargs)
+        return subprocess.Popen(
+            self.prefix() + ['bash', '-c', self._script(command)], **params)
+
+    def run(self, command, timeout=None):
+        """
+        Runs `command` and returns a CommandResult. When the command takes
+        longer than `timeout` (or the executor default) seconds, its process
+        group is killed and the result is marked as timed out.
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        start = time.time()
+        proc = self.popen(command)
+        timer = None
+        expired = []
+        if timeout is not None:
+            def kill():
+                "Kill the command and all its children."
+                expired.append(True)
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            timer = threading.Timer(timeout, kill)
+            timer.start()
+
+        try:
+            output, _ = proc.communicate()
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+        pid = None
+        if command.rstrip().endswith('&'):
+            pid = output.strip()
+            pid = int(pid) if pid.isdigit() else None
+            output = ''
+
+        return CommandResult(command, output, proc.returncode,
+                             time.time() - start, bool(expired), pid)
+
+    def cmd(self, command, timeout=None):
+        "Runs `command` and returns its output."
+        return self.run(command, timeout).output
+
+    def run_many(self, commands, timeout=None, jobs=None):
+        """
+        Runs `commands` concurrently (at most `jobs` at the same time, all by
+        default) and returns their CommandResult in the same order.
+        """
+        results = [None] * len(commands)
+        pending = list(enumerate(commands))
+        pending.reverse()
+        lock = threading.Lock()
+
+        def worker():
+            "Run pending commands until there are none left."
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    idx, command = pending.pop()
+                results[idx] = self.run(command, timeout)
+
+        threads = [threading.Thread(target=worker)
+                   for _ in range(min(jobs or len(commands), len(commands)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+class ExecutorNode(object):
+    """
+    Mixin that runs the Mininet node commands with a NodeExecutor instead of
+    the node shell once `executor` is set. It must come before the Mininet
+    node class (see `executor_class()`).
+    """
+
+    def startShell(self, mnopts=None):
+        "Start the node shell, then run the next commands with the executor."
+        self.executor = None
+        self.exec_output = ''
+        super(ExecutorNode, self).startShell(mnopts)
+        self.executor = NodeExecutor(self.pid, self.name)
+
+    def sendCmd(self, *args, **kwargs):
+        """
+        Run the command with the executor, the output is returned by the next
+        waitOutput() call. Accepts the `timeout` keyword argument.
+        """
+        if self.executor is None:
+            return super(ExecutorNode, self).sendCmd(*args, **kwargs)
+
+        command = command_string(args)
+        self.lastCmd = command
+        result = self.executor.run(command, kwargs.get('timeout'))
+        if result.pid is not None:
+            self.lastPid = result.pid
+        self.exec_output = result.output
+        self.waiting = True
+
+    def monitor(self, timeoutms=None, findPid=True):
+        "Returns the last command output."
+        if self.executor is None:
+            return super(ExecutorNode, self).monitor(timeoutms, findPid)
+
+        output = self.exec_output
+        self.exec_output = ''
+        self.waiting = False
+        return output
+
+    def waitOutput(self, verbose=False, findPid=True):
+        "Returns the last command output."
+        if self.executor is None:
+            return super(ExecutorNode, self).waitOutput(verbose, findPid)
+        return self.monitor()
+
+_executor_classes = {}
+
+def executor_class(cls):
+    "Returns the version of the Mininet node class `cls` using the executor."
+    if issubclass(cls, ExecutorNode):
+        return cls
+    if cls not in _executor_classes:
+        _executor_classes[cls] = type('Exec' + cls.__name__,
+                                      (ExecutorNode, cls), {})
+    return _executor_classes[cls]
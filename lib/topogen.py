@@ -47,37 +47,65 @@ import glob
 import grp
 import platform
 import pwd
+import shutil
 import subprocess
+import threading
 import pytest
 
 from mininet.net import Mininet
+from mininet.node import Host
 from mininet.log import setLogLevel
 from mininet.cli import CLI
 
 from lib import topotest
+from lib import topoexec
+from lib import toponetns
+from lib.topoexa import RouteSpec, UpdateIndex, ANNOUNCED, WITHDRAWN
+from lib.topoexa import prefix_range, save_injection
+from lib.topobgp import BGPSession, BGPSpeaker
 from lib.topolog import logger, logger_config
+from lib.topotrace import tracer, timeline
 
 CWD = os.path.dirname(os.path.realpath(__file__))
 
 # pylint: disable=C0103
-# Global Topogen variable. This is being used to keep the Topogen available on
-# all test functions without declaring a test local variable.
-global_tgen = None
+# The Topogen instance being used by the running test module (per thread).
+# This is being used to keep the Topogen available on all test functions
+# without declaring a test local variable.
+_tgen_local = threading.local()
 
 def get_topogen(topo=None):
     """
     Helper function to retrieve Topogen. Must be called with `topo` when called
     inside the build() method of Topology class.
     """
+    tgen = getattr(_tgen_local, 'tgen', None)
     if topo is not None:
-        global_tgen.topo = topo
-    return global_tgen
+        tgen.topo = topo
+    return tgen
 
 def set_topogen(tgen):
     "Helper function to set Topogen"
-    # pylint: disable=W0603
-    global global_tgen
-    global_tgen = tgen
+    _tgen_local.tgen = tgen
+
+def get_run_id():
+    """
+    Returns the identifier of this test run when running in parallel with
+    other runs on the same host, otherwise an empty string.
+
+    The identifier comes from the `TOPOTESTS_RUN_ID` environment variable
+    (set by lib/toporunner.py) or from the pytest-xdist worker name.
+    """
+    run_id = os.environ.get('TOPOTESTS_RUN_ID')
+    if run_id is not None:
+        return run_id
+
+    # pytest-xdist workers are named 'gw0', 'gw1'...
+    worker = os.environ.get('PYTEST_XDIST_WORKER')
+    if worker is not None:
+        return 'w' + worker.replace('gw', '')
+
+    return ''
 
 #
 # Main class: topology builder
@@ -89,9 +117,50 @@ tgen_defaults = {
     'frrdir': '/usr/lib/frr',
     'quaggadir': '/usr/lib/quagga',
     'routertype': 'frr',
+    'switchtype': 'legacy',
+    'collapse_switches': 'false',
+    'backend': 'mininet',
+    'executor': 'shell',
+    'command_timeout': '300',
+    'command_cache': 'false',
+    'command_cache_lifetime': '1',
     'memleak_path': None,
+    'async_logging': 'false',
+    'log_truncate': '0',
+    'trace_path': None,
+    'timeline_dir': None,
+}
+
+# Switch classes selectable with the `switchtype` configuration.
+SWITCH_TYPES = {
+    'legacy': topotest.LegacySwitch,
+    'linuxbridge': topotest.LinuxBridge,
 }
 
+# ExaBGP peer configuration generated by Topogen.write_bgp_fanout().
+FANOUT_EXABGP_CONFIG = '''group controller {{
+
+    process announce-routes {{
+        run "/etc/exabgp/topoexa.py inject /etc/exabgp/inject.json";
+    }}
+
+    process receive-routes {{
+        run "/etc/exabgp/topoexa.py receive /etc/exabgp/received.log";
+        receive-routes;
+        encoder text;
+    }}
+
+    neighbor {gateway} {{
+        router-id {address};
+        local-address {address};
+        local-as {asn};
+        peer-as {peer_as};
+        graceful-restart;
+    }}
+
+}}
+'''
+
 class Topogen(object):
     "A topology test builder helper."
 
@@ -113,15 +182,41 @@ class Topogen(object):
         self.errorsd = {}
         self.errors = ''
         self.peern = 1
-        self._init_topo(cls)
+        # Built-in BGP speaker serving the TopoBGPSpeaker sessions
+        self.speaker = None
+        # Generated BGP peers (see add_bgp_fanout())
+        self.fanout = None
+        # Replace two port switches by direct links (see _build_links())
+        self.collapse_switches = False
+        self.pending_links = []
+        # Run identifier: prefix for the names that are host wide (switches
+        # and their interfaces live in the main network namespace).
+        self.run_id = get_run_id()
+        self.logdir = '{}/{}'.format(topotest.get_logdir_base(), modname)
+        # Load the default topology configurations
+        self._load_config()
+        self._init_tracing()
+        with timeline.span('_init_topo'):
+            self._init_topo(cls)
         logger.info('loading topology: {}'.format(self.modname))
 
-    @staticmethod
-    def _mininet_reset():
+    def _mininet_reset(self):
         "Reset the mininet environment"
+        # Cleaning up would destroy the other parallel runs topologies, the
+        # parallel runner cleans up once before starting them.
+        if self.run_id != '' or self.backend != 'mininet':
+            return
+
         # Clean up the mininet environment
         os.system('mn -c > /dev/null 2>&1')
 
+    def get_netname(self, name):
+        """
+        Returns the name used in the network for the host wide gear `name`
+        (e.g. switches), unique per parallel run.
+        """
+        return '{}{}'.format(self.run_id, name)
+
     def _init_topo(self, cls):
         """
         Initialize the topogily provided by the user. The user topology class
@@ -138,16 +233,79 @@ class Topogen(object):
             logger.info('MPLS tests will not run (missing mpls-iptunnel kernel module)')
         else:
             self.hasmpls = True
-        # Load the default topology configurations
-        self._load_config()
+
+        # Configure background logging before creating the router loggers
+        if self.config.getboolean(self.CONFIG_SECTION, 'async_logging'):
+            logger_config.set_async(
+                self.config.getint(self.CONFIG_SECTION, 'log_truncate'))
+
+        self.collapse_switches = self.config.getboolean(
+            self.CONFIG_SECTION, 'collapse_switches')
+        self.backend = self.config.get(self.CONFIG_SECTION, 'backend')
+        topotest.set_command_timeout(self.config.getfloat(
+            self.CONFIG_SECTION, 'command_timeout'))
+        topotest.set_command_cache(
+            self.config.getboolean(self.CONFIG_SECTION, 'command_cache'),
+            self.config.getfloat(self.CONFIG_SECTION, 'command_cache_lifetime'))
+        if self.backend not in ['mininet', 'netns']:
+            raise ValueError('unknown backend: {}'.format(self.backend))
 
         # Initialize the API
         self._mininet_reset()
         cls()
-        self.net = Mininet(controller=None, topo=self.topo)
+        if self.collapse_switches:
+            self._build_links()
+        if self.backend == 'netns':
+            self.net = toponetns.NamespaceNet(self.topo)
+        else:
+            self.net = Mininet(controller=None, topo=self.topo)
         for gear in self.gears.values():
             gear.net = self.net
 
+    def _build_links(self):
+        """
+        Adds the switches and links deferred by `collapse_switches` to the
+        topology. Switches joining only two nodes are replaced by a direct
+        link between the nodes interfaces, saving the bridge and two extra
+        interfaces per link. The gears links keep pointing to the switch.
+        """
+        for switch in self.get_gears(TopoSwitch).values():
+            ports = sorted(switch.links.keys())
+            peers = [switch.links[port] for port in ports]
+            if (not switch.collapse or len(peers) != 2 or
+                    any([isinstance(node, TopoSwitch) for node, _ in peers])):
+                switch.add_to_topology()
+                continue
+
+            (node1, ifname1), (node2, ifname2) = peers
+            logger.info('collapsing switch "{}" into link "{}"<->"{}"'.format(
+                switch.name, ifname1, ifname2))
+            switch.collapsed = True
+            self.topo.addLink(node1.netname, node2.netname,
+                              intfName1=ifname1, intfName2=ifname2)
+
+        for node1, ifname1, node2, ifname2 in self.pending_links:
+            if node1.collapsed or node2.collapsed:
+                continue
+            self.topo.addLink(node1.netname, node2.netname,
+                              intfName1=ifname1, intfName2=ifname2)
+        self.pending_links = []
+
+    def _init_tracing(self):
+        "Start the command tracer and the timeline if they are enabled."
+        trace_path = (os.environ.get('TOPOTESTS_TRACE') or
+                      self.config.get(self.CONFIG_SECTION, 'trace_path'))
+        if trace_path is not None:
+            tracer.start(self.modname, trace_path)
+
+        timeline_dir = (os.environ.get('TOPOTESTS_TIMELINE') or
+                        self.config.get(self.CONFIG_SECTION, 'timeline_dir'))
+        if timeline_dir is not None:
+            topotest.make_logdir(timeline_dir)
+            timeline.start(self.modname, timeline_dir)
+        elif timeline.always_record:
+            timeline.start(self.modname)
+
     def _load_config(self):
         """
         Loads the configuration file `pytest.ini` located at the root dir of
@@ -157,6 +315,37 @@ class Topogen(object):
         pytestini_path = os.path.join(CWD, '../pytest.ini')
         self.config.read(pytestini_path)
 
+    def get_scale(self, name, default, nodes=False):
+        """
+        Returns the integer scale parameter `name` of a test (e.g. its number
+        of BGP peers): the `TOPOTESTS_<NAME>` environment variable, the
+        `name` configuration in `pytest.ini` or `default`.
+
+        `nodes` tells the parameter is a number of nodes: lib/toporunner.py
+        reads the calls in the test files (with literal arguments) to size
+        the module and can run it with several values (`--scale`).
+        """
+        value = os.environ.get('TOPOTESTS_{}'.format(name.upper()))
+        if value is None and self.config.has_option(self.CONFIG_SECTION, name):
+            value = self.config.get(self.CONFIG_SECTION, name)
+        if value is None:
+            return default
+        return int(value)
+
+    def node_class(self, cls):
+        """
+        Returns the Mininet node class used for `cls`: when the `executor`
+        configuration is `nsenter` the commands are run by the topoexec
+        executor instead of the node shell.
+        """
+        executor = self.config.get(self.CONFIG_SECTION, 'executor')
+        if executor not in ['shell', 'nsenter']:
+            raise ValueError('unknown executor: {}'.format(executor))
+        # The namespace backend always uses the executor
+        if executor == 'shell' or self.backend == 'netns':
+            return cls
+        return topoexec.executor_class(cls)
+
     def add_router(self, name=None, cls=topotest.Router, **params):
         """
         Adds a new router to the topology. This function has the following
@@ -181,19 +370,31 @@ class Topogen(object):
         self.routern += 1
         return self.gears[name]
 
-    def add_switch(self, name=None, cls=topotest.LegacySwitch):
+    def add_switch(self, name=None, cls=None, collapse=True):
         """
         Adds a new switch to the topology. This function has the following
         options:
         name: (optional) select the switch name
+        cls: (optional) switch class, defaults to the `switchtype`
+        configuration (`legacy` for Open vSwitch or `linuxbridge`)
+        collapse: (optional) whether the switch can be replaced by a direct
+        link with `collapse_switches`, use `False` when the test changes the
+        state of the switch ports or of its members interfaces (e.g. with
+        `link_enable()` or `peer_link_enable()`): on a direct link both
+        sides lose their carrier
         Returns the switch name and number.
         """
         if name is None:
             name = 's{}'.format(self.switchn)
         if name in self.gears:
             raise KeyError('switch already exists')
+        if cls is None:
+            switchtype = self.config.get(self.CONFIG_SECTION, 'switchtype')
+            if switchtype not in SWITCH_TYPES:
+                raise ValueError('unknown switch type: {}'.format(switchtype))
+            cls = SWITCH_TYPES[switchtype]
 
-        self.gears[name] = TopoSwitch(self, cls, name)
+        self.gears[name] = TopoSwitch(self, cls, name, collapse)
         self.switchn += 1
         return self.gears[name]
 
@@ -213,6 +414,24 @@ class Topogen(object):
         self.peern += 1
         return self.gears[name]
 
+    def add_bgp_speaker(self, name, ip, defaultRoute):
+        """
+        Adds a new built-in BGP speaker peer to the topology (a lightweight
+        alternative to the ExaBGP peers, see lib/topobgp.py). This function
+        has the following parameters:
+        * `ip`: the peer address (e.g. '1.2.3.4/24')
+        * `defaultRoute`: the peer default route (e.g. 'via 1.2.3.1')
+        """
+        if name is None:
+            name = 'peer{}'.format(self.peern)
+        if name in self.gears:
+            raise KeyError('bgp speaker already exists')
+
+        self.gears[name] = TopoBGPSpeaker(self, name, ip=ip,
+                                          defaultRoute=defaultRoute)
+        self.peern += 1
+        return self.gears[name]
+
     def add_link(self, node1, node2, ifname1=None, ifname2=None):
         """
         Creates a connection between node1 and node2. The nodes can be the
@@ -233,7 +452,10 @@ class Topogen(object):
 
         node1.register_link(ifname1, node2, ifname2)
         node2.register_link(ifname2, node1, ifname1)
-        self.topo.addLink(node1.name, node2.name,
+        if self.collapse_switches:
+            self.pending_links.append((node1, ifname1, node2, ifname2))
+            return
+        self.topo.addLink(node1.netname, node2.netname,
                           intfName1=ifname1, intfName2=ifname2)
 
     def get_gears(self, geartype):
@@ -273,6 +495,232 @@ class Topogen(object):
         """
         return self.get_gears(TopoExaBGP)
 
+    def bgp_speakers(self):
+        """
+        Returns the built-in BGP speaker peer dictionary (key is the peer name
+        and value is the peer object itself).
+        """
+        return self.get_gears(TopoBGPSpeaker)
+
+    def bgp_speaker(self):
+        "Returns the BGP speaker serving the TopoBGPSpeaker sessions."
+        if self.speaker is None:
+            self.speaker = BGPSpeaker()
+            self.speaker.start()
+        return self.speaker
+
+    def start_exabgp_peers(self, basedir, env_file=None, peers=None,
+                           timeout=60):
+        """
+        Starts the ExaBGP peers concurrently and waits for their BGP sessions
+        to be established. Has the following parameters:
+        * `basedir`: directory with one configuration directory per peer
+          (named after the peer, see TopoExaBGP.start())
+        * `env_file`: (optional) ExaBGP environment file
+        * `peers`: (optional) list of peers, defaults to all peers
+        * `timeout`: maximum seconds to wait for the sessions
+
+        Returns `True` when all sessions are established, otherwise `False`.
+        """
+        if peers is None:
+            peers = self.exabgp_peers().values()
+
+        with timeline.span('start_exabgp_peers'):
+            # Staging is done in-process, only the daemons run in the peers
+            for peer in peers:
+                peer.stage(os.path.join(basedir, peer.name), env_file)
+
+            threads = [threading.Thread(target=peer.launch) for peer in peers]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            return self.wait_exabgp_established(peers, timeout)
+
+    def wait_exabgp_established(self, peers=None, timeout=60, wait=0.5):
+        """
+        Waits until the routers have an established BGP session with every
+        ExaBGP peer of `peers` (all peers by default, TopoBGPSpeaker peers
+        are also accepted). Returns `True` on
+        success, otherwise `False`.
+        """
+        if peers is None:
+            peers = self.exabgp_peers().values()
+        pending = set([peer.address() for peer in peers])
+
+        def _pending_sessions():
+            "Returns the peer addresses without an established session."
+            for router in self.routers().values():
+                output = router.vtysh_cmd('show ip bgp neighbors json',
+                                          isjson=True)
+                for address, neighbor in output.iteritems():
+                    if (address in pending and isinstance(neighbor, dict) and
+                            neighbor.get('bgpState') == 'Established'):
+                        pending.discard(address)
+            return sorted(pending)
+
+        count = max(1, int(timeout / wait))
+        success, result = topotest.run_and_expect(
+            _pending_sessions, [], count=count, wait=wait)
+        if not success:
+            logger.error('ExaBGP sessions not established: {}'.format(
+                ', '.join(result)))
+        return success
+
+    def add_bgp_fanout(self, router, count, peer_as=99, per_switch=5,
+                       speakers=False):
+        """
+        Adds `count` BGP peers (`peer1` to `peerN`) connected to `router`
+        through switches of `per_switch` peers: switch `sN` network is
+        10.0.N.0/24 with `router` address 10.0.N.1 and the peers addresses
+        10.0.N.101 to 10.0.N.(100 + `per_switch`), at most 150 peers per
+        switch. Has the following parameters:
+        * `peer_as`: the peers AS number or a function returning the AS
+          number of a peer number
+        * `speakers`: use built-in BGP speakers instead of ExaBGP peers
+
+        Must be called while building the topology. Returns the list of
+        peers; the configurations are generated by write_bgp_fanout().
+        """
+        if per_switch > 150:
+            raise ValueError('too many peers per switch: {}'.format(per_switch))
+        if count > 254 * per_switch:
+            raise ValueError('too many peers: {}'.format(count))
+
+        switches = []
+        networks = []
+        for swnum in range(1, (count + per_switch - 1) / per_switch + 1):
+            switch = self.add_switch('s{}'.format(swnum))
+            switch.add_link(router)
+            switches.append(switch)
+            networks.append((switch, '10.0.{}.1/24'.format(swnum)))
+
+        peers = []
+        for num in range(1, count + 1):
+            swnum = (num - 1) / per_switch + 1
+            address = '10.0.{}.{}'.format(swnum, 100 + (num - 1) % per_switch + 1)
+            gateway = '10.0.{}.1'.format(swnum)
+            add_peer = self.add_bgp_speaker if speakers else self.add_exabgp_peer
+            peer = add_peer('peer{}'.format(num), ip='{}/24'.format(address),
+                            defaultRoute='via {}'.format(gateway))
+            switches[swnum - 1].add_link(peer)
+            peer.fanout = {
+                'num': num,
+                'asn': peer_as(num) if callable(peer_as) else peer_as,
+                'gateway': gateway,
+            }
+            peers.append(peer)
+
+        self.fanout = {'router': router, 'peers': peers, 'networks': networks}
+        return peers
+
+    def write_bgp_fanout(self, local_as, router_id, routes=None,
+                         directory=None):
+        """
+        Generates the add_bgp_fanout() configurations in `directory` (the
+        test log directory 'fanout' subdirectory by default) and returns it:
+        * '<router>/zebra.conf' and '<router>/bgpd.conf': the router
+          interfaces and a BGP instance `local_as` with all peers
+        * 'peerN/exabgp.cfg' and 'peerN/inject.json' for the ExaBGP peers
+          (announcing with `topoexa.py`, see TopoExaBGP.start())
+
+        `routes` is a function returning the routes of a peer: a list of
+        dictionaries with the `prefix` and `count` keys (see
+        `topoexa.prefix_range()`) and the optional `med`, `as_path` (list of
+        AS numbers) and `origin` keys.
+        """
+        if directory is None:
+            directory = os.path.join(self.logdir, 'fanout')
+        router = self.fanout['router']
+        peers = self.fanout['peers']
+        self.fanout.update({
+            'local_as': local_as,
+            'routes': routes,
+            'directory': directory,
+        })
+
+        rdir = os.path.join(directory, router.name)
+        if not os.path.isdir(rdir):
+            os.makedirs(rdir)
+
+        zebra = ['!', 'hostname {}'.format(router.name),
+                 'log file zebra.log', '!']
+        for switch, address in self.fanout['networks']:
+            for ifname, (node, _) in sorted(router.links.iteritems()):
+                if node is switch:
+                    zebra.extend(['interface {}'.format(ifname),
+                                  ' ip address {}'.format(address), '!'])
+        with open(os.path.join(rdir, 'zebra.conf'), 'w') as fhandle:
+            fhandle.write('\n'.join(zebra) + '\n')
+
+        bgpd = ['!', 'hostname {}'.format(router.name), 'log file bgpd.log',
+                '!', 'router bgp {}'.format(local_as),
+                ' bgp router-id {}'.format(router_id),
+                ' bgp bestpath as-path multipath-relax']
+        bgpd.extend([' neighbor {} remote-as {}'.format(
+            peer.address(), peer.fanout['asn']) for peer in peers])
+        bgpd.extend([' !', '!'])
+        with open(os.path.join(rdir, 'bgpd.conf'), 'w') as fhandle:
+            fhandle.write('\n'.join(bgpd) + '\n')
+
+        for peer in peers:
+            if not isinstance(peer, TopoExaBGP):
+                continue
+            pdir = os.path.join(directory, peer.name)
+            if not os.path.isdir(pdir):
+                os.makedirs(pdir)
+            with open(os.path.join(pdir, 'exabgp.cfg'), 'w') as fhandle:
+                fhandle.write(FANOUT_EXABGP_CONFIG.format(
+                    gateway=peer.fanout['gateway'], address=peer.address(),
+                    asn=peer.fanout['asn'], peer_as=local_as))
+            specs = []
+            for route in routes(peer) if routes else []:
+                attributes = []
+                if route.get('med') is not None:
+                    attributes.append('med {}'.format(route['med']))
+                attributes.append('next-hop {} origin {}'.format(
+                    peer.address(), route.get('origin', 'igp')))
+                if route.get('as_path'):
+                    attributes.append('as-path [ {} ]'.format(
+                        ' '.join([str(asn) for asn in route['as_path']])))
+                specs.append(RouteSpec(route['prefix'], route['count'],
+                                       ' '.join(attributes)))
+            save_injection(os.path.join(pdir, 'inject.json'), specs,
+                           '/etc/exabgp/inject.progress')
+
+        return directory
+
+    def start_bgp_fanout(self, env_file=None, timeout=60):
+        """
+        Starts the write_bgp_fanout() peers (ExaBGP daemons or built-in
+        speaker sessions announcing their routes) and waits for their BGP
+        sessions to be established. Returns `True` on success, otherwise
+        `False`.
+        """
+        peers = self.fanout['peers']
+        exabgp = [peer for peer in peers if isinstance(peer, TopoExaBGP)]
+        if exabgp and not self.start_exabgp_peers(
+                self.fanout['directory'], env_file, exabgp, timeout):
+            return False
+
+        speakers = [peer for peer in peers if isinstance(peer, TopoBGPSpeaker)]
+        for peer in speakers:
+            peer.start(peer.fanout['asn'], peer.fanout['gateway'],
+                       self.fanout['local_as'])
+            routes = self.fanout['routes']
+            for route in routes(peer) if routes else []:
+                # The speaker prepends its AS, ExaBGP paths are sent as is
+                as_path = route.get('as_path') or []
+                if as_path[:1] == [peer.fanout['asn']]:
+                    as_path = as_path[1:]
+                peer.announce(route['prefix'], route['count'],
+                              as_path=as_path, origin=route.get('origin', 'igp'),
+                              med=route.get('med'))
+        if speakers:
+            return self.wait_exabgp_established(speakers, timeout)
+        return True
+
     def start_topology(self, log_level=None):
         """
         Starts the topology class. Possible `log_level`s are:
@@ -295,22 +743,24 @@ class Topogen(object):
             setLogLevel(log_level)
 
         logger.info('starting topology: {}'.format(self.modname))
-        self.net.start()
+        with timeline.span('start_topology'):
+            self.net.start()
 
     def start_router(self, router=None):
         """
         Call the router startRouter method.
         If no router is specified it is called for all registred routers.
         """
-        if router is None:
-            # pylint: disable=r1704
-            for _, router in self.routers().iteritems():
-                router.start()
-        else:
-            if isinstance(router, str):
-                router = self.gears[router]
+        with timeline.span('start_router'):
+            if router is None:
+                # pylint: disable=r1704
+                for _, router in self.routers().iteritems():
+                    router.start()
+            else:
+                if isinstance(router, str):
+                    router = self.gears[router]
 
-            router.start()
+                router.start()
 
     def stop_topology(self):
         """
@@ -322,14 +772,41 @@ class Topogen(object):
         """
         logger.info('stopping topology: {}'.format(self.modname))
         errors = ""
-        for gear in self.gears.values():
-            gear.stop(False, False)
-        for gear in self.gears.values():
-            errors += gear.stop(True, False)
+        with timeline.span('stop_topology'):
+            for gear in self.gears.values():
+                with timeline.span('stop', lane=gear.name):
+                    gear.stop(False, False)
+            for gear in self.gears.values():
+                with timeline.span('stop (wait)', lane=gear.name):
+                    errors += gear.stop(True, False)
+            if self.speaker is not None:
+                self.speaker.stop()
+                self.speaker = None
+            if len(errors) == 0:
+                self.net.stop()
+
+        # The cached outputs belong to this topology
+        topotest.set_command_cache(False)
+
+        # Export after the stop_topology span is closed
+        self._stop_tracing()
+
+        # Make sure the module logs are complete before the next module
+        logger_config.stop()
+
         if len(errors) > 0:
             assert "Errors found post shutdown - details follow:" == 0, errors
 
-        self.net.stop()
+    def _stop_tracing(self):
+        "Report the commands duration summary and export the timeline."
+        if tracer.enabled:
+            tracer.report()
+            tracer.stop()
+        if timeline.enabled:
+            if timeline.outdir is not None:
+                timeline.export()
+            else:
+                timeline.stop()
 
     def mininet_cli(self):
         """
@@ -410,9 +887,14 @@ class TopoGear(object):
     def __init__(self):
         self.tgen = None
         self.name = None
+        # Name of the node in the network (see Topogen.get_netname())
+        self.netname = None
         self.cls = None
         self.links = {}
         self.linkn = 0
+        self.capturen = 0
+        # Replaced by a direct link (see Topogen._build_links())
+        self.collapsed = False
 
     def __str__(self):
         links = ''
@@ -433,12 +915,54 @@ class TopoGear(object):
         logger.info('stopping "{}"'.format(self.name))
         return ""
 
-    def run(self, command):
+    def run(self, command, timeout=None, capture=None):
         """
         Runs the provided command string in the router and returns a string
         with the response.
+
+        Raises topotest.CommandTimeoutError when the command doesn't finish
+        in `timeout` seconds (defaults to `command_timeout` in pytest.ini).
+
+        With `capture` (a file name or `True` to generate one) the output is
+        written to a file in the node log directory and a
+        topotest.CapturedOutput is returned instead: use it for huge outputs.
+        """
+        if capture:
+            path = self.capture_path(capture)
+            command = '{{ {} ; }} > {} 2>&1'.format(command, path)
+
+        with tracer.trace('run', self.name, command) as span:
+            output = topotest.node_cmd(self.tgen.net[self.netname], command,
+                                       timeout)
+            span.output = output
+
+        if capture:
+            return topotest.CapturedOutput(path)
+        return output
+
+    def capture_path(self, name=True):
+        """
+        Returns the path of the capture file `name` in the node log directory,
+        a unique name is generated when `name` is `True`.
+        """
+        logdir = os.path.join(self.tgen.logdir, self.name)
+        topotest.make_logdir(logdir)
+        if name is True:
+            self.capturen += 1
+            name = 'capture-{}.out'.format(self.capturen)
+        return os.path.join(logdir, name)
+
+    def run_many(self, commands):
         """
-        return self.tgen.net[self.name].cmd(command)
+        Runs the provided commands concurrently when the node uses the
+        executor (see `executor` in pytest.ini), otherwise one after the
+        other. Returns a list with the commands responses.
+        """
+        node = self.tgen.net[self.netname]
+        executor = getattr(node, 'executor', None)
+        if executor is None:
+            return [self.run(command) for command in commands]
+        return [result.output for result in executor.run_many(commands)]
 
     def add_link(self, node, myif=None, nodeif=None):
         """
@@ -454,10 +978,19 @@ class TopoGear(object):
         Set this node interface administrative state.
         myif: this node interface name
         enabled: whether we should enable or disable the interface
+
+        NOTE: the interface can't be on a collapsed switch (the other node
+        would lose its carrier too), add the switch with `collapse=False`.
         """
         if myif not in self.links.keys():
             raise KeyError('interface doesn\'t exists')
 
+        switch, _ = self.links[myif]
+        if switch.collapsed:
+            raise RuntimeError(
+                'interface "{}" is on the switch "{}" collapsed into a direct '
+                'link, add it with collapse=False'.format(myif, switch.name))
+
         if enabled is True:
             operation = 'up'
         else:
@@ -492,7 +1025,7 @@ class TopoGear(object):
 
         NOTE: This function should only be called by Topogen.
         """
-        ifname = '{}-eth{}'.format(self.name, self.linkn)
+        ifname = '{}-eth{}'.format(self.netname, self.linkn)
         self.linkn += 1
         return ifname
 
@@ -564,6 +1097,7 @@ class TopoRouter(TopoGear):
         self.tgen = tgen
         self.net = None
         self.name = name
+        self.netname = name
         self.cls = cls
         self.options = {}
         self.routertype = params.get('routertype', 'frr')
@@ -571,9 +1105,11 @@ class TopoRouter(TopoGear):
             params['privateDirs'] = self.PRIVATE_DIRS
 
         self.options['memleak_path'] = params.get('memleak_path', None)
+        # vtysh command outputs cache (see topotest.cached_output())
+        self.cmd_cache = {}
 
         # Create new log directory
-        self.logdir = '/tmp/topotests/{}'.format(self.tgen.modname)
+        self.logdir = self.tgen.logdir
         # Clean up before starting new log files: avoids removing just created
         # log files.
         self._prepare_tmpfiles()
@@ -582,14 +1118,14 @@ class TopoRouter(TopoGear):
 
         #setup the per node directory
         dir = '{}/{}'.format(self.logdir, self.name)
-        os.system('mkdir -p ' + dir)
-        os.system('chmod -R go+rw /tmp/topotests')
+        topotest.make_logdir(dir, self.routertype)
 
         # Open router log file
         logfile = '{0}/{1}.log'.format(dir, name)
 
         self.logger = logger_config.get_logger(name=name, target=logfile)
-        self.tgen.topo.addNode(self.name, cls=self.cls, **params)
+        self.tgen.topo.addNode(self.name, cls=self.tgen.node_class(self.cls),
+                               **params)
 
     def __str__(self):
         gear = super(TopoRouter, self).__str__()
@@ -597,21 +1133,9 @@ class TopoRouter(TopoGear):
         return gear
 
     def _prepare_tmpfiles(self):
-        # Create directories if they don't exist
-        try:
-            os.makedirs(self.logdir, 0755)
-        except OSError:
-            pass
-
-        # Allow unprivileged daemon user (frr/quagga) to create log files
-        try:
-            # Only allow group, if it exist.
-            gid = grp.getgrnam(self.routertype)[2]
-            os.chown(self.logdir, 0, gid)
-            os.chmod(self.logdir, 0775)
-        except KeyError:
-            # Allow anyone, but set the sticky bit to avoid file deletions
-            os.chmod(self.logdir, 01777)
+        # Create directories if they don't exist. Allow unprivileged daemon
+        # user (frr/quagga) to create log files.
+        topotest.make_logdir(self.logdir, self.routertype)
 
         # Try to find relevant old logfiles in /tmp and delete them
         map(os.remove, glob.glob('{}/{}/*.log'.format(self.logdir, self.name)))
@@ -657,15 +1181,16 @@ class TopoRouter(TopoGear):
         """
         self.logger.debug('starting')
         nrouter = self.tgen.net[self.name]
-        result = nrouter.startRouter(self.tgen)
+        with timeline.span('start', lane=self.name):
+            result = nrouter.startRouter(self.tgen)
 
-        # Enable all daemon command logging, logging files
-        # and set them to the start dir.
-        for daemon, enabled in nrouter.daemons.iteritems():
-            if enabled == 0:
-                continue
-            self.vtysh_cmd('configure terminal\nlog commands\nlog file {}.log'.format(
-                daemon), daemon=daemon)
+            # Enable all daemon command logging, logging files
+            # and set them to the start dir.
+            for daemon, enabled in nrouter.daemons.iteritems():
+                if enabled == 0:
+                    continue
+                self.vtysh_cmd('configure terminal\nlog commands\nlog file {}.log'.format(
+                    daemon), daemon=daemon)
 
         if result != '':
             self.tgen.set_error(result)
@@ -680,17 +1205,20 @@ class TopoRouter(TopoGear):
         self.logger.debug('stopping')
         return self.tgen.net[self.name].stopRouter(wait, assertOnError)
 
-    def vtysh_cmd(self, command, isjson=False, daemon=None):
+    def vtysh_cmd(self, command, isjson=False, daemon=None, timeout=None,
+                  capture=None):
         """
         Runs the provided command string in the vty shell and returns a string
-        with the response.
+        with the response. See run() for the `timeout` and `capture`
+        parameters, with `capture` `isjson` is ignored (see
+        topotest.CapturedOutput.json()).
 
         This function also accepts multiple commands, but this mode does not
         return output for each command. See vtysh_multicmd() for more details.
         """
         # Detect multi line commands
         if command.find('\n') != -1:
-            return self.vtysh_multicmd(command, daemon=daemon)
+            return self.vtysh_multicmd(command, daemon=daemon, timeout=timeout)
 
         dparam = ''
         if daemon is not None:
@@ -698,7 +1226,17 @@ class TopoRouter(TopoGear):
 
         vtysh_command = 'vtysh {} -c "{}" 2>/dev/null'.format(dparam, command)
 
-        output = self.run(vtysh_command)
+        if capture:
+            with tracer.trace('vtysh', self.name, command, daemon) as span:
+                span.output = output = self.run(vtysh_command, timeout, capture)
+            self.logger.info('\nvtysh command => {}\nvtysh output <= {} ({} bytes)'.format(
+                command, output.path, output.size))
+            return output
+
+        with tracer.trace('vtysh', self.name, command, daemon) as span:
+            span.output = output = topotest.cached_output(
+                self.cmd_cache, vtysh_command,
+                lambda: self.run(vtysh_command, timeout))
         self.logger.info('\nvtysh command => {}\nvtysh output <= {}'.format(
             command, output))
         if isjson is False:
@@ -710,10 +1248,11 @@ class TopoRouter(TopoGear):
             logger.warning('vtysh_cmd: failed to convert json output')
             return {}
 
-    def vtysh_multicmd(self, commands, pretty_output=True, daemon=None):
+    def vtysh_multicmd(self, commands, pretty_output=True, daemon=None,
+                       timeout=None):
         """
         Runs the provided commands in the vty shell and return the result of
-        execution.
+        execution. See run() for the `timeout` parameter.
 
         pretty_output: defines how the return value will be presented. When
         True it will show the command as they were executed in the vty shell,
@@ -732,8 +1271,11 @@ class TopoRouter(TopoGear):
         else:
             vtysh_command = 'vtysh {} -f {}'.format(dparam, fname)
 
-        res = self.run(vtysh_command)
-        os.unlink(fname)
+        try:
+            with tracer.trace('vtysh', self.name, commands, daemon) as span:
+                span.output = res = self.run(vtysh_command, timeout)
+        finally:
+            os.unlink(fname)
 
         self.logger.info('\nvtysh command => "{}"\nvtysh output <= "{}"'.format(
             vtysh_command, res))
@@ -802,22 +1344,44 @@ class TopoSwitch(TopoGear):
     Switch abstraction. Has the following properties:
     * cls: switch class that will be used to instantiate
     * name: switch name
+    * collapse: whether the switch can be replaced by a direct link
     """
     # pylint: disable=too-few-public-methods
 
-    def __init__(self, tgen, cls, name):
+    def __init__(self, tgen, cls, name, collapse=True):
         super(TopoSwitch, self).__init__()
         self.tgen = tgen
         self.net = None
         self.name = name
+        self.netname = tgen.get_netname(name)
         self.cls = cls
-        self.tgen.topo.addSwitch(name, cls=self.cls)
+        self.collapse = collapse
+        # Added later by Topogen._build_links() when it can be collapsed
+        if not tgen.collapse_switches:
+            self.add_to_topology()
+
+    def add_to_topology(self):
+        "Add the switch to the Mininet topology."
+        self.tgen.topo.addSwitch(self.netname, cls=self.cls)
 
     def __str__(self):
         gear = super(TopoSwitch, self).__str__()
-        gear += ' TopoSwitch<>'
+        gear += ' TopoSwitch<collapsed={}>'.format(self.collapsed)
         return gear
 
+    def link_enable(self, myif, enabled=True, netns=None):
+        """
+        Set this switch port administrative state.
+
+        NOTE: a switch collapsed into a direct link has no ports, create the
+        switch with `collapse=False` to change its ports state.
+        """
+        if self.collapsed:
+            raise RuntimeError(
+                'switch "{}" was collapsed into a direct link and has no '
+                'ports, add it with collapse=False'.format(self.name))
+        return super(TopoSwitch, self).link_enable(myif, enabled, netns)
+
 class TopoHost(TopoGear):
     "Host abstraction."
     # pylint: disable=too-few-public-methods
@@ -835,9 +1399,15 @@ class TopoHost(TopoGear):
         self.tgen = tgen
         self.net = None
         self.name = name
+        self.netname = name
         self.options = params
+        params['cls'] = tgen.node_class(params.get('cls', Host))
         self.tgen.topo.addHost(name, **params)
 
+    def address(self):
+        "Returns the host address (without prefix length)."
+        return self.options['ip'].split('/')[0]
+
     def __str__(self):
         gear = super(TopoHost, self).__str__()
         gear += ' TopoHost<ip="{}",defaultRoute="{}",privateDirs="{}">'.format(
@@ -868,7 +1438,8 @@ class TopoExaBGP(TopoHost):
         """
         params['privateDirs'] = self.PRIVATE_DIRS
         super(TopoExaBGP, self).__init__(tgen, name, **params)
-        self.tgen.topo.addHost(name, **params)
+        # Received update log indexes (see received_routes())
+        self.update_indexes = {}
 
     def __str__(self):
         gear = super(TopoExaBGP, self).__str__()
@@ -882,15 +1453,138 @@ class TopoExaBGP(TopoHost):
         * Copy exabgp env file if specified
         * Make all python files runnable
         * Run ExaBGP with env file `env_file` and configuration peer*/exabgp.cfg
+
+        See also Topogen.start_exabgp_peers() to start all peers at once.
+        """
+        self.stage(peer_dir, env_file)
+        self.launch()
+
+    def etc_path(self, fname=''):
+        """
+        Returns the path of the file `fname` of the peer private /etc/exabgp
+        as seen from this process.
+        """
+        pid = self.tgen.net[self.netname].pid
+        return os.path.join('/proc/{}/root/etc/exabgp'.format(pid), fname)
+
+    def stage(self, peer_dir, env_file=None):
+        """
+        Copies the peer configuration (see start()) into the peer private
+        /etc/exabgp with file operations from this process (through the
+        peer mount namespace root), without running node commands.
+
+        The ExaBGP API processes (`topoexa.py`) are also copied.
         """
-        self.run('mkdir /etc/exabgp')
-        self.run('chmod 755 /etc/exabgp')
-        self.run('cp {}/* /etc/exabgp/'.format(peer_dir))
+        etcdir = self.etc_path()
+        if not os.path.isdir(etcdir):
+            os.makedirs(etcdir)
+        os.chmod(etcdir, 0o755)
+
+        files = [os.path.join(peer_dir, fname)
+                 for fname in os.listdir(peer_dir)]
+        files.append(os.path.join(CWD, 'topoexa.py'))
+        for fname in files:
+            if os.path.isfile(fname):
+                shutil.copy(fname, etcdir)
         if env_file is not None:
-            self.run('cp {} /etc/exabgp/exabgp.env'.format(env_file))
-        self.run('chmod 644 /etc/exabgp/*')
-        self.run('chmod a+x /etc/exabgp/*.py')
-        self.run('chown -R exabgp:exabgp /etc/exabgp')
+            shutil.copy(env_file, os.path.join(etcdir, 'exabgp.env'))
+
+        try:
+            pwent = pwd.getpwnam('exabgp')
+        except KeyError:
+            logger.warning('{}: no exabgp user'.format(self.name))
+            pwent = None
+
+        for fname in os.listdir(etcdir):
+            path = os.path.join(etcdir, fname)
+            os.chmod(path, 0o755 if fname.endswith('.py') else 0o644)
+            if pwent is not None:
+                os.chown(path, pwent.pw_uid, pwent.pw_gid)
+        if pwent is not None:
+            os.chown(etcdir, pwent.pw_uid, pwent.pw_gid)
+
+    def write_injection(self, specs, name='inject', **options):
+        """
+        Writes the route injection file /etc/exabgp/`name`.json, to be run by
+        the ExaBGP configuration with:
+        `run "/etc/exabgp/topoexa.py inject /etc/exabgp/<name>.json";`
+
+        `specs` is a list of `topoexa.RouteSpec` (or of its dictionaries),
+        `options` are the `topoexa.Injector` parameters (`rate`, `batch`,
+        `pack` and `delay`). Usage example:
+        ```py
+        peer.write_injection([
+            RouteSpec('10.201.0.0/24', 1000000,
+                      'med 100 next-hop 10.0.1.101 origin igp'),
+        ], rate=50000, pack=100)
+        peer.start(peer_dir, env_file)
+        ```
+        """
+        etcdir = self.etc_path()
+        if not os.path.isdir(etcdir):
+            os.makedirs(etcdir)
+
+        save_injection(self.etc_path('{}.json'.format(name)), specs,
+                       '/etc/exabgp/{}.progress'.format(name), **options)
+
+    def injection_progress(self, name='inject'):
+        """
+        Returns the route injection `name` progress dictionary (`sent` and
+        `total` prefixes, `elapsed` seconds and `done`) or `None` when it
+        has not started.
+        """
+        try:
+            with open(self.etc_path('{}.progress'.format(name))) as fhandle:
+                return json.load(fhandle)
+        except (IOError, ValueError):
+            return None
+
+    def wait_injection(self, name='inject', timeout=60, wait=0.5):
+        """
+        Waits for the route injection `name` to finish. Returns `True` on
+        success, otherwise `False`.
+        """
+        def _injection_done():
+            "Returns whether the injection is done."
+            progress = self.injection_progress(name)
+            return progress is not None and progress['done']
+
+        count = max(1, int(timeout / wait))
+        success, _ = topotest.run_and_expect(
+            _injection_done, True, count=count, wait=wait)
+        progress = self.injection_progress(name)
+        if success:
+            logger.info('{}: injected {} prefixes in {}s'.format(
+                self.name, progress['sent'], progress['elapsed']))
+        else:
+            logger.error('{}: injection {} not done: {}'.format(
+                self.name, name, progress))
+        return success
+
+    def received_routes(self, log='received.log'):
+        """
+        Returns the up to date `topoexa.UpdateIndex` of the update log
+        /etc/exabgp/`log` written by the ExaBGP configuration process:
+        `run "/etc/exabgp/topoexa.py receive /etc/exabgp/<log>";`
+        """
+        if log not in self.update_indexes:
+            self.update_indexes[log] = UpdateIndex(self.etc_path(log))
+        index = self.update_indexes[log]
+        index.update()
+        return index
+
+    def has_received(self, prefix, log='received.log'):
+        "Returns whether `prefix` is currently announced to this peer."
+        update = self.received_routes(log).get(prefix)
+        return update is not None and update[0] == ANNOUNCED
+
+    def has_withdrawn(self, prefix, log='received.log'):
+        "Returns whether the last update of `prefix` is a withdrawal."
+        update = self.received_routes(log).get(prefix)
+        return update is not None and update[0] == WITHDRAWN
+
+    def launch(self):
+        "Runs the ExaBGP daemon with the staged configuration."
         output = self.run('exabgp -e /etc/exabgp/exabgp.env /etc/exabgp/exabgp.cfg')
         if output == None or len(output) == 0:
             output = '<none>'
@@ -901,6 +1595,86 @@ class TopoExaBGP(TopoHost):
         self.run('kill `cat /var/run/exabgp/exabgp.pid`')
         return ""
 
+class TopoBGPSpeaker(TopoHost):
+    """
+    Built-in BGP speaker peer abstraction: a host whose BGP session is served
+    by the test process (see lib/topobgp.py) instead of an ExaBGP daemon.
+    """
+
+    def __init__(self, tgen, name, **params):
+        """
+        BGP speakers use the following parameters:
+        * `ip`: the IP address (string) for the host interface
+        * `defaultRoute`: the default route that will be installed
+          (e.g. 'via 10.0.0.1')
+        """
+        params.setdefault('privateDirs', [])
+        super(TopoBGPSpeaker, self).__init__(tgen, name, **params)
+        self.session = None
+
+    def __str__(self):
+        gear = super(TopoBGPSpeaker, self).__str__()
+        gear += ' TopoBGPSpeaker<session="{}">'.format(self.session)
+        return gear
+
+    def start(self, local_as, peer_address, peer_as, router_id=None,
+              hold_time=180):
+        """
+        Opens the BGP session with `peer_address`. Routes can be announced
+        before the session is established. Usage example:
+        ```py
+        peer = tgen.add_bgp_speaker('peer1', '10.0.1.101/24', 'via 10.0.1.1')
+        ...
+        peer.start(99, '10.0.1.1', 100)
+        peer.announce('10.201.0.0/24', 1000, med=100)
+        ```
+        """
+        node = self.tgen.net[self.netname]
+        self.session = BGPSession(self.name, node.pid, self.address(),
+                                  local_as, peer_address, peer_as,
+                                  router_id, hold_time)
+        self.tgen.bgp_speaker().add(self.session)
+
+    def announce(self, prefix, count=1, next_hop=None, as_path=None,
+                 origin='igp', med=None, local_pref=None):
+        """
+        Announces `count` consecutive prefixes starting with `prefix` (see
+        `topoexa.prefix_range()`). The local AS is prepended to `as_path`.
+        """
+        self.session.announce(prefix_range(prefix, count), next_hop, as_path,
+                              origin, med, local_pref)
+
+    def withdraw(self, prefix, count=1):
+        "Withdraws `count` consecutive prefixes starting with `prefix`."
+        self.session.withdraw(prefix_range(prefix, count))
+
+    def established(self):
+        "Returns whether the BGP session is established."
+        return self.session is not None and self.session.established()
+
+    def received_routes(self):
+        """
+        Returns the received routes index (same interface as
+        `topoexa.UpdateIndex`).
+        """
+        return self.session
+
+    def has_received(self, prefix):
+        "Returns whether `prefix` is currently announced to this peer."
+        update = self.session.get(prefix)
+        return update is not None and update[0] == ANNOUNCED
+
+    def has_withdrawn(self, prefix):
+        "Returns whether the last update of `prefix` is a withdrawal."
+        update = self.session.get(prefix)
+        return update is not None and update[0] == WITHDRAWN
+
+    def stop(self, wait=True, assertOnError=True):
+        "Close the BGP session."
+        if self.session is not None and self.tgen.speaker is not None:
+            self.tgen.speaker.remove(self.session)
+        return ""
+
 
 #
 # Diagnostic function
@@ -916,12 +1690,14 @@ def diagnose_env():
     ret = True
 
     # Test log path exists before installing handler.
+    logdir = topotest.get_logdir_base()
     if not os.path.isdir('/tmp'):
         logger.warning('could not find /tmp for logs')
     else:
-        os.system('mkdir /tmp/topotests')
+        topotest.make_logdir(logdir)
         # Log diagnostics to file so it can be examined later.
-        fhandler = logging.FileHandler(filename='/tmp/topotests/diagnostics.txt')
+        fhandler = logging.FileHandler(
+            filename='{}/diagnostics.txt'.format(logdir))
         fhandler.setLevel(logging.DEBUG)
         fhandler.setFormatter(
             logging.Formatter(fmt='%(asctime)s %(levelname)s: %(message)s')
@@ -996,7 +1772,7 @@ def diagnose_env():
                     continue
 
                 os.system(
-                    '{} -v 2>&1 >/tmp/topotests/frr_zebra.txt'.format(path)
+                    '{} -v 2>&1 >{}/frr_zebra.txt'.format(path, logdir)
                 )
 
     # Assert that Quagga utilities exist
@@ -1035,7 +1811,7 @@ def diagnose_env():
                     continue
 
                 os.system(
-                    '{} -v 2>&1 >/tmp/topotests/quagga_zebra.txt'.format(path)
+                    '{} -v 2>&1 >{}/quagga_zebra.txt'.format(path, logdir)
                 )
 
     # Test MPLS availability
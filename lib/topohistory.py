@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+#
+# topohistory.py
+# Library of helper functions for NetDEF Topology Tests
+#
+# Copyright (c) 2018 by
+# Network Device Education Foundation, Inc. ("NetDEF")
+#
+# Permission to use, copy, modify, and/or distribute this software
+# for any purpose with or without fee is hereby granted, provided
+# that the above copyright notice and this permission notice appear
+# in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND NETDEF DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL NETDEF BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY
+# DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE
+# OF THIS SOFTWARE.
+#
+
+"""
+Historical timing store for topology tests.
+
+Stores the per module timings of every run (setup, topology build, router
+start, tests, teardown and the run_and_expect() convergence times) in a
+SQLite database keyed by the FRR version and the topotests revision, and
+detects slowdowns of a run against the previous runs.
+
+Usage example (see also the --timing-history pytest option):
+```py
+history = TimingHistory('/var/lib/topotests/history.db')
+run_id = history.add_run(report['modules'], revision=topotests_revision())
+for regression in history.find_regressions(run_id):
+    print(regression)
+```
+"""
+
+import os
+import sqlite3
+import subprocess
+import time
+
+CWD = os.path.dirname(os.path.realpath(__file__))
+
+# Minimum amount of previous samples to consider a metric baseline valid.
+MIN_SAMPLES = 5
+# Amount of previous samples used as baseline.
+MAX_SAMPLES = 20
+# Modified z-score from which a slowdown is considered significant.
+MAX_ZSCORE = 3.5
+# Slowdowns smaller than these are ignored (noise).
+MIN_DELTA = 1.0
+MIN_RATIO = 0.2
+
+def topotests_revision():
+    "Returns the topotests git revision or 'unknown'."
+    try:
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.check_output(
+                ['git', '-C', CWD, 'rev-parse', '--short', 'HEAD'],
+                stderr=devnull)
+        return output.strip()
+    # pylint: disable=W0702
+    except:
+        return 'unknown'
+
+def module_metrics(entry):
+    """
+    Converts a timing report module entry into a list of (metric, duration)
+    tuples. Convergence checks with the same name are numbered in the order
+    they were run.
+    """
+    metrics = []
+    for name in ['setup', 'topology_build', 'router_start', 'teardown',
+                 'total']:
+        metrics.append((name, entry.get(name, 0.0)))
+    for name, duration in sorted(entry.get('tests', {}).items()):
+        metrics.append(('test:{}'.format(name), duration))
+
+    seen = {}
+    for check in entry.get('convergence', []):
+        # Failed checks time out, their duration is not a convergence time
+        if check.get('success') is False:
+            continue
+        seen[check['name']] = seen.get(check['name'], 0) + 1
+        metrics.append(('check:{}#{}'.format(check['name'],
+                                             seen[check['name']]),
+                        check['duration']))
+    return metrics
+
+def median(values):
+    "Returns the median of `values`."
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+class Regression(object):
+    "Timing regression found by TimingHistory.find_regressions()."
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, module, metric, duration, baseline, samples, zscore):
+        self.module = module
+        self.metric = metric
+        self.duration = duration
+        self.baseline = baseline
+        self.samples = samples
+        self.zscore = zscore
+
+    def __str__(self):
+        return '{} {}: {:.2f}s (baseline {:.2f}s over {} runs, +{:.0f}%)'.format(
+            self.module, self.metric, self.duration, self.baseline,
+            self.samples, (self.duration / self.baseline - 1) * 100
+            if self.baseline > 0 else 100)
+
+class TimingHistory(object):
+    "SQLite backed timing history."
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                start REAL,
+                frr_version TEXT,
+                revision TEXT
+            );
+            CREATE TABLE IF NOT EXISTS timings (
+                run_id INTEGER REFERENCES runs(id),
+                module TEXT,
+                metric TEXT,
+                duration REAL,
+                frr_version TEXT
+            );
+            CREATE INDEX IF NOT EXISTS timings_metric
+                ON timings (module, metric, run_id);
+        ''')
+
+    def close(self):
+        "Close the database."
+        self.db.close()
+
+    def add_run(self, modules, revision=None, start=None):
+        """
+        Stores the timing report `modules` entries (see the --timing-report
+        pytest option) and returns the new run id.
+        """
+        if revision is None:
+            revision = topotests_revision()
+        if start is None:
+            start = time.time()
+
+        versions = set([entry.get('version') for entry in modules
+                        if entry.get('version') is not None])
+        run_version = ','.join(sorted(versions)) or None
+
+        cursor = self.db.execute(
+            'INSERT INTO runs (start, frr_version, revision) VALUES (?, ?, ?)',
+            (start, run_version, revision))
+        run_id = cursor.lastrowid
+
+        rows = []
+        for entry in modules:
+            for metric, duration in module_metrics(entry):
+                rows.append((run_id, entry['module'], metric, duration,
+                             entry.get('version')))
+        self.db.executemany(
+            'INSERT INTO timings (run_id, module, metric, duration, frr_version)'
+            ' VALUES (?, ?, ?, ?, ?)', rows)
+        self.db.commit()
+        return run_id
+
+    def runs(self):
+        "Returns the (id, start, frr_version, revision) of all runs."
+        return self.db.execute(
+            'SELECT id, start, frr_version, revision FROM runs ORDER BY id'
+        ).fetchall()
+
+    def baseline(self, module, metric, before_run, frr_version=None,
+                 limit=MAX_SAMPLES):
+        """
+        Returns the last `limit` durations of `module` `metric` stored before
+        the run `before_run`, optionally only for the FRR version
+        `frr_version`.
+        """
+        query = ('SELECT duration FROM timings WHERE module = ? AND '
+                 'metric = ? AND run_id < ?')
+        args = [module, metric, before_run]
+        if frr_version is not None:
+            query += ' AND frr_version = ?'
+            args.append(frr_version)
+        query += ' ORDER BY run_id DESC LIMIT ?'
+        args.append(limit)
+        return [row[0] for row in self.db.execute(query, args)]
+
+    def find_regressions(self, run_id, frr_version=None):
+        """
+        Compares the run `run_id` timings against the previous runs (only
+        the ones with FRR version `frr_version` when specified) and returns
+        the list of significant slowdowns.
+
+        A slowdown is significant when the modified z-score (based on the
+        baseline median and median absolute deviation) is bigger than
+        MAX_ZSCORE and it is bigger than MIN_DELTA seconds and MIN_RATIO of
+        the baseline median.
+        """
+        regressions = []
+        rows = self.db.execute(
+            'SELECT module, metric, duration FROM timings WHERE run_id = ?',
+            (run_id,)).fetchall()
+        for module, metric, duration in rows:
+            samples = self.baseline(module, metric, run_id, frr_version)
+            if len(samples) < MIN_SAMPLES:
+                continue
+
+            center = median(samples)
+            delta = duration - center
+            if delta < MIN_DELTA or delta < center * MIN_RATIO:
+                continue
+
+            mad = median([abs(sample - center) for sample in samples])
+            if mad > 0:
+                zscore = 0.6745 * delta / mad
+            else:
+                zscore = float('inf')
+            if zscore < MAX_ZSCORE:
+                continue
+
+            regressions.append(Regression(module, metric, duration, center,
+                                          len(samples), zscore))
+
+        return sorted(regressions, key=lambda r: r.duration - r.baseline,
+                      reverse=True)
+
+#for testing
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) < 2:
+        sys.stderr.write('usage: {} <database> [baseline FRR version]\n'.format(
+            sys.argv[0]))
+        sys.exit(2)
+
+    history = TimingHistory(sys.argv[1])
+    runs = history.runs()
+    for run in runs:
+        print('run {}: {} FRR {} revision {}'.format(
+            run[0], time.ctime(run[1]), run[2], run[3]))
+    if not runs:
+        sys.exit(0)
+
+    version = None
+    if len(sys.argv) > 2:
+        version = sys.argv[2]
+    found = history.find_regressions(runs[-1][0], version)
+    for regression in found:
+        print('slowdown: {}'.format(regression))
+    sys.exit(1 if found else 0)
@@ -27,7 +27,20 @@ This file defines our logging abstraction.
 """
 
 import sys
+import atexit
 import logging
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:
+    QueueHandler = None
+    QueueListener = None
 
 # Helper dictionary to convert Topogen logging levels to Python's logging.
 DEBUG_TOPO2LOGGING = {
@@ -43,6 +56,113 @@ class InfoFilter(logging.Filter):
     def filter(self, rec):
         return rec.levelno in (logging.DEBUG, logging.INFO)
 
+class TruncateFilter(logging.Filter):
+    """
+    Truncates log messages bigger than `size` bytes and appends the full
+    message to the side file `sidefile`. The truncated message points to the
+    side file entry number so the full output can still be found.
+    """
+
+    def __init__(self, size, sidefile):
+        logging.Filter.__init__(self)
+        self.size = size
+        self.sidefile = sidefile
+        self.entries = 0
+        self.fhandle = None
+
+    def filter(self, rec):
+        message = rec.getMessage()
+        if len(message) <= self.size:
+            return True
+
+        if self.fhandle is None:
+            self.fhandle = open(self.sidefile, 'a')
+
+        self.entries += 1
+        self.fhandle.write('### entry {} ({} bytes)\n{}\n'.format(
+            self.entries, len(message), message))
+        self.fhandle.flush()
+
+        rec.msg = '{}\n... truncated {} bytes, see {} entry {}'.format(
+            message[:self.size], len(message) - self.size, self.sidefile,
+            self.entries)
+        rec.args = None
+        return True
+
+#
+# Queue based logging
+#
+# Python 2 does not provide QueueHandler/QueueListener, so provide a minimal
+# implementation with the same interface when they are missing.
+#
+
+if QueueHandler is None:
+    class QueueHandler(logging.Handler):
+        "Handler that sends the log records to a queue."
+
+        def __init__(self, record_queue):
+            logging.Handler.__init__(self)
+            self.queue = record_queue
+
+        def prepare(self, record):
+            """
+            Formats the message and exception text now, so the record can be
+            handled by another thread without referencing the caller objects.
+            Like the Python 3 QueueHandler the message keeps the traceback.
+            """
+            msg = self.format(record)
+            record.message = msg
+            record.msg = msg
+            record.args = None
+            record.exc_info = None
+            record.exc_text = None
+            return record
+
+        def emit(self, record):
+            try:
+                self.queue.put_nowait(self.prepare(record))
+            # pylint: disable=W0702
+            except:
+                self.handleError(record)
+
+    class QueueListener(object):
+        "Thread that handles the records enqueued by QueueHandler."
+
+        _sentinel = None
+
+        def __init__(self, record_queue, *handlers):
+            self.queue = record_queue
+            self.handlers = handlers
+            self._thread = None
+
+        def start(self):
+            "Start the background thread."
+            self._thread = threading.Thread(target=self._monitor)
+            self._thread.daemon = True
+            self._thread.start()
+
+        def handle(self, record):
+            "Dispatch the record to the handlers."
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+        def _monitor(self):
+            while True:
+                record = self.queue.get()
+                try:
+                    if record is self._sentinel:
+                        break
+                    self.handle(record)
+                finally:
+                    self.queue.task_done()
+
+        def stop(self):
+            "Handle the remaining records and stop the background thread."
+            self.queue.put_nowait(self._sentinel)
+            self._thread.join()
+            self._thread = None
+
 #
 # Logger class definition
 #
@@ -58,6 +178,9 @@ class Logger(object):
     def __init__(self):
         # Create default global logger
         self.log_level = logging.INFO
+        self.async_mode = False
+        self.truncate_size = 0
+        self.listeners = {}
         self.logger = logging.Logger('topolog', level=self.log_level)
 
         handler_stdout = logging.StreamHandler(sys.stdout)
@@ -96,6 +219,9 @@ class Logger(object):
         nlogger = logging.Logger(name, level=log_level)
         if isinstance(target, str):
             handler = logging.FileHandler(filename=target)
+            if self.truncate_size > 0:
+                handler.addFilter(TruncateFilter(self.truncate_size,
+                                                 target + '.full'))
         else:
             handler = logging.StreamHandler(stream=target)
 
@@ -103,12 +229,77 @@ class Logger(object):
             logging.Formatter(fmt='%(asctime)s %(levelname)s: %(message)s')
         )
         nlogger.addHandler(handler)
+        if self.async_mode:
+            self._make_async(nlogger)
         self.loggers[name] = nlogger
         return nlogger
 
+    def set_async(self, truncate_size=0):
+        """
+        Moves log formatting and writing to a background thread for all
+        loggers (the existing and the ones created later).
+
+        When `truncate_size` is greater than zero, messages bigger than it
+        are truncated in the log files and the full message is written to a
+        side file with the '.full' suffix.
+        """
+        self.truncate_size = truncate_size
+        if self.async_mode:
+            return
+
+        self.async_mode = True
+        for nlogger in self.loggers.values():
+            self._make_async(nlogger)
+
+    def _make_async(self, nlogger):
+        "Replace the logger handlers with a queue handled in background."
+        handlers = nlogger.handlers[:]
+        record_queue = queue.Queue()
+        for handler in handlers:
+            nlogger.removeHandler(handler)
+        nlogger.addHandler(QueueHandler(record_queue))
+
+        listener = QueueListener(record_queue, *handlers)
+        # Python 3 listener only honors the handler levels when asked to.
+        listener.respect_handler_level = True
+        listener.start()
+        self.listeners[nlogger.name] = listener
+
+    def flush(self):
+        "Wait until all queued log records are written."
+        for listener in self.listeners.values():
+            listener.queue.join()
+
+    def stop(self):
+        """
+        Write all queued log records, stop the background threads and close
+        the truncated messages side files. Loggers are synchronous again
+        until the next `set_async()`.
+        """
+        for name, listener in self.listeners.items():
+            listener.stop()
+            nlogger = self.loggers[name]
+            for handler in nlogger.handlers[:]:
+                nlogger.removeHandler(handler)
+            for handler in listener.handlers:
+                nlogger.addHandler(handler)
+        self.listeners = {}
+        self.async_mode = False
+
+        for nlogger in self.loggers.values():
+            for handler in nlogger.handlers:
+                for hfilter in handler.filters:
+                    if (isinstance(hfilter, TruncateFilter) and
+                            hfilter.fhandle is not None):
+                        hfilter.fhandle.close()
+                        hfilter.fhandle = None
+
 #
 # Global variables
 #
 
 logger_config = Logger()
 logger = logger_config.logger
+
+# Don't lose the queued records when the test process exits.
+atexit.register(logger_config.flush)
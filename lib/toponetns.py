@@ -0,0 +1,251 @@
+#
+# toponetns.py
+# Library of helper functions for NetDEF Topology Tests
+#
+# Copyright (c) 2018 by
+# Network Device Education Foundation, Inc. ("NetDEF")
+#
+# Permission to use, copy, modify, and/or distribute this software
+# for any purpose with or without fee is hereby granted, provided
+# that the above copyright notice and this permission notice appear
+# in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND NETDEF DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL NETDEF BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY
+# DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE
+# OF THIS SOFTWARE.
+#
+
+"""
+Network namespace topology backend.
+
+Alternative to `mininet.net.Mininet` that builds the Topogen topology
+directly with Linux namespaces:
+
+* every node is a network and mount namespace held by an idle process
+  (no interactive shell, no pty);
+* node commands are run with `nsenter` by the topoexec executor;
+* switches are kernel bridges;
+* all bridges and links are created with a single `ip -batch` call, each
+  node brings its interfaces up with another one.
+
+Only the subset of the Mininet API used by Topogen and `topotest.Router` is
+implemented: `net[name]`, `start()`, `stop()` and the node `cmd()`.
+
+Enable it by setting `backend = netns` in `pytest.ini`.
+"""
+
+import os
+import signal
+import subprocess
+
+from mininet.link import Intf
+from mininet.moduledeps import pathCheck
+from mininet.node import Host
+
+from lib import topotest
+from lib.topoexec import ExecutorNode, NodeExecutor, command_string
+from lib.topolog import logger
+
+class NSNode(ExecutorNode):
+    """
+    Mixin that replaces the Mininet node shell by a namespace holder process
+    and runs the commands with the executor. It must come before the Mininet
+    node class (see `namespace_class()`).
+    """
+
+    isSetup = False
+
+    @classmethod
+    def setup(cls):
+        "Make sure our class dependencies are available"
+        pathCheck('unshare', 'nsenter', 'ip', moduleName='util-linux/iproute2')
+
+    def startShell(self, mnopts=None):
+        "Start the process holding the node namespaces."
+        # pylint: disable=W0613
+        self.exec_output = ''
+        # The holder prints a line once the namespaces exist.
+        self.shell = subprocess.Popen(
+            ['unshare', '--net', '--mount', '--propagation', 'private',
+             'sh', '-c', 'echo ready; exec sleep infinity'],
+            stdin=open(os.devnull), stdout=subprocess.PIPE,
+            preexec_fn=os.setpgrp)
+        self.shell.stdout.readline()
+        self.shell.stdout.close()
+        self.pid = self.shell.pid
+        self.executor = NodeExecutor(self.pid, self.name)
+        self.execed = False
+        self.lastCmd = None
+        self.lastPid = None
+        self.waiting = False
+
+    def mountPrivateDirs(self):
+        "Mount the private directories with a single command."
+        commands = []
+        for directory in self.privateDirs:
+            if isinstance(directory, tuple):
+                private_dir = directory[1] % self.__dict__
+                commands.append('mkdir -p {0} {1} && mount --bind {0} {1}'.format(
+                    private_dir, directory[0]))
+            else:
+                commands.append(
+                    'mkdir -p {0} && mount -n -t tmpfs tmpfs {0}'.format(
+                        directory))
+        if commands:
+            self.cmd('; '.join(commands))
+
+    def unmountPrivateDirs(self):
+        "Nothing to do: the mounts go away with the node mount namespace."
+        pass
+
+    def sendInt(self, intr=chr(3)):
+        "Commands run synchronously, there is nothing to interrupt."
+        pass
+
+    def popen(self, *args, **kwargs):
+        "Return a Popen() object in the node namespaces."
+        kwargs['mncmd'] = self.executor.prefix()
+        return super(NSNode, self).popen(*args, **kwargs)
+
+    def cleanup(self):
+        "Reap the namespace holder process (killed by terminate())."
+        if self.shell:
+            if self.shell.poll() is None:
+                os.killpg(self.shell.pid, signal.SIGKILL)
+            self.shell.wait()
+        self.shell = None
+
+_ns_classes = {}
+
+def namespace_class(cls):
+    "Returns the namespace version of the Mininet node class `cls`."
+    if cls not in _ns_classes:
+        _ns_classes[cls] = type('NS' + cls.__name__, (NSNode, cls), {})
+    return _ns_classes[cls]
+
+class NSSwitch(object):
+    """
+    Kernel bridge living in the host network namespace. Commands run in the
+    host namespace.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.ports = []
+        self.executor = NodeExecutor(None, name)
+
+    def cmd(self, *args, **kwargs):
+        "Run a command in the host namespace and return its output."
+        return self.executor.cmd(command_string(args), kwargs.get('timeout'))
+
+    def start_commands(self):
+        "Returns the `ip` commands that create the bridge and its ports."
+        commands = []
+        # Remove leftovers of interrupted runs
+        if os.path.exists('/sys/class/net/{}'.format(self.name)):
+            commands.append('link del dev {}'.format(self.name))
+        commands.append('link add name {} type bridge {}'.format(
+            self.name, topotest.BRIDGE_OPTIONS))
+        commands.append('link set dev {} up'.format(self.name))
+        return commands
+
+    def __str__(self):
+        return self.name
+
+class NamespaceNet(object):
+    """
+    Namespace topology: builds the Mininet topology `topo` without Mininet.
+    """
+
+    def __init__(self, topo):
+        self.topo = topo
+        self.hosts = []
+        self.switches = []
+        self.nameToNode = {}
+        self.build()
+
+    def __getitem__(self, name):
+        return self.nameToNode[name]
+
+    def __contains__(self, name):
+        return name in self.nameToNode
+
+    def build(self):
+        "Create the nodes, switches and links."
+        for name in self.topo.hosts():
+            params = dict(self.topo.nodeInfo(name))
+            cls = namespace_class(params.pop('cls', Host))
+            node = cls(name, **params)
+            self.hosts.append(node)
+            self.nameToNode[name] = node
+
+        for name in self.topo.switches():
+            switch = NSSwitch(name)
+            self.switches.append(switch)
+            self.nameToNode[name] = switch
+
+        commands = []
+        for switch in self.switches:
+            commands.extend(switch.start_commands())
+
+        for name1, name2, info in self.topo.links(sort=True, withInfo=True):
+            commands.extend(self._link_commands(
+                self.nameToNode[info['node1']], info.get('intfName1'),
+                info['port1'], self.nameToNode[info['node2']],
+                info.get('intfName2'), info['port2']))
+
+        if not topotest.ip_batch(commands):
+            raise Exception('failed to create the topology links')
+
+        # Bring the interfaces up and configure the nodes like Mininet does
+        for node in self.hosts:
+            intfs = ['lo'] + node.intfNames()
+            node.cmd('ip -batch - <<EOF\n{}\nEOF'.format('\n'.join(
+                ['link set dev {} up'.format(intf) for intf in intfs])))
+            node.configDefault()
+
+    def _link_commands(self, node1, ifname1, port1, node2, ifname2, port2):
+        "Returns the `ip` commands that create a link."
+        # Switches interfaces stay in the host namespace
+        if isinstance(node1, NSSwitch):
+            node1, ifname1, port1, node2, ifname2, port2 = (
+                node2, ifname2, port2, node1, ifname1, port1)
+
+        if ifname1 is None:
+            ifname1 = '{}-eth{}'.format(node1.name, port1)
+        if ifname2 is None:
+            ifname2 = '{}-eth{}'.format(node2.name, port2)
+
+        # Register the interfaces, they are created in their namespace.
+        Intf(ifname1, node=node1, port=port1, up=None,
+             moveIntfFn=lambda intf, node: True)
+        if isinstance(node2, NSSwitch):
+            node2.ports.append(ifname2)
+            return [
+                'link add name {} type veth peer name {} netns {}'.format(
+                    ifname2, ifname1, node1.pid),
+                'link set dev {} master {} up'.format(ifname2, node2.name),
+            ]
+
+        Intf(ifname2, node=node2, port=port2, up=None,
+             moveIntfFn=lambda intf, node: True)
+        return ['link add name {} netns {} type veth peer name {} netns {}'.format(
+            ifname1, node1.pid, ifname2, node2.pid)]
+
+    def start(self):
+        "Nothing to do: the topology is ready once built."
+        logger.info('namespace topology with {} nodes and {} switches'.format(
+            len(self.hosts), len(self.switches)))
+
+    def stop(self):
+        "Stop the nodes and remove the switches."
+        for node in self.hosts:
+            node.terminate()
+        # The node links are removed with their namespaces
+        topotest.ip_batch(['link del dev {}'.format(switch.name)
+                           for switch in self.switches])
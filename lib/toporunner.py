@@ -0,0 +1,467 @@
+#!/usr/bin/env python
+
+#
+# toporunner.py
+# Library of helper functions for NetDEF Topology Tests
+#
+# Copyright (c) 2018 by
+# Network Device Education Foundation, Inc. ("NetDEF")
+#
+# Permission to use, copy, modify, and/or distribute this software
+# for any purpose with or without fee is hereby granted, provided
+# that the above copyright notice and this permission notice appear
+# in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND NETDEF DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL NETDEF BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY
+# DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE
+# OF THIS SOFTWARE.
+#
+
+"""
+Parallel topology test runner.
+
+Runs the topology test modules (the test directories) concurrently on the
+same host: each module runs in its own pytest process with its own run
+identifier (`TOPOTESTS_RUN_ID`, used to make the switch and switch interface
+names unique) and log root (`TOPOTESTS_LOGDIR`).
+
+Modules that use Mininet directly and clean up the whole Mininet environment
+(`mn -c`) can't share the host, they are run alone.
+
+The modules are scheduled longest first, using their durations recorded in
+the timing history database (see --timing-history) when available or a
+static estimate based on the topology size otherwise. The amount of nodes
+(routers and hosts) running at the same time can be limited with a node or
+memory budget. The size of the generated topologies comes from their node
+scale parameters (see Topogen.get_scale()).
+
+Modules with scale parameters can run once per size in the same session
+with `--scale` (e.g. `--scale bgp_ecmp_peers=20,100,500`).
+
+Usage example:
+```shell
+$ # Run all topology tests with 8 workers
+$ sudo python lib/toporunner.py -j 8
+$ # Run some of them, passing arguments to pytest
+$ sudo python lib/toporunner.py -j 2 ospf-topo1 bfd-topo1 -- -x
+$ # Use the recorded durations, limit the nodes running at the same time
+$ sudo python lib/toporunner.py -j 8 --history /var/tmp/topotests.db \
+      --max-nodes 64 -- --timing-history=/var/tmp/topotests.db
+$ # Show the schedule without running it
+$ python lib/toporunner.py -j 8 --list
+$ # Run the BGP ECMP topology with 20, 100 and 500 peers
+$ sudo python lib/toporunner.py -j 3 --scale bgp_ecmp_peers=20,100,500 \
+      bgp-ecmp-topo1
+```
+
+pytest-xdist can also be used (`pytest -n 8 --dist=loadfile`), the worker
+name is used as run identifier, but it can't isolate the legacy modules.
+"""
+
+import argparse
+import ConfigParser
+import glob
+import itertools
+import multiprocessing
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+import time
+
+CWD = os.path.dirname(os.path.realpath(__file__))
+TOPOTESTS_DIR = os.path.dirname(CWD)
+
+# Directories that don't contain topology tests (see pytest.ini).
+IGNORED_DIRS = ['lib', 'example-test']
+
+# Test code that makes a module unable to share the host.
+EXCLUSIVE_REGEXP = re.compile(r'mn -c|Mininet\(')
+
+# Node configuration directories (e.g. 'r1', 'ce2' or 'peer10').
+NODE_DIR_REGEXP = re.compile(r'^[a-z]+[0-9]+$')
+# Nodes added with a literal name in the test code.
+NODE_ADD_REGEXP = re.compile(
+    r"add_(?:router|exabgp_peer|bgp_speaker)\(\s*'([a-z]+[0-9]+)'")
+# Scale parameters (see Topogen.get_scale()): name, default value and
+# whether it is a number of nodes.
+SCALE_REGEXP = re.compile(
+    r"get_scale\(\s*'(\w+)'\s*,\s*([0-9]+)\s*(,\s*nodes\s*=\s*True\s*)?\)")
+# Fixed sleeps in the test code.
+SLEEP_REGEXP = re.compile(r'sleep\(\s*([0-9]+(?:\.[0-9]+)?)')
+
+# Static duration estimate: fixed cost plus a cost per node (in seconds).
+MODULE_BASE_COST = 10.0
+NODE_COST = 3.0
+# Default estimated memory used by a node (in MB).
+NODE_MEMORY = 40
+
+class TestModule(object):
+    "Topology test module (test directory) run state."
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, name, path, scale=None):
+        self.name = name
+        self.path = path
+        # Scale parameters values of this run
+        self.scale = scale or {}
+        self.exclusive = is_exclusive(path)
+        self.nodes = count_nodes(path, self.scale)
+        self.cost = estimate_duration(path, self.nodes)
+        self.cost_source = 'estimate'
+        self.slot = None
+        self.process = None
+        self.logfile = None
+        self.start = None
+        self.duration = None
+        self.returncode = None
+
+    def __str__(self):
+        return self.name
+
+def is_exclusive(path):
+    "Returns `True` if the module at `path` must run alone."
+    for fname in glob.glob(os.path.join(path, 'test_*.py')):
+        with open(fname) as fhandle:
+            if EXCLUSIVE_REGEXP.search(fhandle.read()):
+                return True
+    return False
+
+def get_scales(path):
+    """
+    Returns the scale parameters of the module at `path`: a dictionary with
+    the parameters default value and whether it is a number of nodes.
+    """
+    scales = {}
+    for fname in glob.glob(os.path.join(path, 'test_*.py')):
+        with open(fname) as fhandle:
+            for name, default, nodes in SCALE_REGEXP.findall(fhandle.read()):
+                scales[name] = (int(default), nodes != '')
+    return scales
+
+def scale_value(name, default, scale=None):
+    """
+    Returns the scale parameter `name` value like Topogen.get_scale() does:
+    from `scale`, the `TOPOTESTS_<NAME>` environment variable, the
+    `pytest.ini` option or `default`.
+    """
+    if scale and name in scale:
+        return scale[name]
+    value = os.environ.get('TOPOTESTS_{}'.format(name.upper()))
+    if value is None:
+        config = ConfigParser.ConfigParser()
+        config.read(os.path.join(TOPOTESTS_DIR, 'pytest.ini'))
+        if config.has_option('topogen', name):
+            value = config.get('topogen', name)
+    if value is None:
+        return default
+    return int(value)
+
+def count_nodes(path, scale=None):
+    """
+    Returns the amount of nodes of the module at `path`: the configured
+    nodes, the ones added by name in the test code and the generated ones
+    (node scale parameters, with the `scale` values).
+    """
+    names = set([name for name in os.listdir(path)
+                 if NODE_DIR_REGEXP.match(name) and
+                 os.path.isdir(os.path.join(path, name))])
+    for fname in glob.glob(os.path.join(path, 'test_*.py')):
+        with open(fname) as fhandle:
+            names.update(NODE_ADD_REGEXP.findall(fhandle.read()))
+    nodes = len(names)
+    for name, (default, is_nodes) in get_scales(path).items():
+        if is_nodes:
+            nodes += scale_value(name, default, scale)
+    return nodes
+
+def estimate_duration(path, nodes):
+    """
+    Returns a static estimate of the module duration (in seconds) based on
+    the amount of nodes and the fixed sleeps found in its test files.
+    """
+    sleeps = 0.0
+    for fname in glob.glob(os.path.join(path, 'test_*.py')):
+        with open(fname) as fhandle:
+            for line in fhandle:
+                if line.strip().startswith('#'):
+                    continue
+                for amount in SLEEP_REGEXP.findall(line):
+                    sleeps += float(amount)
+    return MODULE_BASE_COST + NODE_COST * nodes + sleeps
+
+def load_durations(history_path, samples=5):
+    """
+    Returns a dictionary with the recorded module durations (median of the
+    last `samples` runs) from the timing history database at
+    `history_path`. The key is the test directory name.
+    """
+    durations = {}
+    if history_path is None or not os.path.isfile(history_path):
+        return durations
+
+    db = sqlite3.connect(history_path)
+    rows = db.execute(
+        "SELECT module, run_id, duration FROM timings WHERE metric = 'total' "
+        "ORDER BY run_id DESC").fetchall()
+    db.close()
+
+    # Sum the test files of each directory per run
+    runs = {}
+    for module, run_id, duration in rows:
+        name = module.split('/')[0]
+        runs.setdefault(name, {})
+        runs[name][run_id] = runs[name].get(run_id, 0.0) + duration
+
+    for name, totals in runs.items():
+        last = [totals[run_id] for run_id in
+                sorted(totals.keys(), reverse=True)[:samples]]
+        last.sort()
+        durations[name] = last[len(last) // 2]
+    return durations
+
+def find_modules(names=None, scales=None):
+    """
+    Returns the list of test modules. When `names` is not specified all
+    topology test directories are returned.
+
+    `scales` is a dictionary with the values of scale parameters to run:
+    the modules using them are run once per value (combination).
+    """
+    scales = scales or {}
+    if not names:
+        names = sorted([name for name in os.listdir(TOPOTESTS_DIR)
+                        if name not in IGNORED_DIRS and
+                        glob.glob(os.path.join(TOPOTESTS_DIR, name,
+                                               'test_*.py'))])
+
+    modules = []
+    for name in names:
+        name = os.path.basename(os.path.normpath(name))
+        path = os.path.join(TOPOTESTS_DIR, name)
+        if not os.path.isdir(path):
+            raise ValueError('test directory not found: {}'.format(name))
+
+        used = sorted([scale for scale in get_scales(path) if scale in scales])
+        if not used:
+            modules.append(TestModule(name, path))
+            continue
+        for values in itertools.product(*[scales[scale] for scale in used]):
+            scale = dict(zip(used, values))
+            modules.append(TestModule('{}[{}]'.format(name, ','.join(
+                ['{}={}'.format(key, scale[key]) for key in used])),
+                                      path, scale))
+    return modules
+
+def schedule(modules, durations=None):
+    """
+    Sets the modules cost from the recorded `durations` (when available) and
+    returns them in the order they should start: the exclusive modules
+    first (they run alone, so their order doesn't matter), then the others
+    longest first.
+    """
+    durations = durations or {}
+    for module in modules:
+        # The recorded durations don't tell the scale they were run with
+        if module.name in durations and not module.scale:
+            module.cost = durations[module.name]
+            module.cost_source = 'history'
+
+    return sorted(modules, key=lambda m: (not m.exclusive, -m.cost, m.name))
+
+class Runner(object):
+    """
+    Runs the test modules using up to `jobs` concurrent pytest processes.
+
+    `max_nodes` limits the amount of nodes running at the same time, a
+    module bigger than the limit runs alone.
+    """
+
+    def __init__(self, modules, jobs, logdir, pytest_args=None,
+                 max_nodes=None):
+        self.pending = list(modules)
+        self.jobs = jobs
+        self.logdir = logdir
+        self.pytest_args = pytest_args or []
+        self.max_nodes = max_nodes
+        self.running = []
+        self.finished = []
+
+    def free_slots(self):
+        "Returns the worker slots not in use."
+        used = [module.slot for module in self.running]
+        return [slot for slot in range(self.jobs) if slot not in used]
+
+    def pick(self):
+        """
+        Returns the next module that can start now or `None`: the first
+        pending module, when it fits in the node budget. The modules behind
+        it don't start ahead of it, so the longest ones still start first
+        (a module bigger than the budget runs alone). Exclusive modules wait
+        for all other modules to finish and block the others from starting
+        while they run.
+        """
+        if not self.pending:
+            return None
+        if any([module.exclusive for module in self.running]):
+            return None
+        if self.pending[0].exclusive:
+            if self.running:
+                return None
+            return self.pending[0]
+
+        if self.max_nodes is None or not self.running:
+            return self.pending[0]
+
+        used = sum([module.nodes for module in self.running])
+        if used + self.pending[0].nodes <= self.max_nodes:
+            return self.pending[0]
+        return None
+
+    def launch(self, module, slot):
+        "Start the module pytest process in the worker slot `slot`."
+        env = dict(os.environ)
+        if module.exclusive:
+            env.pop('TOPOTESTS_RUN_ID', None)
+        else:
+            env['TOPOTESTS_RUN_ID'] = 'w{}'.format(slot)
+        env['TOPOTESTS_LOGDIR'] = os.path.join(self.logdir, module.name)
+        for name, value in module.scale.items():
+            env['TOPOTESTS_{}'.format(name.upper())] = str(value)
+
+        module.slot = slot
+        module.logfile = os.path.join(self.logdir, '{}.out'.format(module.name))
+        module.start = time.time()
+        with open(module.logfile, 'w') as output:
+            module.process = subprocess.Popen(
+                [sys.executable, '-m', 'pytest', os.path.basename(module.path)] +
+                self.pytest_args,
+                cwd=TOPOTESTS_DIR, env=env, stdout=output,
+                stderr=subprocess.STDOUT)
+        self.pending.remove(module)
+        self.running.append(module)
+        print('started {} (worker {})'.format(module, slot))
+
+    def reap(self):
+        "Collect the finished modules."
+        for module in list(self.running):
+            returncode = module.process.poll()
+            if returncode is None:
+                continue
+
+            module.returncode = returncode
+            module.duration = time.time() - module.start
+            self.running.remove(module)
+            self.finished.append(module)
+            print('{} {} ({:.1f} secs)'.format(
+                'passed' if returncode == 0 else 'FAILED', module,
+                module.duration))
+
+    def run(self):
+        "Run all modules and return the amount of failed modules."
+        # Clean up left overs once, the tests won't do it in parallel mode.
+        os.system('mn -c > /dev/null 2>&1')
+        if not os.path.isdir(self.logdir):
+            os.makedirs(self.logdir)
+
+        start = time.time()
+        while self.pending or self.running:
+            self.reap()
+            for slot in self.free_slots():
+                module = self.pick()
+                if module is None:
+                    break
+                self.launch(module, slot)
+            time.sleep(0.2)
+
+        failed = [module for module in self.finished if module.returncode != 0]
+        print('{} modules in {:.1f} secs, {} failed (logs in {})'.format(
+            len(self.finished), time.time() - start, len(failed), self.logdir))
+        for module in failed:
+            print('  FAILED {}: {}'.format(module, module.logfile))
+        return len(failed)
+
+def main(argv=None):
+    "Command line entry point."
+    if argv is None:
+        argv = sys.argv[1:]
+
+    # Arguments after '--' are passed to pytest
+    pytest_args = []
+    if '--' in argv:
+        idx = argv.index('--')
+        pytest_args = argv[idx + 1:]
+        argv = argv[:idx]
+
+    parser = argparse.ArgumentParser(
+        description='Run topology test modules in parallel')
+    parser.add_argument('-j', '--jobs', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='amount of modules running at the same time')
+    parser.add_argument('--logdir', default=None,
+                        help='log root directory (default: '
+                        '/tmp/topotests/run-<timestamp>)')
+    parser.add_argument('--history', default=None, metavar='DB',
+                        help='timing history database with the modules '
+                        'recorded durations')
+    parser.add_argument('--max-nodes', type=int, default=None,
+                        help='maximum amount of nodes running at the same '
+                        'time')
+    parser.add_argument('--max-memory', type=int, default=None,
+                        help='maximum memory (MB) used by the running nodes')
+    parser.add_argument('--node-memory', type=int, default=NODE_MEMORY,
+                        help='estimated memory used by a node (MB, default: '
+                        '%(default)s)')
+    parser.add_argument('--scale', action='append', default=[],
+                        metavar='NAME=VALUES',
+                        help='run the modules using the scale parameter NAME '
+                        'once per comma separated value (e.g. '
+                        'bgp_ecmp_peers=20,100,500)')
+    parser.add_argument('--list', action='store_true',
+                        help='show the schedule and exit')
+    parser.add_argument('modules', nargs='*',
+                        help='test directories (default: all)')
+    args = parser.parse_args(argv)
+
+    logdir = args.logdir
+    if logdir is None:
+        logdir = '/tmp/topotests/run-{}'.format(time.strftime('%Y%m%d-%H%M%S'))
+
+    # The memory budget is converted to a node budget
+    max_nodes = args.max_nodes
+    if args.max_memory is not None:
+        memory_nodes = max(1, args.max_memory // args.node_memory)
+        if max_nodes is None or memory_nodes < max_nodes:
+            max_nodes = memory_nodes
+
+    scales = {}
+    for scale in args.scale:
+        name, _, values = scale.partition('=')
+        try:
+            scales[name] = [int(value) for value in values.split(',')]
+        except ValueError:
+            parser.error('invalid scale: {}'.format(scale))
+
+    modules = schedule(find_modules(args.modules, scales),
+                       load_durations(args.history))
+    if args.list:
+        for module in modules:
+            print('{:8.1f}s ({:<8}) {:3} nodes {}{}'.format(
+                module.cost, module.cost_source, module.nodes, module,
+                ' (alone)' if module.exclusive else ''))
+        return 0
+
+    runner = Runner(modules, max(1, args.jobs), logdir, pytest_args,
+                    max_nodes)
+    if runner.run() > 0:
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,405 @@
+#
+# topotrace.py
+# Library of helper functions for NetDEF Topology Tests
+#
+# Copyright (c) 2018 by
+# Network Device Education Foundation, Inc. ("NetDEF")
+#
+# Permission to use, copy, modify, and/or distribute this software
+# for any purpose with or without fee is hereby granted, provided
+# that the above copyright notice and this permission notice appear
+# in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND NETDEF DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL NETDEF BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY
+# DAMAGES WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS,
+# WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS
+# ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE
+# OF THIS SOFTWARE.
+#
+
+"""
+Command tracing utilities for topology tests.
+
+The tracer records how long every node command takes and writes one JSON
+event per line to the trace file. At the end of the topology it reports the
+slowest commands and the latency histograms per node and daemon.
+
+Tracing is disabled by default, enable it by setting `trace_path` in
+`pytest.ini` or the `TOPOTESTS_TRACE` environment variable with the trace
+file path.
+
+The timeline records the topology lifecycle phases (setup, router start,
+convergence polling, teardown) and exports them in the Chrome trace-event
+format, which can be opened with chrome://tracing or https://ui.perfetto.dev.
+Enable it by setting `timeline_dir` in `pytest.ini` or the
+`TOPOTESTS_TIMELINE` environment variable with the output directory.
+"""
+
+import json
+import os
+import threading
+import time
+
+from lib.topolog import logger
+
+# Amount of commands shown in the slowest commands summary.
+SLOWEST_COUNT = 10
+
+# Histogram bucket upper limits (in milliseconds).
+HISTOGRAM_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048,
+                     4096, 8192]
+
+class TraceSpan(object):
+    """
+    Context manager that measures a command execution. The caller must set
+    `output` with the command output so its size gets recorded.
+    """
+
+    def __init__(self, tracer, kind, node, command, daemon):
+        self.tracer = tracer
+        self.kind = kind
+        self.node = node
+        self.command = command
+        self.daemon = daemon
+        self.output = None
+        self.start = None
+
+    def __enter__(self):
+        self.tracer.nested(1)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.nested(-1)
+        self.tracer.record(self.kind, self.node, self.command,
+                           self.start, time.time() - self.start,
+                           self.output, self.daemon)
+        return False
+
+class NullSpan(object):
+    """
+    Context manager used when tracing is disabled or nested. A new one is
+    used per command: concurrent callers keep their own `output`.
+    """
+
+    output = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+class CommandTracer(object):
+    """
+    Command tracer: records the node commands duration in JSON-lines format
+    and summarizes them per module.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.modname = None
+        self.fhandle = None
+        self.events = []
+        self.lock = threading.Lock()
+        self._local = threading.local()
+
+    def start(self, modname, path):
+        "Start tracing the module `modname` commands into the file `path`."
+        self.stop()
+        self.modname = modname
+        self.fhandle = open(path, 'a')
+        self.events = []
+        self.enabled = True
+
+    def stop(self):
+        "Stop tracing and close the trace file."
+        self.enabled = False
+        if self.fhandle is not None:
+            self.fhandle.close()
+            self.fhandle = None
+
+    def trace(self, kind, node, command, daemon=None):
+        """
+        Returns a context manager that traces the command. `kind` is the
+        entry point type (e.g. 'run', 'vtysh', 'lucommand' or 'cmd').
+
+        Only the outermost entry point is traced: the commands run inside
+        another traced command (e.g. the 'run' of a 'vtysh') are part of it
+        and would be counted twice.
+
+        Usage example:
+        ```py
+        with tracer.trace('run', 'r1', command) as span:
+            span.output = node.cmd(command)
+        ```
+        """
+        if not self.enabled or getattr(self._local, 'depth', 0) > 0:
+            return NullSpan()
+        return TraceSpan(self, kind, node, command, daemon)
+
+    def nested(self, delta):
+        "Updates the current thread traced commands depth."
+        self._local.depth = getattr(self._local, 'depth', 0) + delta
+
+    def record(self, kind, node, command, start, duration, output,
+               daemon=None):
+        "Register a traced command event."
+        try:
+            outsize = len(output)
+        except TypeError:
+            # Not a string (e.g. no output or a boolean result).
+            outsize = 0
+
+        event = {
+            'module': self.modname,
+            'kind': kind,
+            'router': node,
+            'daemon': daemon,
+            'command': command,
+            'start': start,
+            'duration': duration,
+            'output_size': outsize,
+        }
+        with self.lock:
+            if not self.enabled:
+                return
+            self.events.append(event)
+            self.fhandle.write(json.dumps(event) + '\n')
+
+        # Show the commands as node sub-spans in the timeline
+        if timeline.enabled:
+            timeline.add_span(command, kind, node, start, duration,
+                              {'daemon': daemon, 'output_size': outsize})
+
+    def report(self):
+        """
+        Logs the summary of the slowest commands and the latency histograms
+        per node and daemon. Returns the summary string.
+        """
+        with self.lock:
+            events = self.events
+            self.events = []
+
+        if not events:
+            return ''
+
+        lines = ['command trace summary for {} ({} commands, {:.2f} secs)'.format(
+            self.modname, len(events), sum([e['duration'] for e in events]))]
+
+        lines.append('slowest commands:')
+        slowest = sorted(events, key=lambda e: e['duration'], reverse=True)
+        for event in slowest[:SLOWEST_COUNT]:
+            lines.append('  {:9.3f}s {:<9} {:<8} {:<8} {}'.format(
+                event['duration'], event['kind'], event['router'],
+                event['daemon'] or '-', event['command'][:60]))
+
+        groups = {}
+        for event in events:
+            key = (event['router'], event['daemon'] or '-', event['kind'])
+            groups.setdefault(key, []).append(event['duration'])
+
+        for key in sorted(groups.keys()):
+            lines.append('latency histogram {}/{} ({}, {} commands):'.format(
+                key[0], key[1], key[2], len(groups[key])))
+            lines.extend(format_histogram(groups[key]))
+
+        summary = '\n'.join(lines)
+        logger.info(summary)
+        return summary
+
+class TimelineSpan(object):
+    """
+    Context manager that records a timeline span. Extra span information can
+    be added to the `args` dictionary before the context exits.
+    """
+
+    def __init__(self, timeline, name, category, lane, args):
+        self.timeline = timeline
+        self.name = name
+        self.category = category
+        self.lane = lane
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args['exception'] = exc_type.__name__
+        self.timeline.add_span(self.name, self.category, self.lane,
+                               self.start, time.time() - self.start,
+                               self.args)
+        return False
+
+class NullTimelineSpan(object):
+    """
+    Context manager used when the timeline is disabled, a new one per span
+    so concurrent callers don't share `args`.
+    """
+
+    def __init__(self):
+        self.args = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.args.clear()
+        return False
+
+class Timeline(object):
+    """
+    Topology lifecycle timeline: records spans in lanes (the topology itself
+    and one lane per node) and exports them in the Chrome trace-event format.
+    """
+
+    # Lane for the topology wide phases.
+    TOPOLOGY_LANE = 'topogen'
+
+    def __init__(self):
+        self.enabled = False
+        # Record even when no output directory was configured (e.g. for
+        # the test timing report).
+        self.always_record = False
+        self.modname = None
+        self.outdir = None
+        self.events = []
+        self.lanes = {}
+        self.lock = threading.Lock()
+
+    def start(self, modname, outdir=None):
+        """
+        Start recording the module `modname` timeline. When `outdir` is
+        `None` the timeline is only kept in memory.
+        """
+        self.modname = modname
+        self.outdir = outdir
+        self.events = []
+        self.lanes = {self.TOPOLOGY_LANE: 0}
+        self.enabled = True
+
+    def stop(self):
+        "Stop recording, the recorded spans are kept until the next start()."
+        self.enabled = False
+
+    def span(self, name, category='phase', lane=None, **args):
+        """
+        Returns a context manager that records the span `name` in the `lane`
+        (the node name or `None` for the topology phases).
+
+        Usage example:
+        ```py
+        with timeline.span('start', lane='r1'):
+            router.start()
+        ```
+        """
+        if not self.enabled:
+            return NullTimelineSpan()
+        return TimelineSpan(self, name, category, lane, args)
+
+    def add_span(self, name, category, lane, start, duration, args=None):
+        "Register a finished span (times are in seconds)."
+        if lane is None:
+            lane = self.TOPOLOGY_LANE
+
+        with self.lock:
+            if not self.enabled:
+                return
+            tid = self.lanes.setdefault(lane, len(self.lanes))
+            self.events.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': int(start * 1000000),
+                'dur': int(duration * 1000000),
+                'pid': 1,
+                'tid': tid,
+                'args': args or {},
+            })
+
+    def spans(self, category=None):
+        """
+        Returns the recorded spans as (name, lane, start, duration, args)
+        tuples, optionally filtered by `category`.
+        """
+        lanenames = dict((tid, lane) for lane, tid in self.lanes.items())
+        return [(event['name'], lanenames[event['tid']],
+                 event['ts'] / 1000000.0, event['dur'] / 1000000.0,
+                 event['args'])
+                for event in self.events
+                if category is None or event['cat'] == category]
+
+    def export(self, path=None):
+        """
+        Writes the recorded spans in the Chrome trace-event JSON format and
+        stops recording. Returns the written file path.
+        """
+        if path is None:
+            path = os.path.join(self.outdir, '{}.json'.format(self.modname))
+
+        with self.lock:
+            self.enabled = False
+            events = list(self.events)
+
+        # Name the process and lanes, keep the topology lane on top.
+        metadata = [{'name': 'process_name', 'ph': 'M', 'pid': 1, 'tid': 0,
+                     'args': {'name': self.modname}}]
+        for lane, tid in self.lanes.items():
+            metadata.append({'name': 'thread_name', 'ph': 'M', 'pid': 1,
+                             'tid': tid, 'args': {'name': lane}})
+            metadata.append({'name': 'thread_sort_index', 'ph': 'M',
+                             'pid': 1, 'tid': tid,
+                             'args': {'sort_index': tid}})
+
+        with open(path, 'w') as fhandle:
+            json.dump({'traceEvents': metadata + events,
+                       'displayTimeUnit': 'ms'}, fhandle)
+
+        logger.info('timeline written to {}'.format(path))
+        return path
+
+def histogram(durations):
+    """
+    Returns a list with the amount of `durations` (in seconds) per bucket of
+    HISTOGRAM_BUCKETS. The last item counts the durations bigger than the
+    last bucket.
+    """
+    counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+    for duration in durations:
+        msecs = duration * 1000
+        for idx, limit in enumerate(HISTOGRAM_BUCKETS):
+            if msecs < limit:
+                counts[idx] += 1
+                break
+        else:
+            counts[-1] += 1
+    return counts
+
+def format_histogram(durations, width=40):
+    "Returns the `durations` histogram as a list of text lines."
+    counts = histogram(durations)
+    maxcount = max(counts)
+    lines = []
+    for idx, count in enumerate(counts):
+        if count == 0:
+            continue
+        if idx < len(HISTOGRAM_BUCKETS):
+            label = '<{} ms'.format(HISTOGRAM_BUCKETS[idx])
+        else:
+            label = '>={} ms'.format(HISTOGRAM_BUCKETS[-1])
+        bar = '#' * max(1, count * width // maxcount)
+        lines.append('  {:>10} | {} {}'.format(label, bar, count))
+    return lines
+
+#
+# Global variables
+#
+
+tracer = CommandTracer()
+timeline = Timeline()